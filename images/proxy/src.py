@@ -1,32 +1,66 @@
 from tools.core import src
+from tools.core.utils import execute
 import os
 
+FRONTEND_REPO = "https://github.com/ExchangeUnion/xud-ui-dashboard"
+BACKEND_REPO = "https://github.com/ExchangeUnion/xud-docker-api"
+
 
 class SourceManager(src.SourceManager):
     def __init__(self):
         super().__init__(None)
-        self.frontend_dir = os.path.join(self.src_dir, "frontend")
-        self.backend_dir = os.path.join(self.src_dir, "backend")
 
-    def ensure(self, version):
-        self.ensure_repo("https://github.com/ExchangeUnion/xud-ui-dashboard", self.frontend_dir)
-        self.ensure_repo("https://github.com/ExchangeUnion/xud-docker-api", self.backend_dir)
+    @property
+    def frontend_dir(self):
+        return os.path.join(self.src_dir, "frontend")
+
+    @property
+    def backend_dir(self):
+        return os.path.join(self.src_dir, "backend")
+
+    def _get_refs(self, version):
         if version == "latest":
             # change "master" or "main" to a another xud branch for testing
-            self.checkout_repo(self.frontend_dir, "main")
-            self.checkout_repo(self.backend_dir, "master")
+            return "main", "master"
         elif version == "1.3.0":
-            self.checkout_repo(self.frontend_dir, "v1.2.0")
-            self.checkout_repo(self.backend_dir, "v1.3.0")
+            return "v1.2.0", "v1.3.0"
         else:
-            self.checkout_repo(self.frontend_dir, "v" + version)
-            self.checkout_repo(self.backend_dir, "v" + version)
+            return "v" + version, "v" + version
+
+    def get_refs(self, version):
+        frontend_ref, backend_ref = self._get_refs(version)
+        return [(FRONTEND_REPO, frontend_ref), (BACKEND_REPO, backend_ref)]
+
+    def ensure(self, version):
+        self.src_dir = self.get_src_dir(version)
+        self.ensure_repo(FRONTEND_REPO, self.frontend_dir)
+        self.ensure_repo(BACKEND_REPO, self.backend_dir)
+        frontend_ref, backend_ref = self._get_refs(version)
+        self.checkout_repo(self.frontend_dir, frontend_ref)
+        self.checkout_repo(self.backend_dir, backend_ref)
 
     def get_application_revision(self, version):
         r1 = self.get_revision(self.frontend_dir)
-        r2 = self.get_revision(self.backend_dir)
+        if "PROXY_BACKEND_REPO" in os.environ:
+            # the copy in backend_dir isn't a git repository
+            r2 = self.get_local_revision(os.environ["PROXY_BACKEND_REPO"])
+        else:
+            r2 = self.get_revision(self.backend_dir)
         return f"frontend:{r1},backend:{r2}"
 
+    def get_local_revision(self, repo_dir):
+        revision = self.get_revision(repo_dir)
+        if execute(f"git -C {repo_dir} status --porcelain --untracked-files=no").strip():
+            revision += "-dirty"
+        return revision
+
+    def check(self, repo_url, repo_dir):
+        if repo_url == BACKEND_REPO and "PROXY_BACKEND_REPO" in os.environ:
+            # the copy of PROXY_BACKEND_REPO is no worktree of the mirror,
+            # checkout_repo brings it up to date
+            return True
+        return super().check(repo_url, repo_dir)
+
     def checkout_repo(self, repo_dir, ref):
         if "backend" in repo_dir:
             if "PROXY_BACKEND_REPO" not in os.environ:
@@ -45,7 +79,10 @@ class SourceManager(src.SourceManager):
             # -v verbose
             # -z compress
             # -h human-readable
-            os.system("rsync -avzh --exclude='.git' --exclude='.idea' %s %s" % (src_dir, dest_dir))
+            # --delete-excluded also removes the .git file of a worktree
+            # which was checked out here before
+            os.system("rsync -avzh --delete --delete-excluded --exclude='.git' --exclude='.idea' %s %s" % (
+                src_dir, dest_dir))
 
         elif "frontend" in repo_dir:
             super().checkout_repo(repo_dir, ref)
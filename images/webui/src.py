@@ -1,22 +1,46 @@
 from tools.core import src
 import os
 
+FRONTEND_REPO = "https://github.com/ExchangeUnion/xud-webui-poc"
+BACKEND_REPO = "https://github.com/ExchangeUnion/xud-socketio"
+
 
 class SourceManager(src.SourceManager):
     def __init__(self):
         super().__init__(None)
-        self.frontend_dir = os.path.join(self.src_dir, "frontend")
-        self.backend_dir = os.path.join(self.src_dir, "backend")
 
-    def ensure(self, version):
-        self.ensure_repo("https://github.com/ExchangeUnion/xud-webui-poc", self.frontend_dir)
-        self.ensure_repo("https://github.com/ExchangeUnion/xud-socketio", self.backend_dir)
+    @property
+    def frontend_dir(self):
+        return os.path.join(self.src_dir, "frontend")
+
+    @property
+    def backend_dir(self):
+        return os.path.join(self.src_dir, "backend")
+
+    def _get_refs(self, version):
         if version == "latest":
-            self.checkout_repo(self.frontend_dir, "master")
-            self.checkout_repo(self.backend_dir, "master")
+            return "master", "master"
         elif version == "1.0.0":
-            self.checkout_repo(self.frontend_dir, "v1.0.0")
-            self.checkout_repo(self.backend_dir, "v1.1.0")
+            return "v1.0.0", "v1.1.0"
+        else:
+            return None
+
+    def get_refs(self, version):
+        refs = self._get_refs(version)
+        if not refs:
+            return []
+        frontend_ref, backend_ref = refs
+        return [(FRONTEND_REPO, frontend_ref), (BACKEND_REPO, backend_ref)]
+
+    def ensure(self, version):
+        self.src_dir = self.get_src_dir(version)
+        self.ensure_repo(FRONTEND_REPO, self.frontend_dir)
+        self.ensure_repo(BACKEND_REPO, self.backend_dir)
+        refs = self._get_refs(version)
+        if refs:
+            frontend_ref, backend_ref = refs
+            self.checkout_repo(self.frontend_dir, frontend_ref)
+            self.checkout_repo(self.backend_dir, backend_ref)
 
     def get_application_revision(self, version):
         r1 = self.get_revision(self.frontend_dir)
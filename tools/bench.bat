@@ -0,0 +1,3 @@
+@echo off
+set TOOLS_DIR=%~dp0
+python %TOOLS_DIR%helper.py bench %*
@@ -0,0 +1,5 @@
+from .engine import FakeEngine
+from .registry import FakeRegistry
+from .remotes import LocalRemotes
+from .runner import Benchmark, Result
+from .shim import Docker
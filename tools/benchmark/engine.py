@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from .shim import Docker
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _Server
+
+    BUILD_PATH = re.compile(r"^/v[\d.]+/build$")
+    TAG_PATH = re.compile(r"^/v[\d.]+/images/(.+)/tag$")
+    PUSH_PATH = re.compile(r"^/v[\d.]+/images/(.+)/push$")
+    INSPECT_PATH = re.compile(r"^/v[\d.]+/images/(.+)/json$")
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        self.server.engine.logger.debug(format, *args)
+
+    def _read_body(self) -> int:
+        """Reads and drops the request body, returns its size."""
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            size = 0
+            while True:
+                length = int(self.rfile.readline().strip(), 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return len(self.rfile.read(length)) if length else 0
+
+    def _stream(self, messages: List[Dict]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in messages:
+            data = json.dumps(message).encode() + b"\r\n"
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send(self, status: int, message: Dict = None) -> None:
+        body = json.dumps(message).encode() if message else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_POST(self):
+        docker = self.server.engine.docker
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.engine.requests += 1
+
+        if self.BUILD_PATH.match(url.path):
+            size = self._read_body()
+            tag = query["t"]
+            image_id = docker.build(tag, json.loads(query.get("labels", "{}")), query.get("platform"))
+            self._stream([
+                {"stream": "Step 1/2 : FROM scratch\n"},
+                {"stream": " ---> Using cache\n"},
+                {"stream": "Step 2/2 : COPY . /src\n"},
+                {"stream": " ---> Running in 0123456789ab\n"},
+                {"stream": "Context: %d bytes\n" % size},
+                {"aux": {"ID": image_id}},
+                {"stream": "Successfully tagged %s\n" % tag},
+            ])
+            return
+
+        m = self.TAG_PATH.match(url.path)
+        if m:
+            self._read_body()
+            docker.tag(unquote(m.group(1)), "{}:{}".format(query["repo"], query["tag"]))
+            self._send(201)
+            return
+
+        m = self.PUSH_PATH.match(url.path)
+        if m:
+            self._read_body()
+            if not self.headers.get("X-Registry-Auth"):
+                self._send(400, {"message": "missing X-Registry-Auth"})
+                return
+            tag, digest, size = docker.push("{}:{}".format(unquote(m.group(1)), query["tag"]))
+            self._stream([
+                {"status": "The push refers to repository [docker.io/%s]" % m.group(1)},
+                {"status": "Preparing", "id": "0123456789ab"},
+                {"status": "Pushing", "id": "0123456789ab", "progressDetail": {"current": 1, "total": 2}},
+                {"status": "Pushing", "id": "0123456789ab", "progressDetail": {"current": 2, "total": 2}},
+                {"status": "Pushed", "id": "0123456789ab"},
+                {"status": "%s: digest: %s size: %d" % (tag, digest, size)},
+                {"aux": {"Tag": tag, "Digest": digest, "Size": size}},
+            ])
+            return
+
+        self._send(404, {"message": "page not found"})
+
+    def do_GET(self):
+        docker = self.server.engine.docker
+        url = urlsplit(self.path)
+        self.server.engine.requests += 1
+
+        m = self.INSPECT_PATH.match(url.path)
+        if m:
+            try:
+                self._send(200, docker.inspect(unquote(m.group(1))))
+            except FileNotFoundError:
+                self._send(404, {"message": "No such image: " + unquote(m.group(1))})
+            return
+
+        self._send(404, {"message": "page not found"})
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    engine: FakeEngine
+
+
+class FakeEngine:
+    """Docker Engine API stand-in on a Unix socket for the engine backend. It
+    answers /build, /images/{name}/tag, /images/{name}/push and
+    /images/{name}/json with the JSON
+    messages of a real daemon, on top of the same state as the docker shim.
+    """
+
+    def __init__(self, socket_path: str, docker: Docker):
+        self.logger = logging.getLogger("benchmark.FakeEngine")
+        self.socket_path = socket_path
+        self.docker = docker
+        self.requests = 0
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._server = _Server(socket_path, _Handler)
+        self._server.engine = self
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> FakeEngine:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-engine", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        os.remove(self.socket_path)
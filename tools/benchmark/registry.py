@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _Server
+
+    MANIFEST_PATH = re.compile(r"^/v2/(.+)/manifests/([^/]+)$")
+    BLOB_PATH = re.compile(r"^/v2/(.+)/blobs/(sha256:[0-9a-f]{64})$")
+    UPLOAD_PATH = re.compile(r"^/v2/(.+)/blobs/uploads/([^/]*)$")
+
+    def log_message(self, format, *args):
+        self.server.registry.logger.debug(format, *args)
+
+    def _send(self, status: int, body: bytes = b"", headers: Dict[str, str] = None, head: bool = False) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _handle(self, method: str) -> None:
+        registry = self.server.registry
+        registry.requests += 1
+        if registry.latency:
+            time.sleep(registry.latency)
+
+        url = urlsplit(self.path)
+        path = url.path
+
+        if path == "/token":
+            scope = parse_qs(url.query).get("scope", [""])[0]
+            if "push" in scope.rpartition(":")[2] and not self.headers.get("Authorization", "").startswith("Basic "):
+                self._send(401)
+                return
+            body = json.dumps({
+                "token": uuid.uuid4().hex,
+                "expires_in": 300,
+                "issued_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            }).encode()
+            self._send(200, body, {"Content-Type": "application/json"})
+            return
+
+        if path == "/v2/":
+            self._send(200, b"{}", {"Content-Type": "application/json"})
+            return
+
+        m = self.MANIFEST_PATH.match(path)
+        if m:
+            repo, ref = m.groups()
+            if method in ("GET", "HEAD"):
+                manifest = registry.get_manifest(repo, ref)
+                if not manifest:
+                    self._send(404, head=method == "HEAD")
+                    return
+                digest, media_type, data = manifest
+                self._send(200, data, {
+                    "Content-Type": media_type,
+                    "Docker-Content-Digest": digest,
+                }, head=method == "HEAD")
+            elif method == "PUT":
+                data = self._read_body()
+                digest = registry.put_manifest(repo, ref, self.headers.get("Content-Type"), data,
+                                               self.headers.get("If-Match", "").strip('"') or None)
+                if not digest:
+                    self._send(412)
+                    return
+                self._send(201, headers={"Docker-Content-Digest": digest, "Location": path})
+            else:
+                self._send(405)
+            return
+
+        m = self.BLOB_PATH.match(path)
+        if m:
+            repo, digest = m.groups()
+            data = registry.blobs.get(digest)
+            if data is None:
+                self._send(404, head=method == "HEAD")
+            else:
+                self._send(200, data, {"Docker-Content-Digest": digest}, head=method == "HEAD")
+            return
+
+        m = self.UPLOAD_PATH.match(path)
+        if m:
+            repo, upload_id = m.groups()
+            if method == "POST":
+                mount = parse_qs(url.query).get("mount", [""])[0]
+                if mount in registry.blobs:
+                    # blobs aren't kept per repository, so every mount succeeds
+                    self._send(201, headers={"Docker-Content-Digest": mount,
+                                             "Location": "/v2/{}/blobs/{}".format(repo, mount)})
+                    return
+                location = "/v2/{}/blobs/uploads/{}".format(repo, uuid.uuid4().hex)
+                self._send(202, headers={"Location": location})
+            elif method == "PUT":
+                digest = parse_qs(url.query).get("digest", [""])[0]
+                data = self._read_body()
+                if digest != "sha256:" + hashlib.sha256(data).hexdigest():
+                    self._send(400)
+                    return
+                registry.blobs[digest] = data
+                self._send(201, headers={"Docker-Content-Digest": digest})
+            else:
+                self._send(405)
+            return
+
+        self._send(404, head=method == "HEAD")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    registry: FakeRegistry
+
+
+class FakeRegistry:
+    """An in-memory Docker registry (HTTP API v2) with just enough of the
+    token, manifest, blob and monolithic upload endpoints for the toolkit and
+    the docker shim. Every request waits `latency` seconds to stand in for the
+    round trip to Docker Hub.
+    """
+
+    def __init__(self, latency: float = 0, host: str = "127.0.0.1", port: int = 0):
+        self.logger = logging.getLogger("benchmark.FakeRegistry")
+        self.latency = latency
+        self.requests = 0
+        self.blobs: Dict[str, bytes] = {}
+        # repo -> tag or digest -> digest
+        self.tags: Dict[str, Dict[str, str]] = {}
+        # digest -> (media type, data)
+        self.manifests: Dict[str, Tuple[str, bytes]] = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.registry = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def get_manifest(self, repo: str, ref: str) -> Optional[Tuple[str, str, bytes]]:
+        with self._lock:
+            digest = ref if ref.startswith("sha256:") else self.tags.get(repo, {}).get(ref)
+            if not digest or digest not in self.manifests:
+                return None
+            media_type, data = self.manifests[digest]
+            return digest, media_type, data
+
+    def put_manifest(self, repo: str, ref: str, media_type: str, data: bytes, if_match: str = None) -> Optional[str]:
+        """Returns the digest of the manifest, or None if the tag doesn't
+        point to if_match (anymore).
+        """
+        digest = "sha256:" + hashlib.sha256(data).hexdigest()
+        if not media_type:
+            media_type = json.loads(data.decode())["mediaType"]
+        with self._lock:
+            if if_match and self.tags.get(repo, {}).get(ref) != if_match:
+                return None
+            self.manifests[digest] = (media_type, data)
+            if not ref.startswith("sha256:"):
+                self.tags.setdefault(repo, {})[ref] = digest
+        return digest
+
+    def clear(self) -> None:
+        with self._lock:
+            self.blobs.clear()
+            self.tags.clear()
+            self.manifests.clear()
+            self.requests = 0
+
+    def start(self) -> FakeRegistry:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-registry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
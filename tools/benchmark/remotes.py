@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict
+from urllib.parse import urlsplit
+
+from core.utils import execute
+
+GIT = "git -c user.name=benchmark -c user.email=benchmark@localhost -c init.defaultBranch=master"
+
+
+class LocalRemotes:
+    """Bare repositories which stand in for the upstream repositories of the
+    images. git is pointed at them with url.<base>.insteadOf (through the
+    GIT_CONFIG_* environment variables), so the toolkit keeps using the
+    https URLs of src.py and nothing else has to know.
+    """
+
+    def __init__(self, root: str, files: int = 16, file_size: int = 4096):
+        self._logger = logging.getLogger("benchmark.LocalRemotes")
+        self.root = root
+        self.files = files
+        self.file_size = file_size
+
+    def get_path(self, repo_url: str) -> str:
+        parts = urlsplit(repo_url)
+        return os.path.join(self.root, parts.netloc, parts.path.strip("/"))
+
+    def _write_files(self, work_tree: str, seed: str) -> None:
+        for i in range(self.files):
+            h = hashlib.sha256("{}/{}".format(seed, i).encode()).hexdigest()
+            data = (h * (self.file_size // len(h) + 1))[:self.file_size]
+            with open(os.path.join(work_tree, "file{}.txt".format(i)), "w") as f:
+                f.write(data)
+
+    def add(self, repo_url: str, ref: str) -> None:
+        """Creates the repository if needed and a commit for the ref: a branch
+        for master and main, a tag otherwise.
+        """
+        git_dir = self.get_path(repo_url)
+        if not os.path.exists(os.path.join(git_dir, "HEAD")):
+            os.makedirs(git_dir, exist_ok=True)
+            execute(f"{GIT} -C {git_dir} init -q --bare")
+
+        if ref in ("master", "main"):
+            target = "refs/heads/" + ref
+        else:
+            target = "refs/tags/" + ref
+
+        work_tree = tempfile.mkdtemp(prefix="remote-")
+        try:
+            execute(f"{GIT} -C {work_tree} init -q")
+            self._write_files(work_tree, repo_url + "#" + ref)
+            execute(f"{GIT} -C {work_tree} add -A")
+            execute(f"{GIT} -C {work_tree} commit -q -m {ref}")
+            execute(f"{GIT} -C {work_tree} push -q -f {git_dir} HEAD:{target}")
+        finally:
+            shutil.rmtree(work_tree)
+        self._logger.debug("Created %s in %s", target, git_dir)
+
+    def get_git_env(self) -> Dict[str, str]:
+        return {
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": "url.file://{}/.insteadOf".format(self.root),
+            "GIT_CONFIG_VALUE_0": "https://",
+        }
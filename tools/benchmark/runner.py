@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import importlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from subprocess import Popen, STDOUT, DEVNULL
+from typing import Dict, List, Optional
+
+from core.docker import Platforms
+from core.src import SourceManager
+from core.utils import execute
+from .engine import FakeEngine
+from .registry import FakeRegistry
+from .remotes import LocalRemotes, GIT
+from .shim import Docker
+
+# phases shown in the report, in the order they happen
+PHASES = [
+    "resolve refs",
+    "prepare",
+    "fetch",
+    "checkout",
+    "inputs",
+    "manifest lookup",
+    "context upload",
+    "docker build",
+    "docker push",
+    "manifest push",
+]
+
+
+@dataclass
+class Result:
+    scenario: str
+    backend: str
+    images: int
+    platforms: int
+    jobs: int
+    duration: float
+    registry_requests: int
+    # phase -> total seconds (summed over all jobs)
+    phases: Dict[str, float] = field(default_factory=dict)
+    multi_platform: bool = False
+    # PLATFORM=BUILDER, see core.builders
+    builders: List[str] = field(default_factory=list)
+
+
+class Benchmark:
+    """Runs tools/build and tools/push end to end without Docker Hub, GitHub
+    or a docker daemon: a copy of the project is built against a FakeRegistry,
+    LocalRemotes and the docker shim in bin/, which only sleeps for the
+    configured build and push times. What is left is the overhead of the
+    toolkit itself.
+    """
+
+    def __init__(self,
+                 project_dir: str,
+                 work_dir: str = None,
+                 platforms: List[str] = None,
+                 jobs: int = 1,
+                 build_seconds: float = 0.5,
+                 push_seconds: float = 0.2,
+                 registry_latency: float = 0.02,
+                 backend: str = "cli",
+                 multi_platform: bool = False,
+                 builders: List[str] = None,
+                 emulation: float = 1.0,
+                 ):
+        self._logger = logging.getLogger("benchmark.Benchmark")
+        self.project_dir = project_dir
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="xud-docker-bench-")
+        self.platforms = platforms or ["linux/amd64", "linux/arm64"]
+        self.jobs = jobs
+        self.build_seconds = build_seconds
+        self.push_seconds = push_seconds
+        self.registry = FakeRegistry(latency=registry_latency)
+        self.backend = backend
+        self.multi_platform = multi_platform
+        self.builders = builders or []
+        self.emulation = emulation
+        self.engine: Optional[FakeEngine] = None
+        self.remotes = LocalRemotes(os.path.join(self.work_dir, "remotes"))
+        self.results: List[Result] = []
+
+    @property
+    def copy_dir(self) -> str:
+        return os.path.join(self.work_dir, "project")
+
+    @property
+    def cache_dir(self) -> str:
+        return os.path.join(self.work_dir, "cache")
+
+    @property
+    def state_dir(self) -> str:
+        return os.path.join(self.work_dir, "docker")
+
+    @property
+    def log_dir(self) -> str:
+        return os.path.join(self.work_dir, "logs")
+
+    def _copy_project(self) -> None:
+        if os.path.exists(self.copy_dir):
+            shutil.rmtree(self.copy_dir)
+        ignore = shutil.ignore_patterns(".src*", "__pycache__", "*.pyc", "logs", "tools.log")
+        for folder in ["images", "tools"]:
+            shutil.copytree(os.path.join(self.project_dir, folder), os.path.join(self.copy_dir, folder), ignore=ignore)
+        execute(f"{GIT} -C {self.copy_dir} init -q")
+        execute(f"{GIT} -C {self.copy_dir} add -A")
+        execute(f"{GIT} -C {self.copy_dir} commit -q -m benchmark")
+
+    def _create_remotes(self, images: List[str]) -> None:
+        for image in images:
+            name, _, tag = image.partition(":")
+            m = importlib.import_module(f"images.{name}.src")
+            if hasattr(m, "SourceManager"):
+                source_manager = m.SourceManager()
+            else:
+                source_manager = SourceManager(m.REPO_URL, os.path.join(self.project_dir, "images", name))
+            for repo_url, ref in source_manager.get_refs(tag or "latest"):
+                self.remotes.add(repo_url, ref)
+
+    def setup(self, images: List[str]) -> None:
+        print("Work directory: %s" % self.work_dir, flush=True)
+        self._copy_project()
+        self._create_remotes(images)
+        self.registry.start()
+        if self.backend == "engine":
+            docker = Docker(self.state_dir, self.registry.url, self.build_seconds, self.push_seconds, "local",
+                            self._get_nodes(), self.emulation)
+            self.engine = FakeEngine(os.path.join(self.work_dir, "docker.sock"), docker).start()
+
+    def teardown(self) -> None:
+        self.registry.stop()
+        if self.engine:
+            self.engine.stop()
+
+    def reset(self, sources: bool = True, registry: bool = True) -> None:
+        if sources:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            images_dir = os.path.join(self.copy_dir, "images")
+            for name in os.listdir(images_dir):
+                folder = os.path.join(images_dir, name)
+                if not os.path.isdir(folder):
+                    continue
+                for d in os.listdir(folder):
+                    if d.startswith(".src"):
+                        shutil.rmtree(os.path.join(folder, d))
+        if registry:
+            self.registry.clear()
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def _get_env(self) -> Dict[str, str]:
+        env = {key: value for key, value in os.environ.items()
+               if not key.startswith(("GITHUB_", "TRAVIS_", "GIT_CONFIG_"))}
+        env.update(self.remotes.get_git_env())
+        env.update({
+            "PATH": os.path.join(os.path.dirname(__file__), "bin") + os.pathsep + env.get("PATH", ""),
+            "XUD_DOCKER_CACHE_DIR": self.cache_dir,
+            "XUD_DOCKER_METRICS_DB": os.path.join(self.work_dir, "metrics.db"),
+            "XUD_DOCKER_LOG_DIR": self.log_dir,
+            "XUD_DOCKER_REGISTRY_URL": self.registry.url,
+            "XUD_DOCKER_TOKEN_URL": self.registry.url + "/token",
+            # no ref is found there, so refs are resolved with git ls-remote
+            "XUD_DOCKER_GITHUB_API_URL": self.registry.url,
+            "XUD_DOCKER_BENCH_STATE": self.state_dir,
+            "XUD_DOCKER_BENCH_BUILD_SECONDS": str(self.build_seconds),
+            "XUD_DOCKER_BENCH_PUSH_SECONDS": str(self.push_seconds),
+            "XUD_DOCKER_BENCH_NODES": json.dumps(self._get_nodes()),
+            "XUD_DOCKER_BENCH_EMULATION": str(self.emulation),
+            "XUD_DOCKER_BACKEND": self.backend,
+            # only this run writes to the fake registry, one quick recheck of
+            # every manifest list update is enough
+            "XUD_DOCKER_MANIFEST_LIST_SETTLE": "0.1",
+            # any credentials do for the fake registry
+            "XUD_DOCKER_USERNAME": "benchmark",
+            "XUD_DOCKER_PASSWORD": "benchmark",
+        })
+        if self.engine:
+            env["DOCKER_HOST"] = "unix://" + self.engine.socket_path
+        return env
+
+    def _get_nodes(self) -> Dict[str, List[str]]:
+        """Returns the builders of the shim: the local daemon builds the
+        platform of this machine, every configured builder its platforms.
+        """
+        nodes = {"local": [str(Platforms.get_current())]}
+        for item in self.builders:
+            platform, _, spec = item.partition("=")
+            nodes.setdefault(spec, []).append(platform)
+        return nodes
+
+    def run(self, scenario: str, command: str, images: List[str]) -> Result:
+        helper = os.path.join(self.copy_dir, "tools", "helper.py")
+        args = [sys.executable, helper, command, "-j", str(self.jobs)]
+        if command == "push" and self.multi_platform:
+            args.append("--multi-platform")
+        for p in self.platforms:
+            args.extend(["-p", p])
+        if command in ("build", "push"):
+            for builder in self.builders:
+                args.extend(["--builder", builder])
+        args.extend(images)
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        output_file = os.path.join(self.log_dir, "{}-{}-{}.out".format(command, len(images), len(self.results)))
+        requests = self.registry.requests
+        start = time.perf_counter()
+        with open(output_file, "w") as f:
+            p = Popen(args, stdout=f, stderr=STDOUT, env=self._get_env(), cwd=self.copy_dir)
+            exit_code = p.wait()
+        duration = time.perf_counter() - start
+        if exit_code != 0:
+            with open(output_file) as f:
+                print(f.read()[-4096:], file=sys.stderr)
+            raise RuntimeError("{} failed (exit_code={}), see {}".format(scenario, exit_code, output_file))
+
+        phases = {}
+        with open(os.path.join(self.log_dir, "%s-summary.json" % command)) as f:
+            for name, phase in json.load(f)["phases"].items():
+                phases[name] = phase["total"]
+
+        result = Result(scenario, self.backend, len(images), len(self.platforms), self.jobs, round(duration, 3),
+                        self.registry.requests - requests, phases, self.multi_platform, self.builders)
+        self.results.append(result)
+        self._print_result(result)
+        return result
+
+    def run_startup(self, image: str, repeat: int = 5) -> None:
+        """Measures how long the toolkit takes to start, as the median of
+        repeat runs: helper.py --help, and refs of one image (which creates
+        the Toolkit and a Context, reads the git metadata and resolves one
+        cached ref).
+        """
+        helper = os.path.join(self.copy_dir, "tools", "helper.py")
+        for scenario, args, images in [("startup (--help)", ["--help"], 0), ("startup (refs)", ["refs", image], 1)]:
+            durations = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                exit_code = Popen([sys.executable, helper] + args, stdout=DEVNULL, stderr=STDOUT,
+                                  env=self._get_env(), cwd=self.copy_dir).wait()
+                durations.append(time.perf_counter() - start)
+                if exit_code != 0:
+                    raise RuntimeError("{} failed (exit_code={})".format(scenario, exit_code))
+            result = Result(scenario, self.backend, images, 0, 1, round(statistics.median(durations), 3), 0,
+                            multi_platform=self.multi_platform)
+            self.results.append(result)
+            self._print_result(result)
+
+    def run_matrix(self, images: List[str], size: int) -> None:
+        selected = images[:size]
+        self.reset()
+        self.run("build (cold)", "build", selected)
+        self.reset(sources=False)
+        self.run("push (empty registry)", "push", selected)
+        self.run("push (up to date)", "push", selected)
+
+    def _print_result(self, result: Result) -> None:
+        backend = result.backend + ("/multi" if result.multi_platform else "")
+        print("%-24s %-12s %3d images x %d platforms, %d jobs: %7.2fs, %4d registry requests" % (
+            result.scenario, backend, result.images, result.platforms, result.jobs, result.duration,
+            result.registry_requests), flush=True)
+        phases = ["%s %.2fs" % (name, result.phases[name]) for name in PHASES if name in result.phases]
+        if phases:
+            print("    " + ", ".join(phases), flush=True)
+        if result.builders and result.platforms:
+            print("    builders: " + ", ".join(result.builders), flush=True)
+
+    def write(self, output: Optional[str]) -> None:
+        if not output:
+            return
+        with open(output, "w") as f:
+            json.dump([asdict(result) for result in self.results], f, indent=2)
+        print("Results: %s" % output, flush=True)
@@ -0,0 +1,286 @@
+"""A stand-in for the docker CLI and daemon of the benchmark. Builds and
+pushes only sleep for the configured time; images are recorded as JSON files
+in the state directory and pushed to the fake registry.
+
+Every daemon (the local one, a docker context or a DOCKER_HOST) has images of
+its own, so pushing an image from another daemon than the one which built it
+fails. Builders (daemons and buildx builders, named like in core.builders)
+build their native platforms in the build time and the others `emulation`
+times slower.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from urllib.request import Request, urlopen
+
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64", "x86": "386"}
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+
+
+class Docker:
+    def __init__(self, state_dir, registry_url, build_seconds=0.5, push_seconds=0.2, daemon="local", nodes=None,
+                 emulation=1.0):
+        self.state_dir = state_dir
+        self.registry_url = registry_url
+        self.build_seconds = build_seconds
+        self.push_seconds = push_seconds
+        self.daemon = daemon
+        # builder -> native platforms, a builder which isn't there has all
+        self.nodes = nodes or {}
+        self.emulation = emulation
+
+    @classmethod
+    def from_env(cls, daemon="local"):
+        return cls(os.environ["XUD_DOCKER_BENCH_STATE"],
+                   os.environ["XUD_DOCKER_REGISTRY_URL"],
+                   float(os.environ.get("XUD_DOCKER_BENCH_BUILD_SECONDS", "0.5")),
+                   float(os.environ.get("XUD_DOCKER_BENCH_PUSH_SECONDS", "0.2")),
+                   daemon,
+                   json.loads(os.environ.get("XUD_DOCKER_BENCH_NODES") or "{}"),
+                   float(os.environ.get("XUD_DOCKER_BENCH_EMULATION", "1")))
+
+    def _state_file(self, kind, name):
+        daemon = self.daemon.replace("/", "_").replace(":", "@")
+        return os.path.join(self.state_dir, kind, daemon, name.replace("/", "_").replace(":", "@") + ".json")
+
+    def _build_seconds(self, node, platforms):
+        if node in self.nodes and any(p not in self.nodes[node] for p in platforms):
+            return self.build_seconds * self.emulation
+        return self.build_seconds
+
+    def get_native(self, node):
+        """Returns the native platforms of a daemon or buildx builder, or None
+        if there is no such one.
+        """
+        if node == "local":
+            return self.nodes.get(node, ["linux/amd64"])
+        return self.nodes.get(node)
+
+    def _save(self, kind, name, data):
+        path = self._state_file(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def _load(self, kind, name):
+        with open(self._state_file(kind, name)) as f:
+            return json.load(f)
+
+    def _registry(self, method, path, data=None, headers=None):
+        r = urlopen(Request(self.registry_url + path, data=data, method=method, headers=headers or {}))
+        return r.headers, r.read()
+
+    def _upload_blob(self, repo, data):
+        digest = "sha256:" + hashlib.sha256(data).hexdigest()
+        headers, _ = self._registry("POST", "/v2/{}/blobs/uploads/".format(repo))
+        self._registry("PUT", "{}?digest={}".format(headers["Location"], digest), data)
+        return digest
+
+    def build(self, tag, labels, platform=None, builder=None):
+        """Records the image and returns its ID."""
+        if not platform:
+            suffix = tag.rsplit("__", 1)[-1]
+            platform = "linux/" + ARCHITECTURES.get(suffix, "amd64")
+        time.sleep(self._build_seconds(builder or self.daemon, [platform]))
+        os_, architecture = platform.split("/")[:2]
+        image = {"os": os_, "architecture": architecture, "labels": labels}
+        self._save("images", tag, image)
+        return "sha256:" + hashlib.sha256(json.dumps(image, sort_keys=True).encode()).hexdigest()
+
+    def inspect(self, name):
+        image = self._load("images", name)
+        data = json.dumps(image, sort_keys=True).encode()
+        return {"Id": "sha256:" + hashlib.sha256(data).hexdigest(), "Size": len(data)}
+
+    def tag(self, source, target):
+        self._save("images", target, self._load("images", source))
+
+    def push(self, name):
+        """Pushes the image and returns (tag, digest, size) of its manifest."""
+        image = self._load("images", name)
+        repo, ref = name.split(":")
+        time.sleep(self.push_seconds)
+        digest, size = self._push_image(repo, ref, image)
+        return ref, digest, size
+
+    def _push_image(self, repo, ref, image):
+        """Puts the config and manifest of the image, at its digest if ref is
+        None, and returns (digest, size) of the manifest.
+        """
+        config = json.dumps({
+            "os": image["os"],
+            "architecture": image["architecture"],
+            "config": {"Labels": image["labels"]},
+        }).encode()
+        config_digest = self._upload_blob(repo, config)
+        manifest = json.dumps({
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_V2,
+            "config": {
+                "mediaType": "application/vnd.docker.container.image.v1+json",
+                "size": len(config),
+                "digest": config_digest,
+            },
+            "layers": [],
+        }).encode()
+        ref = ref or "sha256:" + hashlib.sha256(manifest).hexdigest()
+        headers, _ = self._registry("PUT", "/v2/{}/manifests/{}".format(repo, ref), manifest,
+                                    {"Content-Type": MANIFEST_V2})
+        return headers["Docker-Content-Digest"], len(manifest)
+
+    def build_push(self, tag, labels, platforms, builder=None):
+        """buildx build --push of several platforms: they are built side by
+        side and pushed by digest, then an OCI index with the provenance
+        attestation of every platform image is put at tag, like buildx 0.10
+        and later do. Returns the digest of the index.
+        """
+        time.sleep(self._build_seconds(builder or self.daemon, platforms))
+        repo, ref = tag.split(":")
+        time.sleep(self.push_seconds)
+        digests = []
+        for platform in platforms:
+            os_, architecture = platform.split("/")[:2]
+            image = {"os": os_, "architecture": architecture, "labels": labels}
+            digest, _ = self._push_image(repo, None, image)
+            digests.append("{}@{}".format(repo, digest))
+        manifests = self._get_entries(digests)
+        for entry in list(manifests):
+            attestation = json.dumps({
+                "schemaVersion": 2,
+                "mediaType": OCI_MANIFEST,
+                "config": {"mediaType": "application/vnd.oci.image.config.v1+json", "size": 2,
+                           "digest": self._upload_blob(repo, b"{}")},
+                "layers": [],
+            }).encode()
+            digest = "sha256:" + hashlib.sha256(attestation).hexdigest()
+            self._registry("PUT", "/v2/{}/manifests/{}".format(repo, digest), attestation,
+                           {"Content-Type": OCI_MANIFEST})
+            manifests.append({
+                "mediaType": OCI_MANIFEST,
+                "size": len(attestation),
+                "digest": digest,
+                "platform": {"architecture": "unknown", "os": "unknown"},
+                "annotations": {"vnd.docker.reference.digest": entry["digest"],
+                                "vnd.docker.reference.type": "attestation-manifest"},
+            })
+        index = json.dumps({"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": manifests}).encode()
+        headers, _ = self._registry("PUT", "/v2/{}/manifests/{}".format(repo, ref), index,
+                                    {"Content-Type": OCI_INDEX})
+        return headers["Docker-Content-Digest"]
+
+    def manifest_create(self, name, refs):
+        self._save("manifests", name, {"refs": refs})
+
+    def manifest_push(self, name):
+        repo, ref = name.split(":")
+        return self._put_manifest_list(repo, ref, self._load("manifests", name)["refs"])
+
+    def _get_entries(self, refs):
+        manifests = []
+        for r in refs:
+            r_repo, digest = r.split("@")
+            _, data = self._registry("GET", "/v2/{}/manifests/{}".format(r_repo, digest))
+            _, config = self._registry("GET", "/v2/{}/blobs/{}".format(r_repo, json.loads(data)["config"]["digest"]))
+            config = json.loads(config)
+            manifests.append({
+                "mediaType": MANIFEST_V2,
+                "size": len(data),
+                "digest": digest,
+                "platform": {"architecture": config["architecture"], "os": config["os"]},
+            })
+        return manifests
+
+    def _put_manifest_list(self, repo, ref, refs):
+        manifests = self._get_entries(refs)
+        manifest_list = json.dumps({"schemaVersion": 2, "mediaType": MANIFEST_LIST_V2,
+                                    "manifests": manifests}).encode()
+        headers, _ = self._registry("PUT", "/v2/{}/manifests/{}".format(repo, ref), manifest_list,
+                                    {"Content-Type": MANIFEST_LIST_V2})
+        return headers["Docker-Content-Digest"]
+
+
+def _parse_build_args(args):
+    tag = None
+    labels = {}
+    platform = None
+    push = False
+    builder = None
+    i = 0
+    while i < len(args):
+        if args[i] == "--builder":
+            builder = "buildx:" + args[i + 1]
+            i += 1
+        elif args[i] == "-t":
+            tag = args[i + 1]
+            i += 1
+        elif args[i] == "--label":
+            key, _, value = args[i + 1].partition("=")
+            labels[key] = value
+            i += 1
+        elif args[i] == "--platform":
+            platform = args[i + 1]
+            i += 1
+        elif args[i] == "--push":
+            push = True
+        i += 1
+    return tag, labels, platform, push, builder
+
+
+def main(argv):
+    """The docker CLI: build, buildx build, buildx inspect, tag, image inspect,
+    push, manifest create/push and version, with --context or --host.
+    """
+    daemon = "local"
+    while argv[:1] in (["--context"], ["--host"], ["-H"]):
+        daemon = ("context:" if argv[0] == "--context" else "") + argv[1]
+        argv = argv[2:]
+    docker = Docker.from_env(daemon)
+    if docker.get_native(daemon) is None:
+        print("Cannot connect to the Docker daemon at %s. Is the docker daemon running?" % daemon, file=sys.stderr)
+        return 1
+
+    if argv[:1] == ["build"] or argv[:2] == ["buildx", "build"]:
+        tag, labels, platform, push, builder = _parse_build_args(argv[1:] if argv[0] == "build" else argv[2:])
+        # the context comes from stdin like with a real daemon
+        size = 0
+        while True:
+            chunk = sys.stdin.buffer.read(1 << 16)
+            if not chunk:
+                break
+            size += len(chunk)
+        print("Sending build context to Docker daemon  %.1fkB" % (size / 1024))
+        if push:
+            print("exporting manifest list %s" % docker.build_push(tag, labels, platform.split(","), builder))
+        else:
+            docker.build(tag, labels, platform, builder)
+            print("Successfully tagged %s" % tag)
+    elif argv[:2] == ["buildx", "inspect"]:
+        name = argv[-1]
+        if docker.get_native("buildx:" + name) is None:
+            print("ERROR: no builder %r found" % name, file=sys.stderr)
+            return 1
+        print("Name: %s" % name)
+    elif argv[:1] == ["version"]:
+        # only --format {{.Server.Arch}}
+        print(docker.get_native(daemon)[0].split("/")[1])
+    elif argv[:1] == ["tag"]:
+        docker.tag(argv[1], argv[2])
+    elif argv[:2] == ["image", "inspect"]:
+        # only --format {{.Size}}
+        print(docker.inspect(argv[-1])["Size"])
+    elif argv[:1] == ["push"]:
+        print("%s: digest: %s size: %d" % docker.push(argv[1]))
+    elif argv[:2] == ["manifest", "create"]:
+        docker.manifest_create(argv[2], argv[3:])
+    elif argv[:2] == ["manifest", "push"]:
+        print(docker.manifest_push([arg for arg in argv[2:] if not arg.startswith("-")][0]))
+    else:
+        print("docker (benchmark shim): unsupported command: " + " ".join(argv), file=sys.stderr)
+        return 1
+    return 0
@@ -1,8 +1,12 @@
 from .toolkit import Toolkit
 import logging
+import logging.handlers
 import os
 
 logfile = os.path.join(os.path.dirname(os.path.dirname(__file__)), "tools.log")
-FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+FORMAT = "%(asctime)s %(process)d [%(levelname)s] %(message)s"
 
-logging.basicConfig(filename=logfile, level=logging.DEBUG, format=FORMAT, filemode="w")
+# runs append to the log (the process ID tells them apart), it is rotated
+# instead of truncated so the log of a failed run outlives the next one
+handler = logging.handlers.RotatingFileHandler(logfile, maxBytes=10 * 1024 * 1024, backupCount=3)
+logging.basicConfig(handlers=[handler], level=logging.DEBUG, format=FORMAT)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import fnmatch
+import logging
+import os
+import tarfile
+from subprocess import Popen, PIPE, CalledProcessError
+from typing import BinaryIO, List, Optional
+
+
+class _CountingWriter:
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self._f.write(data)
+        self.size += len(data)
+        return len(data)
+
+
+class BuildContext:
+    """Streams a docker build context as a tar archive: the files of the image
+    folder, the shared files and the source worktrees (as .src) exported with
+    git archive. Nothing is copied into the image folder and no .git history
+    is sent to the daemon.
+    """
+
+    # files in the image folder which are inputs of the toolkit and not of the image
+    EXCLUDES = ["src.py", "__pycache__", "*.pyc"]
+
+    def __init__(self, image_folder: str, shared_dir: Optional[str], src_dir: str, worktrees: List[str]):
+        self._logger = logging.getLogger("core.BuildContext")
+        self.image_folder = image_folder
+        self.shared_dir = shared_dir
+        self.src_dir = src_dir
+        self.worktrees = worktrees
+        self.size = 0
+
+    def _get_ignore_patterns(self) -> List[str]:
+        patterns = list(self.EXCLUDES)
+        dockerignore = os.path.join(self.image_folder, ".dockerignore")
+        if os.path.exists(dockerignore):
+            with open(dockerignore) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        patterns.append(line.rstrip("/"))
+        return patterns
+
+    def _is_ignored(self, path: str, patterns: List[str]) -> bool:
+        parts = path.split("/")
+        for pattern in patterns:
+            # a pattern also excludes everything below a matching directory
+            for i in range(1, len(parts) + 1):
+                if fnmatch.fnmatch("/".join(parts[:i]), pattern) or fnmatch.fnmatch(parts[i - 1], pattern):
+                    return True
+        return False
+
+    def _reset(self, info: tarfile.TarInfo) -> tarfile.TarInfo:
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    def _add_dir(self, tar: tarfile.TarFile, path: str, arcname: str, patterns: List[str]) -> None:
+        for root, dirs, files in os.walk(path):
+            rel_root = os.path.relpath(root, path)
+            kept = []
+            for d in sorted(dirs):
+                rel = os.path.normpath(os.path.join(rel_root, d))
+                if d.startswith(".src") and rel_root == "." and path == self.image_folder:
+                    continue
+                if d == ".git" or self._is_ignored(rel, patterns):
+                    continue
+                kept.append(d)
+                tar.add(os.path.join(root, d), arcname=os.path.normpath(os.path.join(arcname, rel)), recursive=False,
+                        filter=self._reset)
+            dirs[:] = kept
+            for f in sorted(files):
+                rel = os.path.normpath(os.path.join(rel_root, f))
+                if f == ".git" or self._is_ignored(rel, patterns):
+                    continue
+                tar.add(os.path.join(root, f), arcname=os.path.normpath(os.path.join(arcname, rel)),
+                        filter=self._reset)
+
+    def _add_worktree(self, tar: tarfile.TarFile, worktree: str, arcname: str) -> None:
+        cmd = ["git", "-C", worktree, "archive", "--format=tar", "HEAD"]
+        p = Popen(cmd, stdout=PIPE)
+        with tarfile.open(fileobj=p.stdout, mode="r|") as archive:
+            for info in archive:
+                # skip the pax header git archive adds for the commit id
+                if info.type == tarfile.XGLTYPE:
+                    continue
+                info.name = os.path.join(arcname, info.name)
+                if info.isreg():
+                    tar.addfile(self._reset(info), archive.extractfile(info))
+                else:
+                    tar.addfile(self._reset(info))
+        if p.wait() != 0:
+            raise CalledProcessError(p.returncode, " ".join(cmd))
+
+    def write(self, f: BinaryIO) -> int:
+        out = _CountingWriter(f)
+        patterns = self._get_ignore_patterns()
+        with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            self._add_dir(tar, self.image_folder, ".", patterns)
+            if self.shared_dir and os.path.exists(self.shared_dir):
+                self._add_dir(tar, self.shared_dir, ".", [])
+            for worktree in self.worktrees:
+                arcname = os.path.normpath(".src/" + os.path.relpath(worktree, self.src_dir))
+                if os.path.exists(os.path.join(worktree, ".git")):
+                    self._add_worktree(tar, worktree, arcname)
+                else:
+                    self._add_dir(tar, worktree, arcname, [])
+        self.size = out.size
+        self._logger.debug("Sent %d bytes of build context for %s", self.size, self.image_folder)
+        return self.size
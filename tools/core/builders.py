@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+from subprocess import CalledProcessError
+from typing import Dict, List, Optional
+
+from .docker import Platform, Platforms
+from .engine import DockerEngineClient
+from .utils import execute
+
+
+class Builder:
+    """Where the images of a platform are built, given as
+
+    - local: the local daemon (docker build for its own platform, buildx
+      with QEMU emulation for the others)
+    - buildx:NAME: a buildx builder, e.g. one with a native node per platform
+      (docker buildx create --append)
+    - context:NAME: the daemon of a docker context
+    - unix://..., tcp://..., ssh://...: the daemon at that DOCKER_HOST
+
+    An image stays on the daemon which built it (buildx loads it into the
+    daemon of the docker command), so it is tagged, inspected and pushed with
+    the same docker command.
+    """
+
+    def __init__(self, spec: str, platforms: List[Platform] = None):
+        self._logger = logging.getLogger("core.Builder")
+        self.spec = spec
+        if spec == "local":
+            self.kind, self.target = "local", None
+        elif spec.startswith(("buildx:", "context:")):
+            self.kind, _, self.target = spec.partition(":")
+        elif "://" in spec:
+            self.kind, self.target = "host", spec
+        else:
+            raise ValueError("Invalid builder: {} (local, buildx:NAME, context:NAME or a DOCKER_HOST URL)"
+                             .format(spec))
+        # the platforms it builds without emulation
+        self.platforms = platforms or []
+        self._available: Optional[bool] = None
+        self._lock = threading.Lock()
+
+    @property
+    def docker(self) -> str:
+        """The docker command of the daemon of the builder."""
+        if self.kind == "context":
+            return "docker --context {}".format(self.target)
+        if self.kind == "host":
+            return "docker --host {}".format(self.target)
+        return "docker"
+
+    def get_buildx_args(self) -> List[str]:
+        if self.kind == "buildx":
+            return ["--builder {}".format(self.target)]
+        return []
+
+    def is_native(self, platform: Platform) -> bool:
+        return any(str(p) == str(platform) for p in self.platforms)
+
+    def create_engine(self) -> Optional[DockerEngineClient]:
+        """Returns an Engine API client of the daemon, or None if it has no
+        Unix socket (the engine backend doesn't speak TCP, SSH or buildx).
+        """
+        if self.kind == "local":
+            return DockerEngineClient()
+        if self.kind == "host" and self.target.startswith("unix://"):
+            return DockerEngineClient(self.target[len("unix://"):])
+        return None
+
+    def is_available(self) -> bool:
+        """Returns whether the builder answers, it is asked only once."""
+        if self.kind == "local":
+            return True
+        with self._lock:
+            if self._available is None:
+                if self.kind == "buildx":
+                    cmd = "docker buildx inspect --bootstrap {}".format(self.target)
+                else:
+                    cmd = "{} version --format {{{{.Server.Arch}}}}".format(self.docker)
+                try:
+                    output = execute(cmd)
+                    self._logger.debug("$ %s\n%s", cmd, output)
+                    self._available = True
+                except CalledProcessError as e:
+                    self._logger.warning("Builder %s is not available: %s", self.spec, e.output.decode().strip())
+                    self._available = False
+            return self._available
+
+    def __repr__(self):
+        return "<Builder %s platforms=%s>" % (self.spec, ",".join(str(p) for p in self.platforms))
+
+
+class Builders:
+    """Routes every platform to its builder: the one configured for it with
+    PLATFORM=BUILDER (e.g. linux/arm64=buildx:arm-native), if it is available,
+    else the local daemon, which emulates the platforms of other machines.
+    """
+
+    def __init__(self, specs: List[str], current_platform: Platform):
+        self._logger = logging.getLogger("core.Builders")
+        self.local = Builder("local", [current_platform])
+        self._builders: Dict[str, Builder] = {}
+        # platforms with the same builder share it, so it is checked once
+        by_spec = {"local": self.local}
+        for item in specs:
+            platform, sep, spec = item.partition("=")
+            if not sep:
+                raise ValueError("Invalid builder: {} (expected PLATFORM=BUILDER)".format(item))
+            p = Platforms.get(platform)
+            if spec not in by_spec:
+                by_spec[spec] = Builder(spec)
+            builder = by_spec[spec]
+            # the local daemon emulates everything but its own platform
+            if builder is not self.local and not builder.is_native(p):
+                builder.platforms.append(p)
+            self._builders[str(p)] = builder
+        self._logger.debug("Builders: %r", self._builders)
+
+    @classmethod
+    def from_env(cls, specs: Optional[List[str]], current_platform: Platform) -> Builders:
+        """Uses specs, or else XUD_DOCKER_BUILDERS (separated by spaces or
+        commas).
+        """
+        if specs is None:
+            specs = re.split(r"[\s,]+", os.environ.get("XUD_DOCKER_BUILDERS", "").strip())
+        return cls([spec for spec in specs if spec], current_platform)
+
+    def get(self, platform: Platform, check: bool = True) -> Builder:
+        """Returns the builder of the platform. Without check it is the
+        configured one, whether it answers or not (e.g. for a plan, which must
+        not bootstrap builders).
+        """
+        builder = self._builders.get(str(platform))
+        # is_available() logs why a builder is left out, once
+        if builder and (not check or builder.is_available()):
+            return builder
+        return self.local
+
+    def get_common(self, platforms: List[Platform], check: bool = True) -> Optional[Builder]:
+        """Returns the builder of all platforms, or None if they have
+        different ones.
+        """
+        builders = {id(b): b for b in (self.get(p, check) for p in platforms)}
+        if len(builders) == 1:
+            return list(builders.values())[0]
+        return None
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from typing import Optional
+
+
+class DigestCache:
+    """On-disk store for immutable, content-addressed data (manifests fetched
+    by digest and config blobs). Entries are evicted least recently used first
+    once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 64 * 1024 * 1024):
+        self._logger = logging.getLogger("core.DigestCache")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _get_path(self, digest: str) -> Optional[str]:
+        try:
+            algorithm, hex_digest = digest.split(":")
+        except ValueError:
+            return None
+        if algorithm != "sha256" or len(hex_digest) != 64:
+            return None
+        return os.path.join(self.cache_dir, algorithm, hex_digest[:2], hex_digest)
+
+    def get(self, digest: str) -> Optional[bytes]:
+        path = self._get_path(digest)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # the modification time doubles as the last access time for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, digest: str, data: bytes) -> None:
+        path = self._get_path(digest)
+        if not path:
+            return
+        if "sha256:" + hashlib.sha256(data).hexdigest() != digest:
+            self._logger.debug("Not caching %s: content does not match the digest", digest)
+            return
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _evict(self) -> None:
+        entries, total = self._scan()
+        entries.sort()
+        # shrink to 90% so that we don't scan again on the next put
+        target = self.max_size * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._logger.debug("Evicted cache entries down to %d bytes", total)
+        self._size = total
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from subprocess import Popen, PIPE
+from typing import Dict, List, Optional, Set
+
+# inputs of every image besides its own folder: the toolkit code which
+# decides what goes into an image, i.e. the build context, the labels and the
+# checked out sources
+TOOLKIT_INPUTS = [
+    "tools/core/buildcontext.py",
+    "tools/core/image.py",
+    "tools/core/src.py",
+]
+
+
+@dataclass
+class ImageInputs:
+    """The files (path prefixes) of the repository an image is built from.
+    Its upstream sources are inputs too, they are compared with the labels of
+    the pushed image instead.
+    """
+    name: str
+    paths: List[str]
+
+    def matches(self, file: str) -> bool:
+        return any(file == path.rstrip("/") or file.startswith(path) for path in self.paths)
+
+
+def get_image_inputs(name: str) -> ImageInputs:
+    return ImageInputs(name, ["images/{}/".format(name)] + TOOLKIT_INPUTS)
+
+
+@dataclass
+class _Target:
+    inputs: ImageInputs
+    base: str
+    # commits which are ancestors of base
+    excluded: Set[str] = field(default_factory=set)
+    found: bool = False
+    changes: List[str] = field(default_factory=list)
+
+
+class ChangeDetector:
+    """Finds the images whose inputs changed since the commits they were last
+    pushed from, with one git log walk for all of them.
+
+    The walk goes from HEAD towards the root in topological order (children
+    before parents), so when a commit shows up it is known whether it is an
+    ancestor of the base commit of an image. A commit which isn't counts for
+    that image. The walk stops as soon as every commit left is an ancestor of
+    all base commits.
+    """
+
+    def __init__(self, project_dir: str):
+        self._logger = logging.getLogger("core.ChangeDetector")
+        self.project_dir = project_dir
+
+    def get_changes(self, bases: Dict[str, str], inputs: Dict[str, ImageInputs]) -> Dict[str, Optional[List[str]]]:
+        """Returns the changed files of every key of bases since its base
+        commit, or None if the base commit isn't in the history of HEAD.
+        """
+        targets = {key: _Target(inputs[key], base, {base}) for key, base in bases.items()}
+        if not targets:
+            return {}
+
+        cmd = ["git", "-C", self.project_dir, "log", "--topo-order", "--name-only", "--format=%x00%H %P", "HEAD"]
+        self._logger.debug("$ %s", " ".join(cmd))
+        p = Popen(cmd, stdout=PIPE, universal_newlines=True)
+        # unprocessed parents of commits which count for some target
+        pending: Set[str] = set()
+        commits = 0
+        relevant: List[_Target] = []
+        try:
+            for line in p.stdout:
+                line = line.rstrip("\n")
+                if line.startswith("\0"):
+                    commit, *parents = line[1:].split()
+                    commits += 1
+                    pending.discard(commit)
+                    relevant = []
+                    for t in targets.values():
+                        if commit in t.excluded:
+                            t.found = True
+                            t.excluded.update(parents)
+                        else:
+                            relevant.append(t)
+                    if relevant:
+                        pending.update(parents)
+                    elif all(all(c in t.excluded for t in targets.values()) for c in pending):
+                        break
+                elif line:
+                    for t in relevant:
+                        if t.inputs.matches(line):
+                            t.changes.append(line)
+        finally:
+            p.stdout.close()
+            p.terminate()
+            p.wait()
+        self._logger.debug("Walked %d commits", commits)
+
+        return {key: t.changes if t.found else None for key, t in targets.items()}
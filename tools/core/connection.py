@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import http.client
+import logging
+import threading
+from dataclasses import dataclass
+from email.message import Message
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urljoin
+
+
+class ConnectionPoolError(Exception):
+    pass
+
+
+@dataclass
+class Response:
+    url: str
+    status: int
+    headers: Message
+    body: bytes
+
+
+_Key = Tuple[str, str, int]
+
+
+class ConnectionPool:
+    """Keeps HTTP/1.1 connections alive between requests so that consecutive
+    registry calls don't pay for a new TCP and TLS handshake each time.
+    """
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, maxsize: int = 8, timeout: float = 60):
+        self._logger = logging.getLogger("core.ConnectionPool")
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle: Dict[_Key, List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, url: str) -> _Key:
+        parts = urlsplit(url)
+        if parts.scheme == "https":
+            return parts.scheme, parts.hostname, parts.port or 443
+        elif parts.scheme == "http":
+            return parts.scheme, parts.hostname, parts.port or 80
+        else:
+            raise ConnectionPoolError("Unsupported URL: " + url)
+
+    def _acquire(self, key: _Key) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        else:
+            return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key: _Key, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes]) -> Response:
+        key = self._get_key(url)
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                r = conn.getresponse()
+                data = r.read()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError):
+                conn.close()
+                if reused:
+                    # the server closed an idle keep-alive connection; retry on
+                    # a fresh one
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if r.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+
+            return Response(url=url, status=r.status, headers=r.headers, body=data)
+
+    def request(self, method: str, url: str, headers: Dict[str, str] = None, body: bytes = None,
+                max_redirects: int = 5) -> Response:
+        headers = dict(headers or {})
+        origin = self._get_key(url)
+        for _ in range(max_redirects + 1):
+            r = self._send(method, url, headers, body)
+            if r.status not in self.REDIRECTS:
+                return r
+            url = urljoin(url, r.headers["Location"])
+            if self._get_key(url) != origin:
+                # never leak registry credentials to a blob storage backend
+                headers.pop("Authorization", None)
+            if r.status == 303:
+                method, body = "GET", None
+            self._logger.debug("Redirected to %s", url)
+        raise ConnectionPoolError("Too many redirects: " + url)
+
+    def close(self) -> None:
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
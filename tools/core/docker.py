@@ -1,20 +1,30 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Dict, Optional, List, Union
+from typing import TYPE_CHECKING, ContextManager, Dict, Optional, List, Union, Tuple
 
+import base64
+import hashlib
 import json
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
 import http.client
+import os
 import time
 import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
+from datetime import datetime
+from subprocess import run, PIPE, SubprocessError
 import platform
 
+from .cache import DigestCache
+from .connection import ConnectionPool, Response
+from .utils import get_cache_dir
+
 
 if TYPE_CHECKING:
     from .toolkit import Context
-    from http.client import HTTPResponse
 
 
 # SupportedPlatform = Literal["linux/arm64", "linux/amd64", "linux/386", "linux/ppc64le", "linux/s390s", "linux/arm/v7", "linux/arm/v6"]
@@ -86,68 +96,355 @@ class DockerRegistryClientError(Exception):
     pass
 
 
+def _get_helper_credentials(helper: str, registry: str) -> Optional[Tuple[str, str]]:
+    """Asks the credential helper docker-credential-<helper> (osxkeychain,
+    desktop, pass, ...) for the credentials of registry.
+    """
+    logger = logging.getLogger("core.docker")
+    cmd = ["docker-credential-" + helper, "get"]
+    try:
+        p = run(cmd, input=registry.encode(), stdout=PIPE, stderr=PIPE, timeout=60)
+    except (OSError, SubprocessError) as e:
+        logger.warning("Failed to run %s: %s", cmd[0], e)
+        return None
+    if p.returncode != 0:
+        # e.g. "credentials not found in native keychain" before docker login
+        logger.debug("%s: %s", " ".join(cmd), (p.stdout or p.stderr).decode().strip())
+        return None
+    try:
+        j = json.loads(p.stdout.decode())
+    except ValueError:
+        return None
+    if not j.get("Secret") or j.get("Username") == "<token>":
+        # an identity token, which the token service doesn't take as a password
+        return None
+    return j["Username"], j["Secret"]
+
+
+def get_registry_credentials(registry: str = "https://index.docker.io/v1/") -> Optional[Tuple[str, str]]:
+    """Returns (username, password) from XUD_DOCKER_USERNAME and
+    XUD_DOCKER_PASSWORD, or the ones of docker login: like the docker CLI,
+    from the credential helper of the registry (credHelpers), else the one
+    of all registries (credsStore), else ~/.docker/config.json itself.
+    """
+    if os.environ.get("XUD_DOCKER_USERNAME") and os.environ.get("XUD_DOCKER_PASSWORD"):
+        return os.environ["XUD_DOCKER_USERNAME"], os.environ["XUD_DOCKER_PASSWORD"]
+    config_file = os.path.join(os.environ.get("DOCKER_CONFIG") or os.path.expanduser("~/.docker"), "config.json")
+    try:
+        with open(config_file) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    helper = config.get("credHelpers", {}).get(registry) or config.get("credsStore")
+    if helper:
+        return _get_helper_credentials(helper, registry)
+    entry = config.get("auths", {}).get(registry, {})
+    if entry.get("auth"):
+        try:
+            username, _, password = base64.b64decode(entry["auth"]).decode().partition(":")
+            return username, password
+        except ValueError:
+            pass
+    return None
+
+
 @dataclass
 class Resource:
     digest: str
     payload: Dict
+    # the bytes which digest is the hash of
+    data: bytes = b""
 
 
 class DockerRegistryClient:
-    def __init__(self, token_url, registry_url):
+    MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+    MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+    # buildx >= 0.10 pushes OCI indexes (with attestation manifests) by default
+    OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+    OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+    LIST_MEDIA_TYPES = [MANIFEST_LIST_V2, OCI_INDEX]
+    IMAGE_MEDIA_TYPES = [MANIFEST_V2, OCI_MANIFEST]
+    MANIFEST_MEDIA_TYPES = LIST_MEDIA_TYPES + IMAGE_MEDIA_TYPES + [
+        "application/vnd.docker.distribution.manifest.v1+json",
+    ]
+    # seconds before the announced expiry at which a cached token is renewed
+    TOKEN_LEEWAY = 10
+    # attempts to merge into a manifest list which changes under our feet
+    MANIFEST_LIST_ATTEMPTS = 5
+
+    def __init__(self, token_url, registry_url, cache: DigestCache = None,
+                 credentials: Tuple[str, str] = None, manifest_list_settle: float = 2.0):
+        self._logger = logging.getLogger("core.DockerRegistryClient")
         self.token_url = token_url
         self.registry_url = registry_url
-
-    def get_token(self, repo):
+        self.cache = cache
+        # seconds after which an update of a manifest list is checked again
+        # (see update_manifest_list)
+        self.manifest_list_settle = manifest_list_settle
+        # used for push scopes only, pulls stay anonymous; they are looked up
+        # (see get_registry_credentials) by the first push if not given
+        self.credentials = credentials
+        self._credentials_lock = threading.Lock()
+        self._credentials_looked_up = credentials is not None
+        self._pool = ConnectionPool()
+        # scope -> (token, expires_at)
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._tokens_lock = threading.Lock()
+
+    def _parse_issued_at(self, value: Optional[str]) -> float:
+        if not value:
+            return time.time()
+        try:
+            # e.g. 2020-11-26T09:22:40.419123567Z, Python only parses microseconds
+            value = re.sub(r"(\.\d{6})\d*", r"\1", value).replace("Z", "+00:00")
+            return min(datetime.fromisoformat(value).timestamp(), time.time())
+        except ValueError:
+            return time.time()
+
+    def _get_scope(self, repo: str, actions: str, mount_from: str = None) -> str:
+        scope = "repository:{}:{}".format(repo, actions)
+        if mount_from:
+            # a mount needs to pull from the other repository with the same token
+            scope += " repository:{}:pull".format(mount_from)
+        return scope
+
+    def _get_credentials(self) -> Optional[Tuple[str, str]]:
+        with self._credentials_lock:
+            if not self._credentials_looked_up:
+                self.credentials = get_registry_credentials()
+                self._credentials_looked_up = True
+            return self.credentials
+
+    def get_token(self, repo, actions="pull", mount_from=None):
+        scope = self._get_scope(repo, actions, mount_from)
+        with self._tokens_lock:
+            cached = self._tokens.get(scope)
+        if cached and cached[1] > time.time():
+            return cached[0]
+        headers = {}
+        if "push" in actions:
+            credentials = self._get_credentials()
+            if not credentials:
+                raise DockerRegistryClientError("No credentials to push to repository: {}".format(repo))
+            basic = base64.b64encode("{}:{}".format(*credentials).encode()).decode()
+            headers["Authorization"] = "Basic " + basic
         try:
-            r = urlopen("{}?service=registry.docker.io&scope=repository:{}:pull".format(self.token_url, repo))
-            return json.loads(r.read().decode())["token"]
+            query = "&".join("scope=" + item for item in scope.split(" "))
+            r = self._pool.request("GET", "{}?service=registry.docker.io&{}".format(self.token_url, query), headers)
+            if r.status != 200:
+                raise DockerRegistryClientError("Unexpected status {}".format(r.status))
+            j = json.loads(r.body.decode())
+            token = j.get("token") or j["access_token"]
+            # tokens without expires_in are valid for 60 seconds
+            expires_at = self._parse_issued_at(j.get("issued_at")) + j.get("expires_in", 60) - self.TOKEN_LEEWAY
+            with self._tokens_lock:
+                self._tokens[scope] = (token, expires_at)
+            return token
         except Exception as e:
             raise DockerRegistryClientError("Failed to get token for repository: {}".format(repo)) from e
 
+    def _invalidate_token(self, repo, actions="pull", mount_from=None):
+        with self._tokens_lock:
+            self._tokens.pop(self._get_scope(repo, actions, mount_from), None)
+
+    def _request(self, method: str, repo: str, url: str, headers: Dict[str, str] = None, body: bytes = None,
+                 actions: str = "pull", mount_from: str = None) -> Response:
+        headers = dict(headers or {})
+        for i in range(2):
+            headers["Authorization"] = "Bearer " + self.get_token(repo, actions, mount_from)
+            r = self._pool.request(method, url, headers, body)
+            if r.status != 401:
+                return r
+            # the cached token was revoked or expired earlier than announced
+            self._invalidate_token(repo, actions, mount_from)
+        return r
+
+    def _is_digest(self, ref: str) -> bool:
+        return ref.startswith("sha256:")
+
+    @classmethod
+    def get_media_type(cls, payload: Dict) -> str:
+        """Returns the media type of a manifest (list), which an OCI manifest
+        or index doesn't have to declare.
+        """
+        if "mediaType" in payload:
+            return payload["mediaType"]
+        return cls.OCI_INDEX if "manifests" in payload else cls.OCI_MANIFEST
+
+    @staticmethod
+    def is_attestation(entry: Dict) -> bool:
+        """Returns whether the entry of a manifest list is the attestation
+        manifest (provenance, SBOM) of another entry instead of an image.
+        """
+        return "vnd.docker.reference.type" in entry.get("annotations", {})
+
+    def head_manifest(self, repo: str, tag: str) -> Optional[str]:
+        url = f"{self.registry_url}/v2/{repo}/manifests/{tag}"
+        headers = {"Accept": ",".join(self.MANIFEST_MEDIA_TYPES)}
+        r = self._request("HEAD", repo, url, headers)
+        if r.status == 404:
+            return ""
+        if r.status != 200:
+            raise DockerRegistryClientError("Unexpected status {}".format(r.status))
+        return r.headers.get("Docker-Content-Digest")
+
     def get_manifest(self, repo: str, tag: str) -> Optional[Resource]:
         try:
+            digest = tag if self._is_digest(tag) else None
+            if self.cache and not digest:
+                # a tag moves, so only ask the registry what it points to now
+                digest = self.head_manifest(repo, tag)
+                if digest == "":
+                    return None
+            if self.cache and digest:
+                data = self.cache.get(digest)
+                if data:
+                    return Resource(digest=digest, payload=json.loads(data.decode()), data=data)
+
             url = f"{self.registry_url}/v2/{repo}/manifests/{tag}"
-            request = Request(url)
-            request.add_header("Authorization", "Bearer " + self.get_token(repo))
-            media_types = [
-                "application/vnd.docker.distribution.manifest.list.v2+json",
-                "application/vnd.docker.distribution.manifest.v2+json",
-                "application/vnd.docker.distribution.manifest.v1+json",
-            ]
-            request.add_header("Accept", ",".join(media_types))
+            headers = {"Accept": ",".join(self.MANIFEST_MEDIA_TYPES)}
             for i in range(3):
                 try:
-                    r: HTTPResponse = urlopen(request)
-                    payload = json.loads(r.read().decode())
-                    digest = r.info().get("Docker-Content-Digest")
-                    return Resource(digest=digest, payload=payload)
+                    r = self._request("GET", repo, url, headers)
+                    if r.status == 404:
+                        return None
+                    if r.status != 200:
+                        raise DockerRegistryClientError("Unexpected status {}".format(r.status))
+                    payload = json.loads(r.body.decode())
+                    digest = r.headers.get("Docker-Content-Digest")
+                    if self.cache and digest:
+                        self.cache.put(digest, r.body)
+                    return Resource(digest=digest, payload=payload, data=r.body)
                 except http.client.IncompleteRead:
                     pass
-                except HTTPError as e:
-                    if e.code == 404:
-                        return None
-                    else:
-                        raise
                 time.sleep(1)
             raise RuntimeError("Retried 3 times")
         except Exception as e:
             raise DockerRegistryClientError("Failed to get manifest: {}:{}".format(repo, tag)) from e
 
+    def put_manifest(self, repo: str, ref: str, media_type: str, data: bytes,
+                     headers: Dict[str, str] = None) -> Optional[str]:
+        """Returns the digest of the manifest, or None if a precondition in
+        headers failed.
+        """
+        url = f"{self.registry_url}/v2/{repo}/manifests/{ref}"
+        headers = dict(headers or {}, **{"Content-Type": media_type})
+        r = self._request("PUT", repo, url, headers, data, actions="pull,push")
+        if r.status == 412:
+            return None
+        if r.status not in (200, 201):
+            raise DockerRegistryClientError("Unexpected status {}: {}".format(r.status, r.body[:200]))
+        digest = r.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(data).hexdigest()
+        if self.cache:
+            self.cache.put(digest, data)
+        return digest
+
+    def mount_blob(self, repo: str, digest: str, source_repo: str) -> None:
+        """Makes the blob of source_repo available in repo without uploading
+        it again (a cross-repository blob mount).
+        """
+        url = f"{self.registry_url}/v2/{repo}/blobs/{digest}"
+        r = self._request("HEAD", repo, url, actions="pull,push", mount_from=source_repo)
+        if r.status == 200:
+            return
+        url = f"{self.registry_url}/v2/{repo}/blobs/uploads/?mount={digest}&from={source_repo}"
+        r = self._request("POST", repo, url, actions="pull,push", mount_from=source_repo)
+        if r.status != 201:
+            # 202: the registry started an upload instead, so the blob can't be mounted
+            raise DockerRegistryClientError("Failed to mount {} from {} into {} (status {})".format(
+                digest, source_repo, repo, r.status))
+
+    def _same_platform(self, a: Dict, b: Dict) -> bool:
+        return all(a.get(key) == b.get(key) for key in ["os", "architecture", "variant"])
+
+    def _merge_manifest_list(self, repo: str, tag: str, entry: Dict) -> Tuple[Optional[str], bool]:
+        """Returns (digest of the list, whether it was written): the current
+        list if entry is in it, our merged list if the tag points to it after
+        the write, else (None, True).
+        """
+        current = self.get_manifest(repo, tag)
+        manifests = []
+        # an OCI index (of buildx) stays one
+        media_type = self.MANIFEST_LIST_V2
+        if current and self.get_media_type(current.payload) in self.LIST_MEDIA_TYPES:
+            media_type = self.get_media_type(current.payload)
+            manifests = list(current.payload["manifests"])
+            if entry in manifests:
+                return current.digest, False
+        replaced = {m["digest"] for m in manifests
+                    if not self.is_attestation(m) and self._same_platform(m["platform"], entry["platform"])}
+        # the attestations of the replaced manifest go with it
+        others = [m for m in manifests if m["digest"] not in replaced and
+                  m.get("annotations", {}).get("vnd.docker.reference.digest") not in replaced]
+        # keep the position of the platform in the list
+        i = next((i for i, m in enumerate(manifests) if m not in others), len(others))
+        others.insert(i, entry)
+        data = json.dumps({
+            "schemaVersion": 2,
+            "mediaType": media_type,
+            "manifests": others,
+        }, indent=3).encode()
+
+        headers = {"If-Match": '"{}"'.format(current.digest)} if current else {}
+        digest = self.put_manifest(repo, tag, media_type, data, headers)
+        if digest and self.head_manifest(repo, tag) == digest:
+            return digest, True
+        return None, True
+
+    def update_manifest_list(self, repo: str, tag: str, entry: Dict, lock: ContextManager = None) -> str:
+        """Puts entry (mediaType, size, digest and platform of a manifest)
+        into the manifest list at tag, replacing the entry of its platform,
+        and returns the digest of the list. Only the list itself is read, not
+        its manifests and config blobs.
+
+        The write is conditional on the list read before (If-Match, for
+        registries which honor it). A write of another job in between which
+        lands before ours is noticed right after it, because the tag no
+        longer points to our list, and the merge is done again on top of it.
+        Registries which ignore If-Match (Docker Hub) also let a writer which
+        read the list before our write replace it afterwards, e.g. the CI job
+        of another platform. So the list is read again manifest_list_settle
+        seconds after our write and the entry merged again if it is missing.
+        A writer in another process which takes longer than that from its
+        read to its write can still drop the entry.
+
+        lock, if given, is held from every read to its write (but not while
+        waiting for the recheck), so that writers of this process take turns.
+        """
+        written = False
+        for attempt in range(self.MANIFEST_LIST_ATTEMPTS):
+            with lock or nullcontext():
+                digest, wrote = self._merge_manifest_list(repo, tag, entry)
+            if digest and not wrote:
+                return digest
+            if digest:
+                if written:
+                    self._logger.warning("Manifest list %s:%s was overwritten without our entry, merged it again",
+                                         repo, tag)
+                if self.manifest_list_settle <= 0:
+                    return digest
+                written = True
+                time.sleep(self.manifest_list_settle)
+                continue
+            self._logger.debug("Manifest list %s:%s changed concurrently (attempt %d)", repo, tag, attempt + 1)
+        raise DockerRegistryClientError("Failed to update manifest list: {}:{}".format(repo, tag))
+
     def get_blob(self, repo: str, digest: str) -> Optional[Resource]:
         try:
+            if self.cache:
+                data = self.cache.get(digest)
+                if data:
+                    return Resource(digest=digest, payload=json.loads(data.decode()))
             url = f"{self.registry_url}/v2/{repo}/blobs/{digest}"
-            request = Request(url)
-            request.add_header("Authorization", "Bearer {}".format(self.get_token(repo)))
-            try:
-                r: HTTPResponse = urlopen(request)
-                payload = json.loads(r.read().decode())
-                digest = r.info().get("Docker-Content-Digest")
-                return Resource(digest=digest, payload=payload)
-            except HTTPError as e:
-                if e.code == 404:
-                    return None
-                else:
-                    raise
+            r = self._request("GET", repo, url)
+            if r.status == 404:
+                return None
+            if r.status != 200:
+                raise DockerRegistryClientError("Unexpected status {}".format(r.status))
+            payload = json.loads(r.body.decode())
+            if self.cache:
+                self.cache.put(digest, r.body)
+            return Resource(digest=digest, payload=payload)
         except Exception as e:
             raise DockerRegistryClientError("Failed to get blob: {}@{}".format(repo, digest)) from e
 
@@ -174,16 +471,21 @@ class Manifest:
     @property
     def image_revision(self) -> str:
         key = f"{self.context.label_prefix}.image.revision"
-        return self.labels[key]
+        return (self.labels or {}).get(key)
 
     @property
     def application_revision(self) -> Optional[str]:
         key = f"{self.context.label_prefix}.application.revision"
-        value = self.labels.get(key, None)
+        value = (self.labels or {}).get(key, None)
         if value == "None":
             value = None
         return value
 
+    @property
+    def input_digest(self) -> Optional[str]:
+        key = f"{self.context.label_prefix}.image.input.digest"
+        return (self.labels or {}).get(key) or None
+
     @property
     def application_branch(self) -> Optional[str]:
         key = f"{self.context.label_prefix}.application.branch"
@@ -211,9 +513,20 @@ class DockerTemplate:
     def __init__(self, context: Context):
         self._logger = logging.getLogger("core.DockerTemplate")
         self.context = context
-        self._client = DockerRegistryClient(token_url="https://auth.docker.io/token", registry_url="https://registry-1.docker.io")
-
-    def _parse_platform(self, platform: Dict) -> Platform:
+        # overridable to run against a local registry (see tools/benchmark)
+        token_url = os.environ.get("XUD_DOCKER_TOKEN_URL", "https://auth.docker.io/token")
+        registry_url = os.environ.get("XUD_DOCKER_REGISTRY_URL", "https://registry-1.docker.io")
+        self._client = DockerRegistryClient(token_url=token_url,
+                                            registry_url=registry_url,
+                                            cache=DigestCache(get_cache_dir("registry")),
+                                            manifest_list_settle=float(
+                                                os.environ.get("XUD_DOCKER_MANIFEST_LIST_SETTLE", "2")))
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="registry")
+
+    def _parse_platform(self, platform: Dict) -> Optional[Platform]:
+        """Returns the platform of an entry of a manifest list, or None if it
+        isn't one of ours (e.g. unknown/unknown of an attestation manifest).
+        """
         os = platform["os"]
         architecture = platform["architecture"]
         variant = platform["variant"] if "variant" in platform else None
@@ -221,67 +534,180 @@ class DockerTemplate:
             name = "{}/{}/{}".format(os, architecture, variant)
         else:
             name = "{}/{}".format(os, architecture)
-        return Platforms.get(name)
+        try:
+            return Platforms.get(name)
+        except KeyError:
+            return None
+
+    def _get_entries(self, payload: Dict) -> List[Tuple[Dict, Platform]]:
+        """Returns (entry, platform) of the platform images of a manifest
+        list, without attestation manifests.
+        """
+        result = []
+        for m in payload["manifests"]:
+            p = None if DockerRegistryClient.is_attestation(m) else self._parse_platform(m.get("platform", {}))
+            if p:
+                result.append((m, p))
+            else:
+                self._logger.debug("Skip manifest %s (%s)", m["digest"], m.get("platform"))
+        return result
 
     def _handle_v1_manifest(self, repo: str, res: Resource, platform: Platform = None) -> Optional[Manifest]:
         raise NotImplementedError
 
-    def _handle_v2_manifest_list(self, repo: str, res: Resource, platform: Platform = None) -> Optional[Union[ManifestList, Manifest]]:
-        payload = res.payload
-        if platform:
-            digest = None
-            for m in payload["manifests"]:
-                p = self._parse_platform(m["platform"])
-                if p == platform:
-                    digest = m["digest"]
-            if not digest:
-                return None
+    def _map(self, func, items: List) -> List:
+        if len(items) <= 1:
+            return [func(*item) for item in items]
+        return list(self._executor.map(lambda item: func(*item), items))
 
-            manifest = self._client.get_manifest(repo, digest)
-            payload = manifest.payload
-            assert payload
-            assert payload["schemaVersion"] == 2
-            assert payload["mediaType"] == "application/vnd.docker.distribution.manifest.v2+json"
-            return self._handle_v2_manifest(repo, manifest, platform)
-        else:
-            manifests = []
-            for m in payload["manifests"]:
-                digest = m["digest"]
-                platform = self._parse_platform(m["platform"])
-                manifest = self._client.get_manifest(repo, digest)
-                payload = manifest.payload
-                assert payload
-                assert payload["schemaVersion"] == 2
-                assert payload["mediaType"] == "application/vnd.docker.distribution.manifest.v2+json"
-                manifests.append(self._handle_v2_manifest(repo, manifest, platform))
-            return ManifestList(manifests)
-
-    def _handle_v2_manifest(self, repo: str, res: Resource, platform: Platform) -> Manifest:
+    def _check_v2_manifest(self, res: Resource) -> None:
         payload = res.payload
-        digest = payload["config"]["digest"]
-        blob = self._client.get_blob(repo, digest)
-        assert blob
-        return Manifest(self.context, payload, blob.payload, platform, res.digest)
-
-    def get_manifest(self, name: str, platform: Platform = None) -> Optional[Union[Manifest, ManifestList]]:
-        try:
-            repo, tag = name.split(":")
-
-            manifest = self._client.get_manifest(repo, tag)
-            if not manifest:
-                return None
-            payload = manifest.payload
+        assert payload
+        assert payload["schemaVersion"] == 2
+        assert DockerRegistryClient.get_media_type(payload) in DockerRegistryClient.IMAGE_MEDIA_TYPES
+
+    def _resolve(self, names: List[str], platform: Platform = None) -> List[Optional[Union[Manifest, ManifestList]]]:
+        targets = [tuple(name.split(":")) for name in names]
+
+        # Each level (tags, platform manifests, config blobs) is fetched for all
+        # names at once, so resolving many tags costs three round trips in depth
+        tops = self._map(self._client.get_manifest, targets)
+
+        # (index of the name, repo, manifest resource, platform)
+        images: List[Tuple[int, str, Resource, Optional[Platform]]] = []
+        # (index of the name, repo, manifest digest, platform)
+        children: List[Tuple[int, str, str, Platform]] = []
+        is_list = [False] * len(names)
+
+        for i, ((repo, _), res) in enumerate(zip(targets, tops)):
+            if not res:
+                continue
+            payload = res.payload
             schema_version = payload["schemaVersion"]
             if schema_version == 1:
-                return self._handle_v1_manifest(repo, manifest, platform)
+                self._handle_v1_manifest(repo, res, platform)
             assert schema_version == 2, "Invalid schema version: {}".format(schema_version)
 
-            media_type = payload["mediaType"]
-            if media_type == "application/vnd.docker.distribution.manifest.list.v2+json":
-                return self._handle_v2_manifest_list(repo, manifest, platform)
-            elif media_type == "application/vnd.docker.distribution.manifest.v2+json":
-                return self._handle_v2_manifest(repo, manifest, platform)
+            media_type = DockerRegistryClient.get_media_type(payload)
+            if media_type in DockerRegistryClient.LIST_MEDIA_TYPES:
+                is_list[i] = platform is None
+                for m, p in self._get_entries(payload):
+                    if platform is None or p == platform:
+                        children.append((i, repo, m["digest"], p))
+            elif media_type in DockerRegistryClient.IMAGE_MEDIA_TYPES:
+                images.append((i, repo, res, platform))
             else:
                 raise AssertionError("Invalid media type: {}".format(media_type))
+
+        resources = self._map(self._client.get_manifest, [(repo, digest) for _, repo, digest, _ in children])
+        for (i, repo, _, p), res in zip(children, resources):
+            self._check_v2_manifest(res)
+            images.append((i, repo, res, p))
+        # keep the platform order of the manifest lists
+        images.sort(key=lambda item: item[0])
+
+        blobs = self._map(self._client.get_blob, [(repo, res.payload["config"]["digest"]) for _, repo, res, _ in images])
+
+        result: List[Optional[Union[Manifest, ManifestList]]] = [ManifestList([]) if x else None for x in is_list]
+        for (i, _, res, p), blob in zip(images, blobs):
+            assert blob
+            manifest = Manifest(self.context, res.payload, blob.payload, p, res.digest)
+            if is_list[i]:
+                result[i].manifests.append(manifest)
+            else:
+                result[i] = manifest
+        return result
+
+    def get_manifests(self, names: List[str], platform: Platform = None) -> List[Optional[Union[Manifest, ManifestList]]]:
+        try:
+            return self._resolve(names, platform)
+        except Exception as e:
+            raise DockerTemplateError("Failed to get manifests {} for platform {}".format(", ".join(names), platform)) from e
+
+    def get_manifest(self, name: str, platform: Platform = None) -> Optional[Union[Manifest, ManifestList]]:
+        try:
+            return self._resolve([name], platform)[0]
         except Exception as e:
             raise DockerTemplateError("Failed to get manifest {} for platform {}".format(name, platform)) from e
+
+    def _copy_blobs(self, source_repo: str, repo: str, res: Resource) -> None:
+        """Mounts everything the manifest (list) res refers to into repo and
+        puts the manifests of a list there by digest.
+        """
+        payload = res.payload
+        if DockerRegistryClient.get_media_type(payload) in DockerRegistryClient.LIST_MEDIA_TYPES:
+            children = self._map(self._client.get_manifest, [(source_repo, m["digest"]) for m in payload["manifests"]])
+            self._map(lambda child: self._copy_blobs(source_repo, repo, child), [(child,) for child in children])
+            for child in children:
+                self._client.put_manifest(repo, child.digest, DockerRegistryClient.get_media_type(child.payload),
+                                          child.data)
+            return
+        digests = [payload["config"]["digest"]] + [layer["digest"] for layer in payload["layers"]]
+        self._map(self._client.mount_blob, [(repo, digest, source_repo) for digest in digests])
+
+    def copy_manifest(self, source: str, targets: List[str]) -> str:
+        """Points the targets (repo:tag) to the manifest or manifest list of
+        source, byte for byte, so they get the same digest. Blobs of another
+        repository are mounted, not uploaded. Returns the digest.
+        """
+        try:
+            source_repo, source_tag = source.split(":")
+            res = self._client.get_manifest(source_repo, source_tag)
+            if not res:
+                raise DockerTemplateError("Missing manifest {}".format(source))
+            media_type = DockerRegistryClient.get_media_type(res.payload)
+            copied = {source_repo}
+            for target in targets:
+                repo, tag = target.split(":")
+                if self._client.head_manifest(repo, tag) == res.digest:
+                    self._logger.debug("%s is already %s", target, res.digest)
+                    continue
+                if repo not in copied:
+                    self._copy_blobs(source_repo, repo, res)
+                    copied.add(repo)
+                self._client.put_manifest(repo, tag, media_type, res.data)
+            return res.digest
+        except Exception as e:
+            raise DockerTemplateError("Failed to copy {} to {}".format(source, ", ".join(targets))) from e
+
+    def tag_platforms(self, name: str, targets: Dict[str, str]) -> None:
+        """Points the tags of targets (platform -> repo:tag in the repository
+        of name) to the manifests of their platforms in the manifest list
+        name, like the per-platform pushes would.
+        """
+        try:
+            repo, tag = name.split(":")
+            res = self._client.get_manifest(repo, tag)
+            if not res or DockerRegistryClient.get_media_type(res.payload) not in DockerRegistryClient.LIST_MEDIA_TYPES:
+                raise DockerTemplateError("Missing manifest list {}".format(name))
+            entries = [(m, p) for m, p in self._get_entries(res.payload) if str(p) in targets]
+            children = self._map(self._client.get_manifest, [(repo, m["digest"]) for m, _ in entries])
+            for (_, p), child in zip(entries, children):
+                target_repo, target_tag = targets[str(p)].split(":")
+                assert target_repo == repo, "{} is not in {}".format(target_repo, repo)
+                self._client.put_manifest(repo, target_tag, DockerRegistryClient.get_media_type(child.payload),
+                                          child.data)
+        except Exception as e:
+            raise DockerTemplateError("Failed to tag the platforms of {}".format(name)) from e
+
+    def update_manifest_list(self, name: str, platform: Platform, digest: str, size: int,
+                             lock: ContextManager = None) -> str:
+        """Adds the pushed manifest digest of platform to the manifest list
+        name (repo:tag) and returns the digest of the list. lock is held while
+        the list is read and written (see
+        DockerRegistryClient.update_manifest_list).
+        """
+        p = {"architecture": platform.architecture, "os": platform.os}
+        if platform.variant:
+            p["variant"] = platform.variant
+        entry = {
+            "mediaType": DockerRegistryClient.MANIFEST_V2,
+            "size": size,
+            "digest": digest,
+            "platform": p,
+        }
+        repo, tag = name.split(":")
+        try:
+            return self._client.update_manifest_list(repo, tag, entry, lock)
+        except Exception as e:
+            raise DockerTemplateError("Failed to update manifest list {} for platform {}".format(name, platform)) from e
@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+import base64
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, BinaryIO, TextIO, Iterator, Tuple
+from urllib.parse import urlencode, quote
+
+from .docker import get_registry_credentials
+from .scheduler import Job, JobCancelled, current_job
+from .trace import get_tracer
+
+
+class DockerEngineError(Exception):
+    pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class _ChunkedWriter:
+    """File object for BuildContext.write which sends what is written as
+    chunks of a chunked request body.
+    """
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, conn: http.client.HTTPConnection, job: Optional[Job] = None):
+        self._conn = conn
+        self._job = job
+        self._buffer = bytearray()
+        self.size = 0
+
+    def _send_chunk(self, data: bytes) -> None:
+        self._conn.send(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def write(self, data: bytes) -> int:
+        if self._job and self._job.cancelled.is_set():
+            raise JobCancelled(self._job.name)
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= self.CHUNK_SIZE:
+            self._send_chunk(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def close(self) -> None:
+        if self._buffer:
+            self._send_chunk(bytes(self._buffer))
+            self._buffer.clear()
+        self._conn.send(b"0\r\n\r\n")
+
+
+class _Aborter(threading.Thread):
+    """Shuts the connection of a request down when the job which sent it is
+    cancelled. The daemon stops a build or push whose client went away, also
+    one which hasn't sent anything for a while.
+    """
+
+    def __init__(self, conn: http.client.HTTPConnection, job: Job):
+        super().__init__(daemon=True)
+        # the response keeps reading from the socket after the connection
+        # dropped it (Connection: close)
+        self.sock = conn.sock
+        self.job = job
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            if self.job.cancelled.wait(0.5):
+                if not self.done.is_set():
+                    try:
+                        self.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                return
+
+    def stop(self) -> None:
+        self.done.set()
+
+
+@dataclass
+class EngineEvent:
+    # step, cache, output, layer, aux
+    kind: str
+    message: str = ""
+    # layer id of layer events
+    id: Optional[str] = None
+    aux: Dict = field(default_factory=dict)
+
+
+def get_socket_path() -> str:
+    host = os.environ.get("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host[len("unix://"):]
+    return "/var/run/docker.sock"
+
+
+def get_registry_auth(registry: str = "https://index.docker.io/v1/") -> str:
+    """Returns the X-Registry-Auth header for pushes: the credentials of
+    get_registry_credentials, or none.
+    """
+    auth = {}
+    credentials = get_registry_credentials(registry)
+    if credentials:
+        auth = {"username": credentials[0], "password": credentials[1], "serveraddress": registry}
+    return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+
+class DockerEngineClient:
+    """Talks to the Docker Engine API over its Unix socket, so builds and
+    pushes don't start a docker CLI process and their progress arrives as
+    JSON messages instead of text to parse.
+    """
+
+    API_VERSION = "1.40"
+
+    def __init__(self, socket_path: str = None, timeout: float = None):
+        self._logger = logging.getLogger("core.DockerEngineClient")
+        self.socket_path = socket_path or get_socket_path()
+        self.timeout = timeout
+
+    def _get_path(self, path: str, query: Dict[str, str] = None) -> str:
+        path = "/v{}{}".format(self.API_VERSION, path)
+        if query:
+            path += "?" + urlencode(query)
+        return path
+
+    def _decode(self, r: http.client.HTTPResponse) -> Iterator[Dict]:
+        while True:
+            line = r.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode())
+
+    def _to_event(self, message: Dict) -> Optional[EngineEvent]:
+        if "error" in message:
+            raise DockerEngineError(message["error"].strip())
+        if "aux" in message:
+            return EngineEvent("aux", aux=message["aux"])
+        if "stream" in message:
+            text = message["stream"]
+            if text.startswith("Step "):
+                return EngineEvent("step", text.rstrip("\n"))
+            if text.strip() == "---> Using cache":
+                return EngineEvent("cache", text.strip())
+            return EngineEvent("output", text)
+        if "status" in message:
+            return EngineEvent("layer", message["status"], id=message.get("id"))
+        return None
+
+    def _handle(self, r: http.client.HTTPResponse, on_event: Callable[[EngineEvent], None],
+                job: Optional[Job] = None) -> Dict:
+        if r.status >= 400:
+            body = r.read().decode(errors="replace")
+            try:
+                body = json.loads(body)["message"]
+            except (ValueError, KeyError, TypeError):
+                pass
+            raise DockerEngineError("Unexpected status {}: {}".format(r.status, body))
+        aux = {}
+        for message in self._decode(r):
+            if job and job.cancelled.is_set():
+                raise JobCancelled(job.name)
+            event = self._to_event(message)
+            if not event:
+                continue
+            if event.kind == "aux":
+                aux.update(event.aux)
+            on_event(event)
+        # the aborter ends the response early
+        if job and job.cancelled.is_set():
+            raise JobCancelled(job.name)
+        return aux
+
+    def _start_aborter(self, conn: http.client.HTTPConnection, job: Optional[Job]) -> Optional[_Aborter]:
+        """Aborts the request of conn when job, the scheduler job which sends
+        it, is cancelled.
+        """
+        if not job:
+            return None
+        if job.cancelled.is_set():
+            raise JobCancelled(job.name)
+        aborter = _Aborter(conn, job)
+        aborter.start()
+        return aborter
+
+    def build(self,
+              context: Callable[[BinaryIO], None],
+              tag: str,
+              dockerfile: str,
+              labels: Dict[str, str],
+              build_args: Dict[str, str],
+              no_cache: bool = False,
+              platform: str = None,
+              on_event: Callable[[EngineEvent], None] = lambda event: None,
+              ) -> str:
+        """Builds an image from the tar stream which context writes and
+        returns the image ID.
+        """
+        query = {
+            "t": tag,
+            "dockerfile": dockerfile,
+            "labels": json.dumps(labels),
+            "buildargs": json.dumps(build_args),
+            "rm": "1",
+        }
+        if no_cache:
+            query["nocache"] = "1"
+        if platform:
+            query["platform"] = platform
+        job = current_job()
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        aborter = None
+        try:
+            conn.putrequest("POST", self._get_path("/build", query), skip_accept_encoding=True)
+            conn.putheader("Content-Type", "application/x-tar")
+            conn.putheader("Transfer-Encoding", "chunked")
+            conn.endheaders()
+            aborter = self._start_aborter(conn, job)
+            writer = _ChunkedWriter(conn, job)
+            context(writer)
+            writer.close()
+            aux = self._handle(conn.getresponse(), on_event, job)
+        except (OSError, http.client.HTTPException) as e:
+            if job and job.cancelled.is_set():
+                raise JobCancelled(job.name) from e
+            raise DockerEngineError("Failed to build {}".format(tag)) from e
+        finally:
+            if aborter:
+                aborter.stop()
+            conn.close()
+        if "ID" not in aux:
+            raise DockerEngineError("Missing image ID of {}".format(tag))
+        return aux["ID"]
+
+    def tag(self, image: str, target: str) -> None:
+        repo, _, tag = target.rpartition(":")
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            conn.request("POST", self._get_path("/images/{}/tag".format(quote(image, safe="/:")),
+                                                {"repo": repo, "tag": tag}))
+            r = conn.getresponse()
+            body = r.read()
+            if r.status != 201:
+                raise DockerEngineError("Failed to tag {} as {}: {}".format(image, target, body.decode()))
+        finally:
+            conn.close()
+
+    def inspect(self, name: str) -> Dict:
+        """Returns the details of a local image (Id, Size, Config, ...)."""
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            conn.request("GET", self._get_path("/images/{}/json".format(quote(name, safe="/:"))))
+            r = conn.getresponse()
+            body = r.read()
+            if r.status != 200:
+                raise DockerEngineError("Failed to inspect {}: {}".format(name, body.decode()))
+            return json.loads(body.decode())
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerEngineError("Failed to inspect {}".format(name)) from e
+        finally:
+            conn.close()
+
+    def push(self, name: str, on_event: Callable[[EngineEvent], None] = lambda event: None) -> Tuple[str, int]:
+        """Pushes repo:tag and returns the digest and size of the manifest."""
+        repo, _, tag = name.rpartition(":")
+        job = current_job()
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        aborter = None
+        try:
+            conn.request("POST", self._get_path("/images/{}/push".format(repo), {"tag": tag}),
+                         headers={"X-Registry-Auth": get_registry_auth()})
+            aborter = self._start_aborter(conn, job)
+            aux = self._handle(conn.getresponse(), on_event, job)
+        except (OSError, http.client.HTTPException) as e:
+            if job and job.cancelled.is_set():
+                raise JobCancelled(job.name) from e
+            raise DockerEngineError("Failed to push {}".format(name)) from e
+        finally:
+            if aborter:
+                aborter.stop()
+            conn.close()
+        if "Digest" not in aux:
+            raise DockerEngineError("Missing digest of {}".format(name))
+        return aux["Digest"], aux.get("Size", 0)
+
+
+class EventPrinter:
+    """Writes engine events as docker build/push would and records a trace
+    span for every build step (with whether it was cached).
+    """
+
+    def __init__(self, outputs: List[TextIO]):
+        self.outputs = outputs
+        self._step: Optional[EngineEvent] = None
+        self._step_started_at = 0.0
+        self._cached = False
+        self._layers: Dict[str, str] = {}
+
+    def _write(self, s: str) -> None:
+        for f in self.outputs:
+            f.write(s)
+
+    def _finish_step(self) -> None:
+        if self._step:
+            get_tracer().record("step", self._step_started_at, time.perf_counter(),
+                                instruction=self._step.message[:80], cached=self._cached)
+            self._step = None
+
+    def __call__(self, event: EngineEvent) -> None:
+        if event.kind == "step":
+            self._finish_step()
+            self._step = event
+            self._step_started_at = time.perf_counter()
+            self._cached = False
+            self._write(event.message + "\n")
+        elif event.kind == "cache":
+            self._cached = True
+            self._write(" " + event.message + "\n")
+        elif event.kind == "output":
+            self._write(event.message)
+        elif event.kind == "layer":
+            # only changes of a layer, not every progress update
+            if event.id and self._layers.get(event.id) == event.message:
+                return
+            if event.id:
+                self._layers[event.id] = event.message
+                self._write("{}: {}\n".format(event.id, event.message))
+            else:
+                self._write(event.message + "\n")
+        for f in self.outputs:
+            f.flush()
+
+    def close(self) -> None:
+        self._finish_step()
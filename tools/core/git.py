@@ -6,9 +6,10 @@ import re
 import sys
 from dataclasses import dataclass
 from subprocess import CalledProcessError
-from typing import TYPE_CHECKING, List, Dict
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 
 from .image import Image
+from .trace import get_tracer
 from .utils import execute, get_current_branch
 
 if TYPE_CHECKING:
@@ -19,7 +20,6 @@ if TYPE_CHECKING:
 class GitInfo:
     branch: str
     revision: str
-    master: str
     history: List[str]
 
 
@@ -31,9 +31,6 @@ def get_master_commit_hash():
         return execute("git ls-remote origin master").split()[0]
 
 
-
-
-
 def get_commit_message(commit):
     if commit == "HEAD":
         return ""
@@ -42,11 +39,30 @@ def get_commit_message(commit):
 
 
 class GitTemplate:
+    """Git metadata of the project. Nothing runs before it is needed: the
+    branch, HEAD and whether the tree is dirty come from one git status, the
+    hash of master (which may need git ls-remote) only when asked for.
+    """
+
     def __init__(self, project_dir):
         self._logger = logging.getLogger("core.GitTemplate")
         self.project_dir = project_dir
         self.commit_before_travis = "0aa9c74f46012d212134ec6b7d58732b84f14ee0"
-        self.git_info = self._create_git_info()
+        self._git_info: Optional[GitInfo] = None
+        self._master: Optional[str] = None
+
+    @property
+    def git_info(self) -> GitInfo:
+        if not self._git_info:
+            with get_tracer().span("git info"):
+                self._git_info = self._create_git_info()
+        return self._git_info
+
+    @property
+    def master(self) -> str:
+        if not self._master:
+            self._master = get_master_commit_hash()
+        return self._master
 
     def get_branch_history(self, from_commit):
         cmd = f"git log --oneline --pretty=format:%h --abbrev=-1 {from_commit}.."
@@ -54,12 +70,28 @@ class GitTemplate:
         self._logger.debug("$ %s\n%s", cmd, output)
         return output.splitlines()
 
+    def _parse_status(self, output: str) -> Tuple[str, str, bool]:
+        """Returns the branch, HEAD and whether tracked files are modified
+        (staged or not) from git status --porcelain=v2 --branch.
+        """
+        b = r = ""
+        dirty = False
+        for line in output.splitlines():
+            if line.startswith("# branch.head "):
+                b = line[len("# branch.head "):]
+            elif line.startswith("# branch.oid "):
+                r = line[len("# branch.oid "):]
+            elif line and not line.startswith("#"):
+                dirty = True
+        return b, r, dirty
+
     def _create_git_info(self):
-        if not os.path.exists(".git"):
+        if not os.path.exists(os.path.join(self.project_dir, ".git")):
             raise RuntimeError("Not a git repository")
 
-        b = os.popen("git rev-parse --abbrev-ref HEAD").read().strip()
-        if b == "HEAD":
+        output = execute("git -C {} status --porcelain=v2 --branch --untracked-files=no".format(self.project_dir))
+        b, r, dirty = self._parse_status(output)
+        if b == "(detached)":
             b = get_current_branch()
         if b == "local":
             print("ERROR: Git branch name (local) is reserved", file=sys.stderr)
@@ -67,29 +99,26 @@ class GitTemplate:
         if "__" in b:
             print("ERROR: Git branch name (%s) contains \"__\"" % b, file=sys.stderr)
             exit(1)
-        r = os.popen("git rev-parse HEAD").read().strip()
-        if os.system("git diff --quiet") != 0:
+        if dirty:
             r = r + "-dirty"
-        master = get_master_commit_hash()
-        branch = b
         # if branch == "master":
         #     history = self.get_branch_history(self.commit_before_travis)
         # else:
-        #     history = self.get_branch_history(master)
+        #     history = self.get_branch_history(self.master)
 
         # output = check_output("git diff --name-only", shell=True, stderr=PIPE)
         # output = output.decode().strip()
         # if len(output) > 0:
         #     history.insert(0, "HEAD")
 
-        return GitInfo(b, r, master, [])
+        return GitInfo(b, r, [])
 
     def get_modified_images(self, context: Context) -> List[Image]:
         branch = context.branch
         if branch == "master":
             base = self._get_last_successful_travis_build("master")
         else:
-            base = self.git_info.master
+            base = self.master
 
         modified_folders = self._get_modified_since_commit(base)
 
@@ -137,22 +166,25 @@ class GitTemplate:
 
         return self._process_lines(lines1 + lines2)
 
-    def _get_modified_at_commit(self, commit: str) -> List[str]:
-        if commit == "HEAD":
-            return self._get_modified_at_head()
-
-        cmd = f"git diff-tree --no-commit-id --name-only -r {commit} -- images"
-        output = execute(cmd)
-        self._logger.debug("$ %s\n%s", cmd, output)
-        lines = output.splitlines()
-
-        return self._process_lines(lines)
-
     @property
     def history(self) -> Dict[str, List[str]]:
         history = {commit: [] for commit in self.git_info.history}
 
-        for commit in history:
-            history[commit] = self._get_modified_at_commit(commit)
+        if "HEAD" in history:
+            history["HEAD"] = self._get_modified_at_head()
+
+        commits = [commit for commit in history if commit != "HEAD"]
+        if not commits:
+            return history
+
+        # one git log for all commits instead of a git diff-tree each
+        cmd = "git log --no-walk=unsorted --name-only --format=%x00%H {} -- images".format(" ".join(commits))
+        output = execute(cmd)
+        self._logger.debug("$ %s\n%s", cmd, output)
+        for chunk in output.split("\0")[1:]:
+            full_hash, *lines = chunk.splitlines()
+            for commit in commits:
+                if full_hash.startswith(commit):
+                    history[commit] = self._process_lines([line for line in lines if line])
 
         return history
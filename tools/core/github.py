@@ -1,30 +1,189 @@
 from __future__ import annotations
 
 import json
-from typing import Optional, TYPE_CHECKING, Dict, List
-from urllib.request import urlopen
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional, TYPE_CHECKING, Dict, List, Tuple
 import re
 
+from .connection import ConnectionPool, Response
+
 if TYPE_CHECKING:
     from .toolkit import Context
 
 
+class GithubClientError(Exception):
+    pass
+
+
+class GithubRateLimitError(GithubClientError):
+    pass
+
+
 class GithubClient:
+    """One client is shared by the whole run (see get_client). GET responses
+    are kept with their ETag and revalidated with If-None-Match (a 304 doesn't
+    count against the rate limit), lookups which can't change during a run are
+    memoized, and requests wait for the rate limit window to reset instead of
+    failing with 403 once X-RateLimit-Remaining runs out. Callers with another
+    way to get an answer (e.g. git ls-remote) pass wait=False to get a
+    GithubRateLimitError right away instead.
+    """
+
+    API_URL = "https://api.github.com"
+
+    # keep a few requests for the ref lookups of other threads
+    RATE_LIMIT_RESERVE = 5
+    # never sleep longer than this for a rate limit reset
+    MAX_RATE_LIMIT_WAIT = 300
+
+    def __init__(self, token: str = None, api_url: str = None):
+        self._logger = logging.getLogger("core.GithubClient")
+        if api_url:
+            self.API_URL = api_url
+        self._pool = ConnectionPool()
+        self.token = token
+        self._lock = threading.Lock()
+        # path -> (etag, json)
+        self._responses: Dict[str, Tuple[str, Dict]] = {}
+        # key -> Future of the value
+        self._memo: Dict[Tuple, Future] = {}
+        self._rate_limit_remaining: Optional[int] = None
+        self._rate_limit_reset: Optional[float] = None
+
+    def _get_headers(self) -> Dict[str, str]:
+        headers = {
+            "Accept": "application/vnd.github.v3+json",
+            "User-Agent": "xud-docker",
+        }
+        if self.token:
+            headers["Authorization"] = "token " + self.token
+        return headers
+
+    def _wait_for_rate_limit(self, wait: bool = True) -> None:
+        with self._lock:
+            remaining = self._rate_limit_remaining
+            reset = self._rate_limit_reset
+        if remaining is None or reset is None or remaining > self.RATE_LIMIT_RESERVE:
+            return
+        delay = reset - time.time()
+        if delay <= 0:
+            return
+        if not wait or delay > self.MAX_RATE_LIMIT_WAIT:
+            raise GithubRateLimitError("GitHub API rate limit almost exceeded ({} left, resets in {:.0f}s)".format(
+                remaining, delay))
+        self._logger.warning("GitHub API rate limit almost exceeded (%d left), wait %.0fs", remaining, delay)
+        time.sleep(delay)
+
+    def _update_rate_limit(self, r: Response) -> None:
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        reset = r.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self._rate_limit_remaining = int(remaining)
+            self._rate_limit_reset = float(reset)
+
+    def _is_rate_limited(self, r: Response) -> bool:
+        return r.status == 429 or (r.status == 403 and r.headers.get("X-RateLimit-Remaining") == "0")
+
+    def _request(self, url: str, headers: Dict[str, str], wait: bool = True) -> Response:
+        for _ in range(2):
+            self._wait_for_rate_limit(wait)
+            r = self._pool.request("GET", url, headers)
+            self._update_rate_limit(r)
+            if not self._is_rate_limited(r):
+                return r
+            # the window was used up by someone else (e.g. a parallel CI job)
+            self._logger.debug("GET %s: rate limited", url)
+            if not wait:
+                break
+        raise GithubRateLimitError("GET {}: GitHub API rate limit exceeded".format(url))
+
+    def _get(self, path: str, etag: str = None, wait: bool = True) -> Tuple[int, Optional[Dict], Optional[str]]:
+        headers = self._get_headers()
+        if etag:
+            headers["If-None-Match"] = etag
+        r = self._request(self.API_URL + path, headers, wait)
+        if r.status == 304:
+            return r.status, None, etag
+        if r.status == 404:
+            return r.status, None, None
+        if r.status != 200:
+            raise GithubClientError("GET {}: unexpected status {}".format(path, r.status))
+        return r.status, json.loads(r.body.decode()), r.headers.get("ETag")
+
+    def _get_json(self, path: str) -> Optional[Dict]:
+        """GET with the ETag of the last response of the same path."""
+        with self._lock:
+            etag, cached = self._responses.get(path, (None, None))
+        status, j, etag = self._get(path, etag)
+        if status == 304:
+            return cached
+        if status == 404:
+            return None
+        if etag:
+            with self._lock:
+                self._responses[path] = (etag, j)
+        return j
+
+    def _memoize(self, key: Tuple, func):
+        """Returns func() once per key, threads asking for a key which is
+        being fetched wait for its result instead of fetching it again. A
+        failed fetch isn't memoized.
+        """
+        with self._lock:
+            future = self._memo.get(key)
+            owner = future is None
+            if owner:
+                future = self._memo[key] = Future()
+        if owner:
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                with self._lock:
+                    del self._memo[key]
+                future.set_exception(e)
+        return future.result()
+
+    def get_git_ref(self, repo: str, ref: str, etag: str = None,
+                    wait: bool = True) -> Tuple[int, Optional[Dict], Optional[str]]:
+        """Looks up a single ref like tags/v1.0.0 or heads/master. Returns the
+        status (200, 304 when etag still matches or 404), the ref and its ETag.
+        """
+        return self._get(f"/repos/{repo}/git/ref/{ref}", etag, wait)
+
+    def get_git_tag(self, repo: str, sha: str, wait: bool = True) -> Dict:
+        # tag objects are immutable
+        def fetch():
+            status, tag, _ = self._get(f"/repos/{repo}/git/tags/{sha}", wait=wait)
+            if status != 200:
+                raise GithubClientError("Missing tag object {} in {}".format(sha, repo))
+            return tag
+        return self._memoize(("git_tag", repo, sha), fetch)
+
     def get_tag(self, repo, tag):
         try:
-            r = urlopen(f"https://api.github.com/repos/{repo}/tags")
-            target = [t for t in json.loads(r.read().decode()) if t["name"] == tag]
-            if len(target) == 0:
+            ref = self._get_json(f"/repos/{repo}/git/ref/tags/{tag}")
+            if not ref:
                 return None
-            else:
-                return target[0]["commit"]["sha"]
+            obj = ref["object"]
+            if obj["type"] == "tag":
+                # annotated tag
+                obj = self.get_git_tag(repo, obj["sha"])["object"]
+            return obj["sha"]
         except Exception as e:
             raise RuntimeError(e, "Failed to get GitHub repository {} tag {}".format(repo, tag))
 
     def get_branch_revision(self, repo, branch):
         try:
-            r = urlopen(f"https://api.github.com/repos/{repo}/git/refs/heads/{branch}")
-            return json.loads(r.read().decode())["object"]["sha"]
+            ref = self._get_json(f"/repos/{repo}/git/ref/heads/{branch}")
+            if not ref:
+                raise GithubClientError("No such branch")
+            return ref["object"]["sha"]
         except Exception as e:
             raise RuntimeError(e, "Failed to get GitHub repository {} branch {} revision".format(repo, branch))
 
@@ -38,25 +197,67 @@ class GithubClient:
             return self.get_branch_revision(repo, branch_or_tag)
 
     def get_commit(self, ref: str) -> Dict:
-        r = urlopen(f"https://api.github.com/repos/ExchangeUnion/xud/commits/{ref}")
-        return json.loads(r.read().decode())
+        commit = self._get_json(f"/repos/ExchangeUnion/xud/commits/{ref}")
+        if not commit:
+            raise GithubClientError("No such commit: " + ref)
+        return commit
 
     def get_branches(self, commit: str) -> List[str]:
-        # try to get branches which contain the commit using GitHub undocumented API
-        r = urlopen(f"https://github.com/ExchangeUnion/xud/branch_commits/{commit}")
-        branches = []
-        p = re.compile(r"^.*\"branch\".*>([^<]+)<.*$")
-        for line in r.read().decode().splitlines():
-            m = p.match(line)
-            if m:
-                branches.append(m.group(1))
-        return branches
+        def fetch():
+            # try to get branches which contain the commit using GitHub undocumented API
+            r = self._pool.request("GET", f"https://github.com/ExchangeUnion/xud/branch_commits/{commit}",
+                                   {"User-Agent": "xud-docker"})
+            if r.status != 200:
+                raise GithubClientError("Failed to get the branches of {}: status {}".format(commit, r.status))
+            branches = []
+            p = re.compile(r"^.*\"branch\".*>([^<]+)<.*$")
+            for line in r.body.decode().splitlines():
+                m = p.match(line)
+                if m:
+                    branches.append(m.group(1))
+            return branches
+        return self._memoize(("branches", commit), fetch)
+
+    def get_job_url(self, repo: str, run_id: str, job_name: str) -> Optional[str]:
+        """Returns the web URL of a job of a workflow run. The job list of a
+        run is fetched once and shared by all images and platforms.
+        """
+        def fetch():
+            jobs = {}
+            page = 1
+            while True:
+                j = self._get_json(f"/repos/{repo}/actions/runs/{run_id}/jobs?per_page=100&page={page}")
+                if not j:
+                    break
+                for job in j["jobs"]:
+                    jobs.setdefault(job["name"], job["id"])
+                if len(j["jobs"]) < 100:
+                    break
+                page += 1
+            return jobs
+
+        jobs = self._memoize(("run_jobs", repo, run_id), fetch)
+        if job_name not in jobs:
+            return None
+        return "https://github.com/{}/runs/{}?check_suite_focus=true".format(repo, jobs[job_name])
+
+
+_client: Optional[GithubClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> GithubClient:
+    global _client
+    with _client_lock:
+        if not _client:
+            _client = GithubClient(os.environ.get("GITHUB_TOKEN"), os.environ.get("XUD_DOCKER_GITHUB_API_URL"))
+        return _client
 
 
 class GithubTemplate:
     def __init__(self, context: Context):
         self.context = context
-        self._client = GithubClient()
+        self._client = get_client()
 
     def get_branch_head_revision(self, repo: str, branch: str) -> Optional[str]:
         return self._client.get_revision(repo, branch)
@@ -66,3 +267,6 @@ class GithubTemplate:
 
     def get_branches(self, commit: str) -> List[str]:
         return self._client.get_branches(commit)
+
+    def get_job_url(self, run_id: str, job_name: str) -> Optional[str]:
+        return self._client.get_job_url("ExchangeUnion/xud-docker", run_id, job_name)
@@ -1,23 +1,38 @@
 from __future__ import annotations
 
+import hashlib
+import json
 import logging
 import os
 import sys
-from shutil import copyfile
-from subprocess import CalledProcessError
-from typing import TYPE_CHECKING, List, Optional
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Optional, Dict, Callable, BinaryIO, TextIO, Tuple
 import re
 import importlib
-import threading
 
-from .docker import ManifestList
+from .buildcontext import BuildContext
+from .docker import ManifestList, Manifest
+from .builders import Builder
+from .engine import EventPrinter
+from .scheduler import current_job
 from .src import SourceManager
-from .utils import execute, get_github_job_url
+from .trace import get_tracer
+from .utils import execute, stream_command
 
 if TYPE_CHECKING:
     from .toolkit import Platform, Context
 
 
+@dataclass
+class BuildInputs:
+    application_revision: str
+    dockerfile: str
+    build_args: Dict[str, str]
+    digest: str
+    src_dir: str
+    worktrees: List[str]
+
+
 class Image:
     def __init__(self, context: Context, name: str):
         self.context = context
@@ -68,7 +83,31 @@ class Image:
     def get_shared_dir(self):
         return "{}/shared".format(self.name)
 
-    def get_labels(self, application_revision) -> List[str]:
+    def get_input_digest(self, application_revision: str, dockerfile: str, build_args: Dict[str, str],
+                         platform: Platform) -> str:
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(self.image_folder):
+            # .src and the .src-<version> worktrees are covered by the revision
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".src") and d != "__pycache__")
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                h.update(os.path.relpath(path, self.image_folder).encode())
+                h.update(b"\0")
+                with open(path, "rb") as fp:
+                    h.update(hashlib.sha256(fp.read()).digest())
+        h.update(json.dumps({
+            "application_revision": application_revision,
+            "dockerfile": os.path.relpath(dockerfile, self.image_folder),
+            "build_args": build_args,
+            "platform": str(platform),
+        }, sort_keys=True).encode())
+        return "sha256:" + h.hexdigest()
+
+    def get_labels(self, application_revision, input_digest: str = "") -> List[str]:
+        labels = self.get_label_values(application_revision, input_digest)
+        return [f"--label {key}='{value}'" for key, value in labels.items()]
+
+    def get_label_values(self, application_revision, input_digest: str = "") -> Dict[str, str]:
         image_revision = ""
         image_source = ""
         image_ci = ""
@@ -84,20 +123,21 @@ class Image:
         if "GITHUB_RUN_ID" in os.environ:
             run_id = os.environ["GITHUB_RUN_ID"]
             job_name = os.environ["GITHUB_JOB"]
-            image_ci = get_github_job_url(run_id, job_name)
+            image_ci = self.context.github_template.get_job_url(run_id, job_name)
 
         prefix = self.label_prefix
 
-        return [
-            f"--label {prefix}.image.revision='{image_revision}'",
-            f"--label {prefix}.image.source='{image_source}'",
-            f"--label {prefix}.image.ci='{image_ci}'",
-            f"--label {prefix}.application.revision='{application_revision}'",
+        return {
+            f"{prefix}.image.revision": image_revision,
+            f"{prefix}.image.source": image_source,
+            f"{prefix}.image.ci": image_ci,
+            f"{prefix}.application.revision": application_revision,
+            f"{prefix}.image.input.digest": input_digest,
             # TODO remove labels below
-            f"--label {prefix}.image.branch='master'",
-            f"--label {prefix}.application.branch='master'",
-            "--label {}.image.created={}".format(prefix, self.context.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')),
-        ]
+            f"{prefix}.image.branch": "master",
+            f"{prefix}.application.branch": "master",
+            f"{prefix}.image.created": self.context.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
 
     def print_title(self, title, badge):
         print("-" * 80)
@@ -139,85 +179,171 @@ class Image:
             repo = "connext/rest-api-client"
         return repo
 
-    def _run_command(self, cmd):
-        on_travis = "TRAVIS_BRANCH" in os.environ
-        if on_travis:
-            self._run_command_on_travis(cmd)
-            return
+    def _span(self, name: str, platform: Platform = None):
+        return get_tracer().span(name, image=self.name, tag=self.tag,
+                                 platform=platform.tag_suffix if platform else None)
+
+    def _run_command(self, cmd, stdin: Callable[[BinaryIO], None] = None) -> List[str]:
+        """Streams the output of the command to stdout, or the log of the
+        current job, and returns its last lines.
+        """
+        self._logger.debug("$ %s", cmd)
+        job = current_job()
+        if job:
+            return job.run_command(cmd, stdin)
         print("\033[34m$ %s\033[0m" % cmd, flush=True)
-        exit_code = os.system(cmd)
-        if exit_code != 0:
-            raise RuntimeError("Failed to build (exit_code=%s)" % exit_code)
-
-    def _run_command_on_travis(self, cmd):
-        self._logger.info(cmd)
-
-        stop = threading.Event()
-
-        def f():
-            nonlocal stop
-            counter = 0
-
-            while not stop.is_set():
-                counter = counter + 1
-                print("Still building... ({})".format(counter), flush=True)
-                stop.wait(10)
-
-        threading.Thread(target=f).start()
+        return stream_command(cmd, stdin, [sys.stdout])
+
+    def _get_outputs(self) -> List[TextIO]:
+        """Returns the streams of the output of the current job (see
+        Job.get_outputs), or stdout.
+        """
+        job = current_job()
+        if job:
+            return job.get_outputs()
+        return [sys.stdout]
+
+    def _set_job_args(self, **args) -> None:
+        """Adds args to the span of the current job, they end up in the trace
+        summary and the metrics store (see core.metrics).
+        """
+        job = current_job()
+        if job and job.span:
+            job.span.args.update({key: str(value) for key, value in args.items() if value is not None})
+
+    def get_builder(self, platform: Platform, check: bool = True) -> Builder:
+        """Returns the builder of the platform (see core.builders). The engine
+        backend only reaches daemons with a Unix socket, other platforms are
+        emulated by the local one.
+        """
+        builder = self.context.builders.get(platform, check)
+        if self.context.engine and builder is not self.context.builders.local and not builder.create_engine():
+            self._logger.warning("The engine backend can't use builder %s, emulate %s", builder.spec, platform)
+            return self.context.builders.local
+        return builder
+
+    def _get_image_size(self, tag: str, builder: Builder) -> Optional[int]:
         try:
-            output = execute(cmd)
-            self._logger.debug("$ %s\n%s", cmd, output)
-            stop.set()
-        except CalledProcessError as e:
-            stop.set()
-            print(e.output.decode(), end="", flush=True)
-            raise SystemExit(1)
-        except:
-            stop.set()
-            raise
-
-    def _build(self, args: List[str], build_dir: str, build_tag: str) -> None:
-        cmd = "docker build {} {}".format(" ".join(args), build_dir)
+            if self.context.engine:
+                return builder.create_engine().inspect(tag)["Size"]
+            return int(execute("{} image inspect --format {{{{.Size}}}} {}".format(builder.docker, tag)))
+        except Exception:
+            self._logger.exception("Failed to get the size of %s", tag)
+            return None
+
+    def _write_context(self, build_context: BuildContext, platform: Platform) -> Callable[[BinaryIO], None]:
+        def write(f: BinaryIO) -> None:
+            # runs in the feeder thread, next to the docker build span
+            with self._span("context upload", platform):
+                build_context.write(f)
+        return write
+
+    def _build(self, args: List[str], build_context: BuildContext, build_tag: str, platform: Platform,
+               builder: Builder) -> None:
+        cmd = "{} build {} -".format(builder.docker, " ".join(args))
         # self.run_command(cmd, "Failed to build {}".format(build_tag))
-        self._run_command(cmd)
+        self._run_command(cmd, self._write_context(build_context, platform))
 
-    def _buildx_build(self, args: List[str], build_dir: str, build_tag: str, platform: Platform) -> None:
-        cmd = "docker buildx build --platform {} --progress plain --load {} {}" \
-            .format(platform, " ".join(args), build_dir)
+    def _buildx_build(self, args: List[str], build_context: BuildContext, build_tag: str, platform: Platform,
+                      builder: Builder) -> None:
+        options = builder.get_buildx_args() + ["--platform {}".format(platform), "--progress plain", "--load"]
+        cmd = "{} buildx build {} {} -".format(builder.docker, " ".join(options), " ".join(args))
         # self.run_command(cmd, "Failed to build {}".format(build_tag))
-        self._run_command(cmd)
+        self._run_command(cmd, self._write_context(build_context, platform))
 
-    def build(self, platform: Platform, no_cache: bool) -> None:
-        self._logger.info("Building %s:%s (%s)", self.name, self.tag, platform.tag_suffix)
-
-        print("=" * 80)
-        print("Building %s:%s (%s)" % (self.name, self.tag, platform.tag_suffix))
-        print("=" * 80)
-
-        sys.stdout.flush()
+    def _engine_build(self, build_tag: str, dockerfile: str, inputs: BuildInputs, no_cache: bool,
+                      build_context: BuildContext, platform: Platform, builder: Builder) -> None:
+        printer = EventPrinter(self._get_outputs())
+        try:
+            image_id = builder.create_engine().build(
+                self._write_context(build_context, platform),
+                tag=build_tag,
+                dockerfile=dockerfile,
+                labels=self.get_label_values(inputs.application_revision, inputs.digest),
+                build_args=inputs.build_args,
+                no_cache=no_cache,
+                # other platforms need binfmt emulation like with buildx
+                platform=None if builder.is_native(platform) else str(platform),
+                on_event=printer,
+            )
+        finally:
+            printer.close()
+        self._logger.debug("Built %s (%s)", build_tag, image_id)
 
+    def get_build_inputs(self, platform: Platform) -> BuildInputs:
         source_manager = self.prepare()
+        with self._span("inputs", platform):
+            return self._get_build_inputs(source_manager, platform)
 
-        build_tag = self.get_build_tag(self.branch, platform)
+    def _get_build_inputs(self, source_manager: SourceManager, platform: Platform) -> BuildInputs:
+        application_revision = source_manager.get_application_revision(self.tag)
+        source_dockerfile = source_manager.get_dockerfile(self.tag)
+        build_args = source_manager.get_build_args(self.tag)
+        src_dir = source_manager.src_dir
+        worktrees = source_manager.get_worktrees()
 
-        build_labels = self.get_labels(source_manager.get_application_revision(self.tag))
-        build_dir = "."
+        dockerfile = self.get_dockerfile(self.image_folder, platform, source_dockerfile)
+        digest = self.get_input_digest(application_revision, dockerfile, build_args, platform)
+        return BuildInputs(application_revision, dockerfile, build_args, digest, src_dir, worktrees)
+
+    def is_up_to_date(self, platform: Platform, inputs: BuildInputs) -> bool:
+        tag = self.get_build_tag(self.branch, platform)
+        if tag in self.context.remote_manifests:
+            manifest = self.context.remote_manifests[tag]
+        else:
+            with self._span("manifest lookup", platform):
+                manifest = self.context.docker_template.get_manifest(tag)
+        if not isinstance(manifest, Manifest):
+            return False
+        self._logger.debug("Input digest of %s is %s (local %s)", tag, manifest.input_digest, inputs.digest)
+        return manifest.input_digest == inputs.digest
+
+    def get_cache_tag(self, branch: str, platform: Optional[Platform]) -> str:
+        return self.get_build_tag(branch, platform) + "__cache"
+
+    def get_local_cache_dir(self, branch: str, platform: Optional[Platform]) -> str:
+        repo, tag = self.get_cache_tag(branch, platform).split(":")
+        return os.path.join(self.context.cache_dir, repo, tag)
+
+    def get_cache_args(self, platform: Optional[Platform], no_cache: bool = False, export: bool = False) -> List[str]:
+        """Returns the --cache-from/--cache-to options of buildx. Layers are
+        imported from the cache of the branch and then of master, so the first
+        build of a new branch starts from the master cache, and exported (with
+        mode=max, i.e. the layers of all stages) to the cache of the branch.
+        """
+        branches = [self.branch]
+        if self.branch != "master":
+            branches.append("master")
+
+        args = []
+        if self.context.build_cache == "registry":
+            refs = [self.get_cache_tag(branch, platform) for branch in branches]
+            if not no_cache:
+                args.extend(f"--cache-from type=registry,ref={ref}" for ref in refs)
+            if export:
+                args.append(f"--cache-to type=registry,ref={refs[0]},mode=max")
+        elif self.context.build_cache == "local":
+            dirs = [self.get_local_cache_dir(branch, platform) for branch in branches]
+            if not no_cache:
+                # buildx fails on a local cache which was never exported
+                args.extend(f"--cache-from type=local,src={d}" for d in dirs
+                            if os.path.exists(os.path.join(d, "index.json")))
+            if export:
+                args.append(f"--cache-to type=local,dest={dirs[0]},mode=max")
+        return args
+
+    def _create_build_context(self, inputs: BuildInputs) -> BuildContext:
+        build_dir = self.image_folder
 
         if not os.path.exists(build_dir):
             print("ERROR: Missing build directory: " + build_dir, file=sys.stderr)
             exit(1)
 
-        shared_dir = self.get_shared_dir()
-        shared_files = []
-        if os.path.exists(shared_dir):
-            shared_files = os.listdir(shared_dir)
-            for f in shared_files:
-                copyfile("{}/{}".format(shared_dir, f), "{}/{}".format(build_dir, f))
-
-        dockerfile = self.get_dockerfile(build_dir, platform, source_manager.get_dockerfile(self.tag))
-
-        build_args = [f"--build-arg {key}='{value}'" for key, value in source_manager.get_build_args(self.tag).items()]
+        shared_dir = os.path.join(build_dir, self.get_shared_dir())
+        return BuildContext(build_dir, shared_dir, inputs.src_dir, inputs.worktrees)
 
+    def _get_build_args(self, build_tag: str, inputs: BuildInputs, no_cache: bool, input_digest: str) -> List[str]:
+        dockerfile = os.path.relpath(inputs.dockerfile, self.image_folder)
         args = [
             f"-f {dockerfile}",
             f"-t {build_tag}",
@@ -225,45 +351,147 @@ class Image:
         if no_cache:
             args.append("--no-cache")
 
-        args.extend(build_labels)
-        args.extend(build_args)
+        args.extend(self.get_labels(inputs.application_revision, input_digest))
+        args.extend(f"--build-arg {key}='{value}'" for key, value in inputs.build_args.items())
+        return args
+
+    def build(self, platform: Platform, no_cache: bool, inputs: BuildInputs = None, export_cache: bool = None) -> None:
+        """export_cache defaults to True for a local cache only, tools/build
+        shouldn't write to the registry.
+        """
+        if export_cache is None:
+            export_cache = self.context.build_cache == "local"
+        with self._span("build", platform):
+            self._build_image(platform, no_cache, inputs, export_cache)
+
+    def _build_image(self, platform: Platform, no_cache: bool, inputs: BuildInputs = None,
+                     export_cache: bool = False) -> None:
+        self._logger.info("Building %s:%s (%s)", self.name, self.tag, platform.tag_suffix)
 
-        try:
+        print("=" * 80)
+        print("Building %s:%s (%s)" % (self.name, self.tag, platform.tag_suffix))
+        print("=" * 80)
+
+        sys.stdout.flush()
+
+        if not inputs:
+            inputs = self.get_build_inputs(platform)
+        self._set_job_args(tag=self.tag, input_digest=inputs.digest)
+
+        build_tag = self.get_build_tag(self.branch, platform)
+        build_context = self._create_build_context(inputs)
+        # the Dockerfile is read from the streamed context
+        dockerfile = os.path.relpath(inputs.dockerfile, self.image_folder)
+        args = self._get_build_args(build_tag, inputs, no_cache, inputs.digest)
+
+        builder = self.get_builder(platform)
+        native = builder.is_native(platform)
+        print("Builder: %s (%s)" % (builder.spec, "native" if native else "emulated"), flush=True)
+        self._set_job_args(builder=builder.spec, emulated=None if native else "yes")
+
+        if self.context.engine:
+            if self.context.build_cache != "none":
+                self._logger.warning("The engine backend has no BuildKit cache import/export, ignore --cache")
+            print("\033[34m$ POST /build (%s)\033[0m" % build_tag, flush=True)
+            with self._span("docker build", platform):
+                self._engine_build(build_tag, dockerfile, inputs, no_cache, build_context, platform, builder)
             if self.context.current_platform == platform:
-                self._build(args, build_dir, build_tag)
+                build_tag_without_arch = self.get_build_tag(self.branch, None)
+                with self._span("tag", platform):
+                    builder.create_engine().tag(build_tag, build_tag_without_arch)
+        else:
+            if self.context.build_cache != "none":
+                args.extend(self.get_cache_args(platform, no_cache, export_cache))
 
+            with self._span("docker build", platform):
+                # cache import and export need BuildKit, so with a cache the
+                # native platform is built (and loaded) with buildx as well
+                if native and builder.kind != "buildx" and self.context.build_cache == "none":
+                    self._build(args, build_context, build_tag, platform, builder)
+                else:
+                    self._buildx_build(args, build_context, build_tag, platform, builder)
+
+            if self.context.current_platform == platform:
                 build_tag_without_arch = self.get_build_tag(self.branch, None)
-                cmd = "docker tag {} {}".format(build_tag, build_tag_without_arch)
-                execute(cmd)
-            else:
-                self._buildx_build(args, build_dir, build_tag, platform)
-        finally:
-            for f in shared_files:
-                os.remove("{}/{}".format(build_dir, f))
+                cmd = "{} tag {} {}".format(builder.docker, build_tag, build_tag_without_arch)
+                with self._span("tag", platform):
+                    execute(cmd)
+
+        print("Build context: %.1f MB" % (build_context.size / 1024 / 1024), flush=True)
+        self._set_job_args(context_size=build_context.size, image_size=self._get_image_size(build_tag, builder))
+
+    def create_source_manager(self) -> SourceManager:
+        m = importlib.import_module(f"images.{self.name}.src")
+        if hasattr(m, "SourceManager"):
+            source_manager = m.SourceManager()
+        else:
+            assert hasattr(m, "REPO_URL"), "REPO_URL is required in src.py"
+            repo_url = m.REPO_URL
+            source_manager = SourceManager(repo_url, self.image_folder)
+
+        if self.context.fetch_mode:
+            source_manager.fetch_mode = self.context.fetch_mode
+
+        return source_manager
+
+    def get_refs(self) -> List[Tuple[str, str]]:
+        """Returns the upstream (URL, ref) pairs of this image, without
+        touching the sources.
+        """
+        return self.create_source_manager().get_refs(self.tag)
 
     def prepare(self):
-        self._logger.info("Prepare")
-        try:
-            os.chdir(self.context.project_dir)
-            m = importlib.import_module(f"images.{self.name}.src")
-            os.chdir(self.image_folder)
-            if hasattr(m, "SourceManager"):
-                source_manager = m.SourceManager()
-            else:
-                assert hasattr(m, "REPO_URL"), "REPO_URL is required in src.py"
-                repo_url = m.REPO_URL
-                source_manager = SourceManager(repo_url)
+        key = "{}:{}".format(self.name, self.tag)
+        # the platform jobs of an image share its sources, only the first one
+        # fetches and checks them out
+        with self.context.lock("prepare:" + key):
+            if key in self.context.source_managers:
+                return self.context.source_managers[key]
 
-            version = self.tag
+            self._logger.info("Prepare")
+            with self._span("prepare"):
+                source_manager = self.create_source_manager()
 
-            source_manager.ensure(version)
+                version = self.tag
 
+                source_manager.ensure(version)
+
+            self.context.source_managers[key] = source_manager
             return source_manager
-        finally:
-            os.chdir(self.image_folder)
+
+    def _push_image(self, tag: str, builder: Builder) -> Tuple[str, int]:
+        """Pushes the image from the daemon of the builder which built it and
+        returns the digest and size of the pushed manifest.
+        """
+        if self.context.engine:
+            print("\033[34m$ POST /images/%s/push\033[0m" % tag, flush=True)
+            printer = EventPrinter(self._get_outputs())
+            return builder.create_engine().push(tag, on_event=printer)
+
+        cmd = "{} push {}".format(builder.docker, tag)
+        output = self._run_command(cmd)
+        last_line = output[-1]
+        p = re.compile(r"^(.*): digest: (.*) size: (\d+)$")
+        m = p.match(last_line)
+        assert m
+        assert m.group(1) in tag
+        return m.group(2), int(m.group(3))
 
     def push(self, platform: Platform, no_cache: bool = False, dirty_push: bool = False) -> None:
-        self.build(platform=platform, no_cache=no_cache)
+        with self._span("push", platform):
+            self._push(platform, no_cache, dirty_push)
+
+    def _push(self, platform: Platform, no_cache: bool = False, dirty_push: bool = False) -> None:
+        inputs = self.get_build_inputs(platform)
+        self._set_job_args(tag=self.tag, input_digest=inputs.digest)
+
+        if not no_cache and self.is_up_to_date(platform, inputs):
+            tag = self.get_build_tag(self.branch, platform)
+            print("Skip {} (inputs {} are already pushed)".format(tag, inputs.digest), flush=True)
+            self._set_job_args(skipped="up to date")
+            return
+
+        self.build(platform=platform, no_cache=no_cache, inputs=inputs, export_cache=True)
 
         tag = self.get_build_tag(self.branch, platform)
 
@@ -274,55 +502,178 @@ class Image:
 
         sys.stdout.flush()
 
-        cmd = "docker push {}".format(tag)
-        print("\033[34m$ %s\033[0m" % cmd, flush=True)
-        output = execute(cmd)
-        print("%s" % output.rstrip(), flush=True)
-        last_line = output.splitlines()[-1]
-        p = re.compile(r"^(.*): digest: (.*) size: (\d+)$")
-        m = p.match(last_line)
-        assert m
-        assert m.group(1) in tag
+        with self._span("docker push", platform):
+            digest, size = self._push_image(tag, self.get_builder(platform))
 
-        new_manifest = "{}/{}@{}".format(self.group, self.name, m.group(2))
+        new_manifest = "{}/{}@{}".format(self.group, self.name, digest)
         print("New manifest: %s" % new_manifest, flush=True)
 
-        # append to manifest list
-        os.environ["DOCKER_CLI_EXPERIMENTAL"] = "enabled"
         t0 = self.get_build_tag(self.branch, None)
-        repo, _ = t0.split(":")
-        manifest_list = self.context.docker_template.get_manifest(t0)
-        if manifest_list:
-            assert isinstance(manifest_list, ManifestList)
-            # try to update manifests
-            tags = []
-            for m in manifest_list.manifests:
-                if m.platform != platform:
-                    tags.append("{}@{}".format(repo, m.digest))
-            tags = " ".join(tags)
-            cmd = f"docker manifest create {t0} {new_manifest}"
-
-            if len(tags) > 0:
-                cmd += " " + tags
-            print("\033[34m$ %s\033[0m" % cmd, flush=True)
-            if os.system(cmd) != 0:
-                raise Exception("Failed to create manifest")
-
-            cmd = f"docker manifest push -p {t0}"
-            print("\033[34m$ %s\033[0m" % cmd, flush=True)
-            if os.system(cmd) != 0:
-                raise Exception("Failed to push manifest")
 
+        # the platform jobs of this run take turns to read and write the list,
+        # so they never overwrite each other's entries; the registry client
+        # merges the updates of other processes (see
+        # DockerRegistryClient.update_manifest_list)
+        with self._span("manifest push", platform):
+            list_digest = self.context.docker_template.update_manifest_list(
+                t0, platform, digest, size, self.context.lock("manifest:" + t0))
+        print("Manifest list: {}@{}".format(t0, list_digest), flush=True)
+
+    def get_multi_platform_digest(self, inputs: List[BuildInputs]) -> str:
+        """Returns the input digest of a manifest list built in one go, which
+        is the label of all its platform images.
+        """
+        h = hashlib.sha256("\n".join(sorted(i.digest for i in inputs)).encode())
+        return "sha256:" + h.hexdigest()
+
+    def get_manifest_list(self) -> Optional[ManifestList]:
+        tag = self.get_build_tag(self.branch, None)
+        if tag in self.context.remote_manifests:
+            manifest_list = self.context.remote_manifests[tag]
         else:
-            cmd = f"docker manifest create {t0} {new_manifest}"
-            print("\033[34m$ %s\033[0m" % cmd, flush=True)
-            if os.system(cmd) != 0:
-                raise Exception("Failed to create manifest")
-
-            cmd = f"docker manifest push -p {t0}"
-            print("\033[34m$ %s\033[0m" % cmd, flush=True)
-            if os.system(cmd) != 0:
-                raise Exception("Failed to push manifest")
+            with self._span("manifest lookup"):
+                manifest_list = self.context.docker_template.get_manifest(tag)
+        if not isinstance(manifest_list, ManifestList):
+            return None
+        return manifest_list
+
+    def is_manifest_list_up_to_date(self, platforms: List[Platform], input_digest: str) -> bool:
+        tag = self.get_build_tag(self.branch, None)
+        manifest_list = self.get_manifest_list()
+        if not manifest_list:
+            return False
+        digests = {str(m.platform): m.input_digest for m in manifest_list.manifests}
+        self._logger.debug("Input digests of %s are %s (local %s)", tag, digests, input_digest)
+        return all(digests.get(str(p)) == input_digest for p in platforms)
+
+    def push_platforms(self, platforms: List[Platform], no_cache: bool = False, dirty_push: bool = False) -> None:
+        """Builds all platforms with one buildx invocation which pushes the
+        platform images and the manifest list at once. Nothing is loaded into
+        the local image store and the manifest list isn't read and rewritten,
+        so the platforms don't have to take turns. The per-platform tags are
+        pointed to the new images in the registry afterwards.
+
+        The platforms are pushed one by one (see push) when they can't be
+        built in one go, or when the manifest list has other platforms, which
+        the list pushed by buildx would drop.
+        """
+        with self._span("push"):
+            self._push_platforms(platforms, no_cache, dirty_push)
+
+    def _push_platforms(self, platforms: List[Platform], no_cache: bool = False, dirty_push: bool = False) -> None:
+        inputs = [self.get_build_inputs(p) for p in platforms]
+        builder = self.context.builders.get_common(platforms)
+        manifest_list = self.get_manifest_list()
+        names = {str(p) for p in platforms}
+        others = sorted({str(m.platform) for m in manifest_list.manifests} - names) if manifest_list else []
+
+        # one invocation has one build context, Dockerfile (see
+        # get_dockerfile), set of build args and labels, and one builder
+        reason = None
+        if self.context.engine:
+            reason = "the engine backend has no multi-platform builds"
+        elif not builder:
+            reason = "the platforms have different builders"
+        elif len({(i.application_revision, i.dockerfile, json.dumps(i.build_args, sort_keys=True), i.src_dir)
+                  for i in inputs}) > 1:
+            reason = "the platforms have different build inputs"
+        elif others:
+            reason = "the manifest list has other platforms too: " + ", ".join(others)
+        if reason:
+            print("Push the platforms of %s:%s one by one (%s)" % (self.name, self.tag, reason), flush=True)
+            self._logger.info("Push the platforms of %s:%s one by one (%s)", self.name, self.tag, reason)
+            for p in platforms:
+                self.push(p, no_cache, dirty_push)
+            return
+
+        tag = self.get_build_tag(self.branch, None)
+        input_digest = self.get_multi_platform_digest(inputs)
+        self._set_job_args(tag=self.tag, input_digest=input_digest)
+
+        if not no_cache and self.is_manifest_list_up_to_date(platforms, input_digest):
+            print("Skip {} (inputs {} are already pushed)".format(tag, input_digest), flush=True)
+            self._set_job_args(skipped="up to date")
+            return
+
+        print("=" * 80)
+        print("Building and pushing %s (%s)" % (tag, ", ".join(p.tag_suffix for p in platforms)))
+        print("=" * 80)
+
+        emulated = [p.tag_suffix for p in platforms if not builder.is_native(p)]
+        print("Builder: %s (%s)" % (builder.spec, "emulated " + ", ".join(emulated) if emulated else "native"))
+        self._set_job_args(builder=builder.spec, emulated=",".join(emulated) or None)
+
+        sys.stdout.flush()
+
+        build_context = self._create_build_context(inputs[0])
+        args = self._get_build_args(tag, inputs[0], no_cache, input_digest)
+        if self.context.build_cache != "none":
+            args.extend(self.get_cache_args(None, no_cache, export=True))
+
+        options = builder.get_buildx_args() + ["--platform {}".format(",".join(str(p) for p in platforms)),
+                                               "--progress plain", "--push"]
+        cmd = "{} buildx build {} {} -".format(builder.docker, " ".join(options), " ".join(args))
+        with self._span("docker build"):
+            self._run_command(cmd, self._write_context(build_context, None))
+
+        targets = {str(p): self.get_build_tag(self.branch, p) for p in platforms}
+        with self._span("manifest push"):
+            self.context.docker_template.tag_platforms(tag, targets)
+        print("Tagged {}".format(", ".join(targets.values())), flush=True)
+
+        print("Build context: %.1f MB" % (build_context.size / 1024 / 1024), flush=True)
+        # the images are pushed without loading them, so their size is unknown
+        self._set_job_args(context_size=build_context.size)
+
+    def verify_release(self, source: str, platforms: List[Platform]) -> None:
+        """Checks that the images of the manifest list source were built from
+        the inputs of this tree, i.e. the release ships what was tested.
+        """
+        with self._span("manifest lookup"):
+            manifest_list = self.context.docker_template.get_manifest(source)
+        if not isinstance(manifest_list, ManifestList):
+            raise Exception("Missing manifest list {}".format(source))
+        inputs = {str(p): self.get_build_inputs(p) for p in platforms}
+        # the input digest of a push --multi-platform covers all platforms
+        multi_platform_digest = self.get_multi_platform_digest(list(inputs.values()))
+        found = {str(m.platform): m for m in manifest_list.manifests}
+        for p in platforms:
+            m = found.get(str(p))
+            if not m:
+                raise Exception("Missing platform {} in {}".format(p, source))
+            if m.input_digest not in (inputs[str(p)].digest, multi_platform_digest):
+                raise Exception("Inputs of {} ({}) are {}, not {}".format(
+                    source, p, m.input_digest, inputs[str(p)].digest))
+
+    def release(self, source_branch: str, tags: List[str] = None, verify: bool = True,
+                source_group: str = None) -> None:
+        """Copies the manifest list of the branch to the release tag (and
+        tags) in the registry, without building anything.
+        """
+        with self._span("release"):
+            self._release(source_branch, tags or [], verify, source_group)
+
+    def _release(self, source_branch: str, tags: List[str], verify: bool, source_group: Optional[str]) -> None:
+        source = self.get_build_tag(source_branch, None)
+        if source_group:
+            source = source_group + source[len(self.group):]
+        targets = [self.get_build_tag("master", None)]
+        for tag in tags:
+            target = "{}/{}:{}".format(self.group, self.name, tag)
+            if target not in targets:
+                targets.append(target)
+        if source in targets:
+            raise Exception("Cannot release {} onto itself".format(source))
+
+        if verify:
+            self.verify_release(source, self.context.platforms)
+
+        print("\033[34m$ copy {} {}\033[0m".format(source, " ".join(targets)), flush=True)
+        if self.context.dry_run:
+            return
+        with self._span("manifest push"):
+            digest = self.context.docker_template.copy_manifest(source, targets)
+        print("Released {}@{} as {}".format(source, digest, ", ".join(targets)), flush=True)
 
     def __repr__(self):
         return "<Image name=%r tag=%r branch=%r>" % (self.name, self.tag, self.branch)
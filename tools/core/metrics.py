@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from contextlib import closing
+from datetime import timezone
+from typing import Dict, List, Optional, Tuple
+
+from .trace import Tracer
+from .utils import get_cache_dir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    branch TEXT,
+    revision TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    image TEXT NOT NULL,
+    tag TEXT,
+    platform TEXT,
+    input_digest TEXT,
+    status TEXT,
+    up_to_date INTEGER NOT NULL DEFAULT 0,
+    duration REAL NOT NULL,
+    context_size INTEGER,
+    image_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs(name);
+CREATE INDEX IF NOT EXISTS jobs_image ON jobs(image, platform);
+"""
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    k = (len(values) - 1) * p
+    i = int(k)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (k - i)
+
+
+class MetricsStore:
+    """The durations and outcomes of past runs in a local SQLite database: one
+    row per run, per scheduler job (image, tag, platform, input digest, status,
+    context and image size) and per phase of a job, all taken from the spans
+    of the tracer.
+    """
+
+    # the number of recent runs of a job its duration is estimated from
+    RECENT = 5
+
+    def __init__(self, path: str):
+        self._logger = logging.getLogger("core.MetricsStore")
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def record(self, command: str, tracer: Tracer, branch: str = None, revision: str = None) -> int:
+        """Stores the jobs of the run traced by tracer and returns the run
+        ID. A phase belongs to the job span which runs it on the same thread,
+        or to the job of its image and platform (e.g. the context upload in
+        the feeder thread of a build).
+        """
+        spans = tracer.spans
+        jobs = [s for s in spans if s.category == "job"]
+        started_at = tracer.started_at.replace(tzinfo=timezone.utc).timestamp()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT INTO runs (command, started_at, duration, branch, revision) VALUES (?, ?, ?, ?, ?)",
+                (command, started_at, max([s.end or 0 for s in spans], default=0), branch, revision))
+            run_id = cursor.lastrowid
+            for job in jobs:
+                args = job.args
+                image, _, suffix = job.name.partition("@")
+                cursor = conn.execute(
+                    "INSERT INTO jobs (run_id, name, image, tag, platform, input_digest, status, up_to_date,"
+                    " duration, context_size, image_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, job.name, args.get("image", image), args.get("tag"), args.get("platform", suffix),
+                     args.get("input_digest"), args.get("status"), "skipped" in args, job.duration,
+                     args.get("context_size"), args.get("image_size")))
+                job_id = cursor.lastrowid
+                phases: Dict[str, Tuple[int, float]] = {}
+                for s in spans:
+                    if s.category == "job" or s.start < job.start or s.end is None or s.end > job.end:
+                        continue
+                    if s.thread_id == job.thread_id or \
+                            (s.args.get("image"), s.args.get("platform")) == (image, suffix):
+                        count, total = phases.get(s.name, (0, 0.0))
+                        phases[s.name] = (count + 1, total + s.duration)
+                conn.executemany("INSERT INTO phases (job_id, name, count, duration) VALUES (?, ?, ?, ?)",
+                                 [(job_id, name, count, total) for name, (count, total) in phases.items()])
+        self._logger.debug("Recorded %d jobs of %s as run %d", len(jobs), command, run_id)
+        return run_id
+
+    def get_durations(self, jobs: Dict[str, bool], commands: List[str]) -> Dict[str, Optional[float]]:
+        """Returns the expected duration of every job name of jobs (-> whether
+        it is expected to be skipped as up to date): the median of its recent
+        runs by the first of commands which ran it, else the median of the
+        jobs with the same suffix (e.g. all @aarch64 builds), else None. Jobs
+        which were skipped are only compared with skipped jobs and the other
+        way round.
+        """
+        if not os.path.exists(self.path):
+            return {name: None for name in jobs}
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT runs.command, jobs.name, jobs.up_to_date, jobs.duration FROM jobs"
+                " JOIN runs ON runs.id = jobs.run_id WHERE jobs.status = 'done'"
+                " ORDER BY runs.started_at DESC").fetchall()
+        # (command, name, up_to_date) -> recent durations
+        recorded: Dict[Tuple[str, str, bool], List[float]] = {}
+        for command, name, up_to_date, duration in rows:
+            durations = recorded.setdefault((command, name, bool(up_to_date)), [])
+            if len(durations) < self.RECENT:
+                durations.append(duration)
+
+        result = {}
+        for name, skip in jobs.items():
+            result[name] = None
+            suffix = name.partition("@")[2]
+            for command in commands:
+                durations = recorded.get((command, name, skip))
+                if not durations:
+                    durations = [statistics.median(d) for (c, n, s), d in recorded.items()
+                                 if c == command and s == skip and n.partition("@")[2] == suffix]
+                if durations:
+                    result[name] = statistics.median(durations)
+                    break
+        return result
+
+    def _query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        if not os.path.exists(self.path):
+            return []
+        with closing(self._connect()) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def slowest(self, command: str = None, since: float = 0, limit: int = 10) -> List[Tuple]:
+        """Returns (image, platform, runs, median, max) of the image jobs
+        which weren't skipped, slowest median first.
+        """
+        rows = self._query(
+            "SELECT jobs.image, jobs.platform, jobs.duration FROM jobs JOIN runs ON runs.id = jobs.run_id"
+            " WHERE jobs.status = 'done' AND NOT jobs.up_to_date AND jobs.platform != 'source'"
+            " AND runs.started_at >= ? AND (? IS NULL OR runs.command = ?)",
+            (since, command, command))
+        groups: Dict[Tuple[str, str], List[float]] = {}
+        for image, platform, duration in rows:
+            groups.setdefault((image, platform), []).append(duration)
+        result = [(image, platform, len(d), statistics.median(d), max(d)) for (image, platform), d in groups.items()]
+        return sorted(result, key=lambda r: -r[3])[:limit]
+
+    def percentiles(self, image: str, platform: str = None, command: str = None, since: float = 0,
+                    period: str = "day") -> List[Tuple]:
+        """Returns (period, runs, p50, p95) of the jobs of image which weren't
+        skipped, grouped by day or week.
+        """
+        rows = self._query(
+            "SELECT runs.started_at, jobs.duration FROM jobs JOIN runs ON runs.id = jobs.run_id"
+            " WHERE jobs.image = ? AND jobs.status = 'done' AND NOT jobs.up_to_date AND jobs.platform != 'source'"
+            " AND (? IS NULL OR jobs.platform = ?) AND (? IS NULL OR runs.command = ?) AND runs.started_at >= ?"
+            " ORDER BY runs.started_at",
+            (image, platform, platform, command, command, since))
+        fmt = "%G-W%V" if period == "week" else "%Y-%m-%d"
+        groups: Dict[str, List[float]] = {}
+        for started_at, duration in rows:
+            groups.setdefault(time.strftime(fmt, time.localtime(started_at)), []).append(duration)
+        return [(key, len(d), _percentile(d, 0.5), _percentile(d, 0.95)) for key, d in groups.items()]
+
+    def regressions(self, image: str, platform: str = None, command: str = None,
+                    factor: float = 1.5) -> List[Tuple]:
+        """Returns (revision, previous revision, median, previous median) for
+        every project revision whose jobs of image took at least factor times
+        as long as those of the revision built before it.
+        """
+        rows = self._query(
+            "SELECT runs.revision, jobs.duration FROM jobs JOIN runs ON runs.id = jobs.run_id"
+            " WHERE jobs.image = ? AND jobs.status = 'done' AND NOT jobs.up_to_date AND jobs.platform != 'source'"
+            " AND (? IS NULL OR jobs.platform = ?) AND (? IS NULL OR runs.command = ?)"
+            " ORDER BY runs.started_at",
+            (image, platform, platform, command, command))
+        # revisions in the order they were first built
+        groups: Dict[str, List[float]] = {}
+        for revision, duration in rows:
+            groups.setdefault(revision or "?", []).append(duration)
+        result = []
+        previous = None
+        for revision, durations in groups.items():
+            median = statistics.median(durations)
+            if previous and median >= previous[1] * factor:
+                result.append((revision, previous[0], median, previous[1]))
+            previous = (revision, median)
+        return result
+
+
+_store: Optional[MetricsStore] = None
+_store_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsStore:
+    global _store
+    with _store_lock:
+        if not _store:
+            _store = MetricsStore(os.environ.get("XUD_DOCKER_METRICS_DB") or get_cache_dir("metrics.db"))
+        return _store
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .scheduler import Scheduler
+
+
+@dataclass
+class Step:
+    """What a job of the scheduler would do: fetch, build, push or skip."""
+    action: str
+    notes: List[str] = field(default_factory=list)
+
+
+class Plan:
+    """The job graph of a build or push, printed instead of run. The wall-clock
+    time is estimated from the expected durations of the jobs (see
+    core.metrics) by simulating the scheduler, and the jobs of the critical
+    path are marked with a "*".
+    """
+
+    def __init__(self, scheduler: Scheduler):
+        self.scheduler = scheduler
+        self.steps: Dict[str, Step] = {}
+        # image name -> lines printed above its jobs
+        self.images: Dict[str, List[str]] = {}
+
+    def add(self, job: str, action: str, notes: List[str] = None) -> None:
+        self.steps[job] = Step(action, notes or [])
+
+    def print(self, expected: Dict[str, Optional[float]]) -> None:
+        """Prints the plan, expected maps job names to their duration or None
+        if it is unknown.
+        """
+        jobs = self.scheduler.get_jobs()
+        durations = {job.name: expected.get(job.name) or 0.0 for job in jobs}
+        unknown = [job.name for job in jobs if expected.get(job.name) is None]
+        self.scheduler.prioritize(durations)
+        times = self.scheduler.estimate(durations)
+        path = self.scheduler.critical_path(durations)
+        critical = {job.name for job in path}
+
+        pools = ", ".join("{} {}".format(size, name) for name, size in self.scheduler.pools.items())
+        print("Plan ({} jobs, workers: {})".format(len(jobs), pools))
+        image = None
+        for job in jobs:
+            name = job.name.split("@")[0]
+            if name != image:
+                image = name
+                print()
+                print(name)
+                for line in self.images.get(name, []):
+                    print("    " + line)
+            step = self.steps.get(job.name) or Step("run")
+            start, end = times[job.name]
+            if job.name in unknown:
+                duration = "?"
+            else:
+                duration = "%.1fs" % durations[job.name]
+            print("  {} {:<32} {:<6} {:>8} {:>8}".format(
+                "*" if job.name in critical else " ", job.name, step.action, "+%.1fs" % start, duration))
+            for note in step.notes:
+                print("      " + note)
+
+        print()
+        total = max([end for _, end in times.values()], default=0.0)
+        print("Estimated wall-clock time: %.1fs" % total)
+        print("Critical path (%.1fs): %s" % (
+            sum(durations[job.name] for job in path), " -> ".join(job.name for job in path)))
+        if unknown:
+            print("No recorded duration of %d jobs, counted as 0s: %s" % (len(unknown), ", ".join(unknown)))
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from subprocess import CalledProcessError
+from typing import Dict, List, Optional, Tuple
+
+from .github import GithubClient, GithubRateLimitError, get_client
+from .utils import execute, get_cache_dir
+
+
+@dataclass
+class ResolvedRef:
+    sha: str
+    # full name, e.g. refs/tags/v0.11.1-beta
+    name: str
+    checked_at: float
+    etag: Optional[str] = None
+
+
+class RefResolver:
+    """Resolves branches and tags of upstream repositories to commits.
+
+    Results are kept in a JSON file for `ttl` seconds. After that a GitHub ref
+    is revalidated with its ETag (a 304 doesn't count against the rate limit);
+    other repositories, or GitHub when the API fails or its rate limit is
+    (almost) used up, are asked with git ls-remote.
+    """
+
+    def __init__(self, cache_file: str, ttl: float = 300, github: GithubClient = None, max_workers: int = 16):
+        self._logger = logging.getLogger("core.RefResolver")
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.github = github or get_client()
+        self.max_workers = max_workers
+        self._cache: Dict[str, ResolvedRef] = self._load()
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    def _load(self) -> Dict[str, ResolvedRef]:
+        try:
+            with open(self.cache_file) as f:
+                return {key: ResolvedRef(**value) for key, value in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def _save(self) -> None:
+        with self._lock:
+            data = {key: asdict(value) for key, value in self._cache.items()}
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.cache_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.cache_file)
+
+    def _get_key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _get_github_repo(self, repo_url: str) -> Optional[str]:
+        m = re.match(r"^https://github\.com/([^/]+/[^/]+?)(\.git)?/?$", repo_url)
+        if m:
+            return m.group(1)
+        return None
+
+    def _resolve_github(self, repo: str, ref: str, entry: Optional[ResolvedRef]) -> Optional[ResolvedRef]:
+        if entry:
+            names = [entry.name]
+        else:
+            names = [f"refs/tags/{ref}", f"refs/heads/{ref}"]
+        for name in names:
+            etag = entry.etag if entry and entry.name == name else None
+            # no waiting for the rate limit, git ls-remote answers as well
+            status, j, etag = self.github.get_git_ref(repo, name[len("refs/"):], etag, wait=False)
+            if status == 304:
+                return ResolvedRef(entry.sha, name, time.time(), etag)
+            if status == 404:
+                continue
+            obj = j["object"]
+            sha = obj["sha"]
+            if obj["type"] == "tag":
+                # annotated tag
+                sha = self.github.get_git_tag(repo, sha, wait=False)["object"]["sha"]
+            return ResolvedRef(sha, name, time.time(), etag)
+        return None
+
+    def _ls_remote(self, repo_url: str, ref: str) -> Optional[ResolvedRef]:
+        cmd = f"git ls-remote {repo_url} refs/tags/{ref} 'refs/tags/{ref}^{{}}' refs/heads/{ref}"
+        output = execute(cmd)
+        self._logger.debug("$ %s\n%s", cmd, output)
+        refs = {}
+        for line in output.splitlines():
+            sha, name = line.split()
+            refs[name] = sha
+        if f"refs/tags/{ref}^{{}}" in refs:
+            # annotated tag
+            return ResolvedRef(refs[f"refs/tags/{ref}^{{}}"], f"refs/tags/{ref}", time.time())
+        for name in [f"refs/tags/{ref}", f"refs/heads/{ref}"]:
+            if name in refs:
+                return ResolvedRef(refs[name], name, time.time())
+        return None
+
+    def _resolve(self, repo_url: str, ref: str) -> Optional[ResolvedRef]:
+        key = f"{repo_url}#{ref}"
+        with self._get_key_lock(key):
+            entry = self._cache.get(key)
+            if entry and time.time() - entry.checked_at < self.ttl:
+                return entry
+
+            result = None
+            repo = self._get_github_repo(repo_url)
+            if repo:
+                try:
+                    result = self._resolve_github(repo, ref, entry)
+                except GithubRateLimitError as e:
+                    self._logger.debug("Resolve %s in %s with git ls-remote: %s", ref, repo, e)
+                except Exception:
+                    self._logger.debug("Failed to resolve %s in %s with the GitHub API", ref, repo, exc_info=True)
+            if not result:
+                try:
+                    result = self._ls_remote(repo_url, ref)
+                except CalledProcessError:
+                    self._logger.exception("Failed to resolve %s in %s", ref, repo_url)
+
+            if result:
+                self._logger.debug("Resolved %s in %s to %s (%s)", ref, repo_url, result.sha, result.name)
+                with self._lock:
+                    self._cache[key] = result
+            return result
+
+    def resolve(self, repo_url: str, ref: str) -> Optional[ResolvedRef]:
+        result = self._resolve(repo_url, ref)
+        self._save()
+        return result
+
+    def resolve_all(self, refs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[ResolvedRef]]:
+        """Resolves many (repo_url, ref) pairs in one parallel round."""
+        refs = list(dict.fromkeys(refs))
+        if not refs:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(refs))) as executor:
+            results = list(executor.map(lambda item: self._resolve(*item), refs))
+        self._save()
+        return dict(zip(refs, results))
+
+
+_resolver: Optional[RefResolver] = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver() -> RefResolver:
+    global _resolver
+    with _resolver_lock:
+        if not _resolver:
+            ttl = float(os.environ.get("XUD_DOCKER_REFS_TTL", "300"))
+            _resolver = RefResolver(get_cache_dir("refs.json"), ttl)
+        return _resolver
@@ -0,0 +1,407 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from subprocess import CalledProcessError
+from typing import Callable, Dict, List, Optional, TextIO, BinaryIO, Tuple
+
+from .trace import get_tracer, Span
+from .utils import stream_command
+
+_local = threading.local()
+# lines written to the original stdout by jobs and the scheduler
+_stdout_lock = threading.Lock()
+
+
+def current_job() -> Optional[Job]:
+    return getattr(_local, "job", None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _summarize(error: Optional[BaseException]) -> str:
+    return "".join(traceback.format_exception_only(type(error), error)).strip() if error else "?"
+
+
+def _format_error(error: BaseException) -> str:
+    return "".join(traceback.format_exception(type(error), error, error.__traceback__))
+
+
+class SchedulerError(Exception):
+    def __init__(self, failed: List[Job]):
+        super().__init__("Failed jobs: " + ", ".join(
+            "{} ({})".format(job.name, _summarize(job.error)) for job in failed))
+        self.failed = failed
+
+
+class Job:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    SKIPPED = "skipped"
+
+    def __init__(self, name: str, target: Callable[[], None], deps: List[Job] = None, pool: str = "default"):
+        self.name = name
+        self.target = target
+        self.deps = deps or []
+        self.pool = pool
+        self.status = Job.PENDING
+        self.error: Optional[BaseException] = None
+        self.log_file: Optional[str] = None
+        self.log: Optional[TextIO] = None
+        self.cancelled = threading.Event()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.span: Optional[Span] = None
+        # jobs which are ready start in the order of priority (highest first)
+        self.priority = 0.0
+
+    @property
+    def duration(self) -> float:
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def get_outputs(self) -> List[TextIO]:
+        """Returns the streams the output of a command of the job goes to."""
+        if self.log:
+            return [self.log, _PrefixWriter(self.name)]
+        return [sys.stdout]
+
+    def run_command(self, cmd: str, stdin: Callable[[BinaryIO], None] = None) -> List[str]:
+        """Run a shell command whose output goes to the job log and to stdout
+        (each line prefixed with the job name), or only to stdout when the job
+        has no log, and which is terminated when the job is cancelled. stdin,
+        if given, writes the input of the command. Returns the last lines of
+        the output.
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled(self.name)
+        outputs = self.get_outputs()
+        if self.log:
+            for f in outputs:
+                f.write("$ %s\n" % cmd)
+                f.flush()
+        else:
+            print("\033[34m$ %s\033[0m" % cmd, flush=True)
+        try:
+            return stream_command(cmd, stdin, outputs, cancelled=self.cancelled)
+        except CalledProcessError:
+            if self.cancelled.is_set():
+                raise JobCancelled(self.name)
+            raise
+
+    def tail(self, size: int = 4096) -> str:
+        if not self.log_file or not os.path.exists(self.log_file):
+            return ""
+        with open(self.log_file, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - size))
+            return f.read().decode(errors="replace")
+
+    def __repr__(self):
+        return "<Job name=%r status=%r>" % (self.name, self.status)
+
+
+class _PrefixWriter:
+    """Writes the output of a job to the original stdout, every line
+    prefixed with the job name so that the lines of parallel jobs can be told
+    apart.
+    """
+
+    def __init__(self, name: str):
+        self._prefix = "[%s] " % name
+        self._line_start = True
+
+    def write(self, s: str) -> int:
+        parts = []
+        for line in s.splitlines(keepends=True):
+            if self._line_start:
+                parts.append(self._prefix)
+            parts.append(line)
+            self._line_start = line.endswith("\n")
+        with _stdout_lock:
+            sys.__stdout__.write("".join(parts))
+        return len(s)
+
+    def flush(self) -> None:
+        with _stdout_lock:
+            sys.__stdout__.flush()
+
+
+class _JobStream:
+    """Routes writes to the log of the job running in the current thread and
+    everything else to the original stream.
+    """
+
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+
+    def _target(self) -> TextIO:
+        job = current_job()
+        if job and job.log:
+            return job.log
+        return self._stream
+
+    def write(self, s: str) -> int:
+        return self._target().write(s)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def __getattr__(self, item):
+        return getattr(self._stream, item)
+
+
+class Scheduler:
+    """Runs jobs once all their dependencies are done. Every job runs in one
+    of the worker pools, "default" has `jobs` workers and extra pools (e.g. for
+    network bound work next to CPU bound builds) are given as name -> size.
+
+    A job waits for a free worker of its pool in the scheduler, not in the
+    queue of the pool, so that the ready job with the highest priority is the
+    next to start (see prioritize()).
+    """
+
+    def __init__(self, jobs: int = 1, keep_going: bool = False, log_dir: Optional[str] = None,
+                 pools: Dict[str, int] = None):
+        self._logger = logging.getLogger("core.Scheduler")
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+        self.log_dir = log_dir
+        self.pools = {"default": self.jobs}
+        for name, size in (pools or {}).items():
+            self.pools[name] = max(1, size)
+        self._jobs: List[Job] = []
+
+    def add(self, name: str, target: Callable[[], None], deps: List[Job] = None, pool: str = "default") -> Job:
+        assert pool in self.pools, "Unknown pool: " + pool
+        job = Job(name, target, deps, pool)
+        self._jobs.append(job)
+        return job
+
+    def get_jobs(self) -> List[Job]:
+        return list(self._jobs)
+
+    def prioritize(self, durations: Dict[str, float]) -> None:
+        """Sets the priority of every job to the time it takes from its start
+        to the end of the run with unlimited workers (its duration plus the
+        longest chain of jobs depending on it), so the longest jobs, and the
+        jobs the longest jobs wait for, start first.
+        """
+        dependents: Dict[str, List[Job]] = {job.name: [] for job in self._jobs}
+        for job in self._jobs:
+            for dep in job.deps:
+                dependents[dep.name].append(job)
+        # add() only takes jobs which were added before as dependencies
+        for job in reversed(self._jobs):
+            job.priority = durations.get(job.name, 0.0) + max(
+                [d.priority for d in dependents[job.name]], default=0.0)
+
+    def _next_ready(self, ready: List[Job], running: Dict[str, int]) -> Optional[Job]:
+        """Returns the ready job with the highest priority whose pool has a
+        free worker, the first added one of equal priorities.
+        """
+        candidates = [job for job in ready if running[job.pool] < self.pools[job.pool]]
+        return max(candidates, key=lambda j: j.priority, default=None)
+
+    def estimate(self, durations: Dict[str, float]) -> Dict[str, Tuple[float, float]]:
+        """Simulates a run in which every job takes durations[job.name]
+        seconds (0 if unknown) and returns job name -> (start, end). Like
+        run(), a job starts once its dependencies are done and a worker of
+        its pool is free, in the order of priority.
+        """
+        running = {name: 0 for name in self.pools}
+        # (end, sequence, job)
+        events: List[Tuple[float, int, Job]] = []
+        done = set()
+        times: Dict[str, Tuple[float, float]] = {}
+        pending = list(self._jobs)
+        now = 0.0
+        while pending or events:
+            ready = [job for job in pending if all(dep.name in done for dep in job.deps)]
+            job = self._next_ready(ready, running)
+            while job:
+                pending.remove(job)
+                ready.remove(job)
+                running[job.pool] += 1
+                times[job.name] = (now, now + durations.get(job.name, 0.0))
+                heapq.heappush(events, (times[job.name][1], len(times), job))
+                job = self._next_ready(ready, running)
+            if not events:
+                raise SchedulerError(pending)
+            now, _, job = heapq.heappop(events)
+            done.add(job.name)
+            running[job.pool] -= 1
+        return times
+
+    def critical_path(self, durations: Dict[str, float]) -> List[Job]:
+        """Returns the chain of dependent jobs which takes the longest, i.e.
+        the wall-clock time of the run with unlimited workers.
+        """
+        finish: Dict[str, float] = {}
+        previous: Dict[str, Optional[Job]] = {}
+        # add() only takes jobs which were added before as dependencies
+        for job in self._jobs:
+            dep = max(job.deps, key=lambda d: finish[d.name], default=None)
+            previous[job.name] = dep
+            finish[job.name] = (finish[dep.name] if dep else 0.0) + durations.get(job.name, 0.0)
+        if not finish:
+            return []
+        job = max(self._jobs, key=lambda j: finish[j.name])
+        path = []
+        while job:
+            path.insert(0, job)
+            job = previous[job.name]
+        return path
+
+    def _get_log_file(self, job: Job) -> str:
+        name = job.name.replace("/", "-").replace(":", "__").replace("@", "__")
+        return os.path.join(self.log_dir, name + ".log")
+
+    def _has_log(self, job: Job) -> bool:
+        # with one worker the jobs of the default pool write to stdout, the
+        # jobs of other pools run next to them and write to their logs
+        return bool(self.log_dir) and (self.jobs > 1 or job.pool != "default")
+
+    def _run_job(self, job: Job) -> None:
+        _local.job = job
+        try:
+            if self._has_log(job):
+                job.log_file = self._get_log_file(job)
+                job.log = open(job.log_file, "w")
+            job.started_at = time.time()
+            with get_tracer().span(job.name, "job", pool=job.pool) as span:
+                job.span = span
+                job.target()
+        except JobCancelled:
+            raise
+        except Exception as e:
+            # the log of a failed job ends with why it failed
+            if job.log:
+                job.log.write(_format_error(e))
+            raise
+        finally:
+            job.finished_at = time.time()
+            _local.job = None
+            if job.log:
+                job.log.close()
+                job.log = None
+
+    def _print(self, msg: str) -> None:
+        with _stdout_lock:
+            print(msg, file=sys.__stdout__, flush=True)
+
+    def _report(self, job: Job, finished: int) -> None:
+        if job.span:
+            job.span.args["status"] = job.status
+        total = len(self._jobs)
+        msg = "[%d/%d] %s %s in %.1fs" % (finished, total, job.name, job.status, job.duration)
+        if job.log_file:
+            msg += " (log: %s)" % job.log_file
+        self._print(msg)
+        if job.status == Job.FAILED:
+            if job.log_file:
+                tail = job.tail().rstrip()
+                if tail:
+                    self._print(tail)
+            elif job.error:
+                self._print(_format_error(job.error).rstrip())
+
+    def _cancel_all(self, futures: Dict[Future, Job]) -> None:
+        for job in self._jobs:
+            job.cancelled.set()
+        for future, job in futures.items():
+            if future.cancel():
+                job.status = Job.CANCELLED
+
+    def run(self) -> List[Job]:
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        stdout = sys.stdout
+        if self.log_dir:
+            sys.stdout = _JobStream(stdout)
+
+        pending = list(self._jobs)
+        ready: List[Job] = []
+        running = {name: 0 for name in self.pools}
+        futures: Dict[Future, Job] = {}
+        finished = 0
+        stopping = False
+
+        try:
+            with ExitStack() as stack:
+                executors = {}
+                for name, size in self.pools.items():
+                    executors[name] = stack.enter_context(
+                        ThreadPoolExecutor(max_workers=size, thread_name_prefix="job-" + name))
+                while pending or ready or futures:
+                    if not stopping:
+                        for job in list(pending):
+                            if any(dep.status in (Job.FAILED, Job.CANCELLED, Job.SKIPPED) for dep in job.deps):
+                                pending.remove(job)
+                                job.status = Job.SKIPPED
+                                finished += 1
+                                self._report(job, finished)
+                            elif all(dep.status == Job.DONE for dep in job.deps):
+                                pending.remove(job)
+                                ready.append(job)
+                        job = self._next_ready(ready, running)
+                        while job:
+                            ready.remove(job)
+                            running[job.pool] += 1
+                            job.status = Job.RUNNING
+                            futures[executors[job.pool].submit(self._run_job, job)] = job
+                            job = self._next_ready(ready, running)
+                    else:
+                        for job in pending + ready:
+                            job.status = Job.CANCELLED
+                        pending = []
+                        ready = []
+
+                    if not futures:
+                        break
+
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = futures.pop(future)
+                        running[job.pool] -= 1
+                        if future.cancelled():
+                            job.status = Job.CANCELLED
+                            continue
+                        error = future.exception()
+                        if error is None:
+                            job.status = Job.DONE
+                        elif isinstance(error, JobCancelled):
+                            job.status = Job.CANCELLED
+                        else:
+                            job.status = Job.FAILED
+                            job.error = error
+                            self._logger.error("Job %s failed", job.name, exc_info=error)
+                        finished += 1
+                        self._report(job, finished)
+                        if job.status == Job.FAILED and not self.keep_going and not stopping:
+                            stopping = True
+                            self._cancel_all(futures)
+        except KeyboardInterrupt:
+            self._cancel_all(futures)
+            raise
+        finally:
+            sys.stdout = stdout
+
+        failed = [job for job in self._jobs if job.status == Job.FAILED]
+        if failed:
+            raise SchedulerError(failed) from failed[0].error
+        return self._jobs
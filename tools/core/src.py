@@ -1,53 +1,109 @@
 from subprocess import check_output, CalledProcessError, PIPE, STDOUT
+from typing import Optional, Tuple, Dict, List
+from urllib.parse import urlsplit
 import os
+import re
 import shutil
 import logging
-from .utils import execute
+import sys
+import threading
+from .refs import get_resolver
+from .trace import get_tracer
+from .utils import execute, get_cache_dir
 
 
 class SourceManager:
-    def __init__(self, repo_url):
+    # full: fetch all branches and tags of the upstream repository
+    # shallow: fetch only the commit of the ref (--depth 1)
+    # blobless: fetch the history of the ref without file contents (--filter=blob:none)
+    FETCH_MODES = ["full", "shallow", "blobless"]
+
+    # upstream URL -> lock of its mirror
+    _mirror_locks: Dict[str, threading.Lock] = {}
+    _mirror_locks_lock = threading.Lock()
+
+    def __init__(self, repo_url, work_dir=None):
         self.repo_url = repo_url
-        self.src_dir = os.path.abspath(".src")
+        if not work_dir:
+            # the image folder is the one of the src.py which subclasses us
+            module = sys.modules[type(self).__module__]
+            if module is sys.modules[__name__]:
+                raise ValueError("work_dir is required")
+            work_dir = os.path.dirname(os.path.abspath(module.__file__))
+        self.work_dir = work_dir
+        self.src_dir = os.path.join(self.work_dir, ".src")
         self.logger = logging.getLogger("core.SourceManager")
+        self.fetch_mode = os.environ.get("XUD_DOCKER_FETCH_MODE", "shallow")
+        # source directory -> upstream URL
+        self._repos: Dict[str, str] = {}
+
+    def get_src_dir(self, version):
+        # every version has its own worktree, so that building several
+        # versions of an image doesn't fight over one checkout
+        if version == "latest":
+            return os.path.join(self.work_dir, ".src")
+        else:
+            return os.path.join(self.work_dir, ".src-" + version)
+
+    def get_mirror_dir(self, repo_url):
+        parts = urlsplit(repo_url)
+        path = (parts.netloc + parts.path).strip("/")
+        if path.endswith(".git"):
+            path = path[:-4]
+        return get_cache_dir("git", path + ".git")
+
+    def _get_mirror_lock(self, repo_url) -> threading.Lock:
+        with self._mirror_locks_lock:
+            if repo_url not in self._mirror_locks:
+                self._mirror_locks[repo_url] = threading.Lock()
+            return self._mirror_locks[repo_url]
+
+    def _ensure_mirror(self, repo_url):
+        mirror_dir = self.get_mirror_dir(repo_url)
+        if not os.path.exists(os.path.join(mirror_dir, "HEAD")):
+            if os.path.exists(mirror_dir):
+                shutil.rmtree(mirror_dir)
+            os.makedirs(mirror_dir)
+            self._execute(f"git -C {mirror_dir} init -q --bare")
+            self._execute(f"git -C {mirror_dir} remote add origin {repo_url}")
+        return mirror_dir
 
     def check(self, repo_url, repo_dir):
         if not os.path.exists(repo_dir) or not os.path.isdir(repo_dir):
             return False
-        wd = os.getcwd()
         try:
-            os.chdir(repo_dir)
-            try:
-                self._execute(f"git status")
-            except CalledProcessError:
-                return False
-
-            return self._get_origin_url() == repo_url
-        finally:
-            os.chdir(wd)
-
-    def _get_origin_url(self):
-        cmd = f"git remote get-url origin"
-        output = execute(cmd)
-        self.logger.debug("$ %s\n%s", cmd, output)
-        return output.strip()
-
-    def _clone_repo(self, repo_url, repo_dir):
-        self._execute(f"git clone {repo_url} {repo_dir}")
+            output = execute(f"git -C {repo_dir} rev-parse --git-common-dir").strip()
+        except CalledProcessError:
+            return False
+        common_dir = os.path.realpath(os.path.join(repo_dir, output))
+        return common_dir == os.path.realpath(self.get_mirror_dir(repo_url))
 
     def ensure_repo(self, repo_url, repo_dir):
+        with self._get_mirror_lock(repo_url), get_tracer().span("clone", repo=repo_url):
+            self._ensure_mirror(repo_url)
+
         if not self.check(repo_url, repo_dir):
+            # e.g. a full clone made by an older version of the toolkit
             if os.path.exists(repo_dir):
                 shutil.rmtree(repo_dir)
 
-        if not os.path.exists(repo_dir):
-            self._clone_repo(repo_url, repo_dir)
+        # the worktree is added by checkout_repo once the commit is known
+        self._repos[repo_dir] = repo_url
+
+    def get_worktrees(self) -> List[str]:
+        """Returns the source directories of the current version."""
+        return sorted(d for d in self._repos if d == self.src_dir or d.startswith(self.src_dir + os.sep))
 
     def ensure(self, version):
+        self.src_dir = self.get_src_dir(version)
         repo_dir = self.src_dir
         self.ensure_repo(self.repo_url, repo_dir)
         self.checkout(repo_dir, version)
 
+    def get_refs(self, version) -> List[Tuple[str, str]]:
+        """Returns the (upstream URL, ref) pairs that the version is built from."""
+        return [(self.repo_url, self.get_ref(version))]
+
     def get_ref(self, version):
         if version == "latest":
             return "master"
@@ -64,29 +120,69 @@ class SourceManager:
         output = execute(cmd)
         self.logger.debug("$ %s\n%s", cmd, output)
 
-    def checkout_repo(self, repo_dir, ref):
-        wd = os.getcwd()
+    def _rev_parse(self, git_dir, rev) -> Optional[str]:
         try:
-            os.chdir(repo_dir)
-            self._execute(f"git fetch")
-            self._execute(f"git checkout {ref}")
-            self._execute(f"git pull origin {ref}")
-            self._execute(f"git clean -xfd")
-        finally:
-            os.chdir(wd)
+            return execute(f"git -C {git_dir} rev-parse -q --verify {rev}").strip()
+        except CalledProcessError:
+            return None
+
+    def _fetch_ref(self, repo_url, git_dir, ref) -> str:
+        if re.match(r"^[0-9a-f]{40}$", ref):
+            sha, refspec = ref, ref
+        else:
+            # a tag never moves, so if we have it already there is no need to
+            # ask the remote
+            sha = self._rev_parse(git_dir, f"refs/tags/{ref}^{{commit}}")
+            if sha:
+                return sha
+            with get_tracer().span("resolve", repo=repo_url, ref=ref):
+                resolved = get_resolver().resolve(repo_url, ref)
+            if not resolved:
+                raise RuntimeError("Failed to resolve {} in {}".format(ref, repo_url))
+            sha, name = resolved.sha, resolved.name
+            if name.startswith("refs/tags/"):
+                refspec = f"+{name}:{name}"
+            else:
+                refspec = f"+{name}:refs/remotes/origin/{ref}"
+
+        if not self._rev_parse(git_dir, f"{sha}^{{commit}}"):
+            with get_tracer().span("fetch", repo=repo_url, ref=ref, mode=self.fetch_mode):
+                self._fetch(git_dir, refspec)
+        return sha
+
+    def _fetch(self, git_dir, refspec):
+        if self.fetch_mode == "full":
+            refspec = "'+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*'"
+            self._execute(f"git -C {git_dir} fetch -q origin {refspec}")
+        elif self.fetch_mode == "shallow":
+            self._execute(f"git -C {git_dir} fetch -q --no-tags --depth 1 origin {refspec}")
+        else:
+            self._execute(f"git -C {git_dir} fetch -q --no-tags --filter=blob:none origin {refspec}")
+
+    def checkout_repo(self, repo_dir, ref):
+        repo_url = self._repos[repo_dir]
+        mirror_dir = self.get_mirror_dir(repo_url)
+
+        with self._get_mirror_lock(repo_url):
+            sha = self._fetch_ref(repo_url, mirror_dir, ref)
+            if not os.path.exists(repo_dir):
+                with get_tracer().span("worktree add", repo=repo_url, ref=ref):
+                    # drop worktrees whose directories were removed
+                    self._execute(f"git -C {mirror_dir} worktree prune")
+                    self._execute(f"git -C {mirror_dir} worktree add -q -f --detach {repo_dir} {sha}")
+
+        with get_tracer().span("checkout", repo=repo_url, ref=ref):
+            if self._rev_parse(repo_dir, "HEAD") != sha:
+                self._execute(f"git -C {repo_dir} checkout -q -f --detach {sha}")
+            self._execute(f"git -C {repo_dir} clean -xfd")
 
     def checkout(self, repo_dir, version):
         ref = self.get_ref(version)
         self.checkout_repo(repo_dir, ref)
 
     def get_revision(self, repo_dir):
-        wd = os.getcwd()
-        try:
-            os.chdir(repo_dir)
-            output = execute(f"git rev-parse HEAD")
-            return output.strip()
-        finally:
-            os.chdir(wd)
+        output = execute(f"git -C {repo_dir} rev-parse HEAD")
+        return output.strip()
 
     def get_application_revision(self, version):
         return self.get_revision(self.src_dir)
@@ -1,15 +1,24 @@
 import logging
 import os
 import sys
+import threading
 from datetime import datetime
-from typing import Optional, List
-from subprocess import CalledProcessError, check_output
-import re
+from typing import Optional, List, Dict, Tuple
+from subprocess import CalledProcessError, call
 
-from .docker import DockerTemplate, Platform, Platforms
+from .builders import Builders
+from .changes import ChangeDetector, get_image_inputs
+from .docker import DockerTemplate, Platform, Platforms, Manifest, ManifestList
+from .engine import DockerEngineClient
 from .git import GitTemplate
 from .github import GithubTemplate
 from .image import Image
+from .metrics import get_metrics
+from .plan import Plan
+from .refs import get_resolver, ResolvedRef
+from .scheduler import Scheduler, SchedulerError
+from .trace import get_tracer
+from .utils import execute, get_cache_dir
 from .travis import TravisTemplate
 
 
@@ -38,7 +47,12 @@ class Context:
                  project_repo: str,
                  project_dir: str,
                  git_template: GitTemplate,
-                 current_platform: Platform
+                 current_platform: Platform,
+                 fetch_mode: Optional[str] = None,
+                 backend: Optional[str] = None,
+                 build_cache: Optional[str] = None,
+                 cache_dir: Optional[str] = None,
+                 builders: Optional[List[str]] = None,
                  ):
         self._logger = logging.getLogger("core.Context")
 
@@ -50,6 +64,16 @@ class Context:
         self.timestamp = timestamp
         self.project_repo = project_repo
         self.project_dir = project_dir
+        self.fetch_mode = fetch_mode
+        # cli: run the docker CLI, engine: talk to the Engine API socket
+        self.backend = backend or os.environ.get("XUD_DOCKER_BACKEND", "cli")
+        self.engine = DockerEngineClient() if self.backend == "engine" else None
+        # BuildKit layer cache: registry, local or none
+        self.build_cache = build_cache or os.environ.get("XUD_DOCKER_BUILD_CACHE", "none")
+        self.cache_dir = cache_dir or get_cache_dir("buildkit")
+        # PLATFORM=BUILDER, the platforms without one are built (or emulated)
+        # by the local daemon
+        self.builders = Builders.from_env(builders, current_platform)
 
         self.docker_template = DockerTemplate(self)
         self.github_template = GithubTemplate(self)
@@ -62,8 +86,20 @@ class Context:
         self.revision = git_info.revision
         self.branch = git_info.branch
 
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.source_managers = {}
+        # build tag -> manifest fetched before the jobs were started
+        self.remote_manifests = {}
+
         self._logger.debug("Current branch is \"%s\"\n%s", self.branch, self._display_history(self.history))
 
+    def lock(self, key: str) -> threading.RLock:
+        with self._locks_lock:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
     def _display_history(self, history):
         lines = []
         for commit, images in history.items():
@@ -99,7 +135,9 @@ class Toolkit:
         self.git_template = GitTemplate(self.project_dir)
         self.current_platform = Platforms.get_current()
 
-    def _create_context(self, dry_run: bool, platforms: List[Platform]):
+    def _create_context(self, dry_run: bool, platforms: List[Platform], fetch_mode: Optional[str] = None,
+                        backend: Optional[str] = None, build_cache: Optional[str] = None,
+                        cache_dir: Optional[str] = None, builders: Optional[List[str]] = None):
         return Context(
             group=self.group,
             label_prefix=self.label_prefix,
@@ -110,52 +148,257 @@ class Toolkit:
             project_dir=self.project_dir,
             git_template=self.git_template,
             current_platform=self.current_platform,
+            fetch_mode=fetch_mode,
+            backend=backend,
+            build_cache=build_cache,
+            cache_dir=cache_dir,
+            builders=builders,
         )
 
-    def _get_current_branch(self) -> str:
-        cmd = "git branch --show-current"
-        print("\033[34m$ %s\033[0m" % cmd, flush=True)
-        output = check_output(cmd, shell=True)
-        output = output.decode()
-        print("%s" % output.rstrip(), flush=True)
-        output = output.strip()
-        return output
-
-    def _get_modified_images(self) -> List[str]:
-        branch = self._get_current_branch()
-        if branch == "master":
-            cmd = "git diff --name-only HEAD^..HEAD images"
+    def _get_all_images(self) -> List[str]:
+        return [name for name in sorted(os.listdir(os.path.join(self.project_dir, "images")))
+                if os.path.exists(os.path.join(self.project_dir, "images", name, "src.py"))]
+
+    def _get_pushed(self, ctx: Context, names: List[str]) -> Dict[str, List[Manifest]]:
+        """Returns the platform images of the manifest lists of the branch
+        (or of master, if the branch has none yet) which are to be built.
+        """
+        result = {}
+        tags = [Image(ctx, name).get_build_tag(ctx.branch, None) for name in names]
+        if ctx.branch != "master":
+            tags += [Image(ctx, name).get_build_tag("master", None) for name in names]
+        with get_tracer().span("manifest lookup", count=len(tags)):
+            manifests = ctx.docker_template.get_manifests(tags)
+        for i, name in enumerate(names):
+            lists = [m for m in manifests[i::len(names)] if isinstance(m, ManifestList)]
+            if lists:
+                found = {str(m.platform): m for m in lists[0].manifests}
+                result[name] = [found.get(str(p)) for p in ctx.platforms]
+        return result
+
+    def _get_change_reasons(self, ctx: Context, names: List[str]) -> Dict[str, str]:
+        """Returns image name -> why it has to be pushed for the images whose
+        inputs changed since they were pushed: a file of the image (see
+        core.changes), or the revision of an upstream source. The pushed
+        commit is the image.revision label of every platform image, all of
+        them are checked in one git log walk.
+        """
+        resolved = self.resolve_refs(ctx, names)
+        pushed = self._get_pushed(ctx, names)
+
+        reasons: Dict[str, str] = {}
+        bases: Dict[str, str] = {}
+        for name in names:
+            manifests = pushed.get(name)
+            if not manifests or None in manifests:
+                reasons[name] = "not pushed"
+                continue
+            refs = Image(ctx, name).get_refs()
+            for ref in refs:
+                r = resolved.get(ref)
+                if not r or any(r.sha not in (m.application_revision or "") for m in manifests):
+                    reasons[name] = "upstream {} changed".format(ref[1])
+                    break
+            if name in reasons:
+                continue
+            for i, m in enumerate(manifests):
+                revision = m.image_revision
+                if not revision or revision.endswith("-dirty"):
+                    reasons[name] = "pushed from a dirty tree"
+                    break
+                bases["{}@{}".format(name, i)] = revision
+
+        inputs = {key: get_image_inputs(key.split("@")[0]) for key in bases}
+        with get_tracer().span("changes", count=len(bases)):
+            changes = ChangeDetector(self.project_dir).get_changes(bases, inputs)
+        for key, files in changes.items():
+            name = key.split("@")[0]
+            if name in reasons:
+                continue
+            if files is None:
+                reasons[name] = "pushed from {} which is not in the history".format(bases[key][:7])
+            elif files:
+                reasons[name] = "{} changed since {}".format(files[0], bases[key][:7])
+
+        return reasons
+
+    def _get_local_change_reasons(self, ctx: Context, names: List[str]) -> Dict[str, str]:
+        """Returns image name -> why it has to be built for the images whose
+        inputs changed in the commits of the branch: since HEAD^ on master,
+        else since the fork point of origin/master. Only the local history
+        is read, neither the registry nor the upstream repositories.
+        """
+        if ctx.branch == "master":
+            base = "HEAD^"
         else:
-            cmd = "git diff --name-only $(git merge-base --fork-point origin/master)..HEAD images"
-        print("\033[34m$ %s\033[0m" % cmd, flush=True)
-        output = check_output(cmd, shell=True)
-        output = output.decode()
-        print("%s" % output.rstrip(), flush=True)
-        lines = output.splitlines()
-        p = re.compile(r"^images/(.+?)/.*$")
-        images = set()
-        for line in lines:
-            m = p.match(line)
-            assert m, "mismatch line (%r): %s" % (p, line)
-            image = m.group(1)
-            images.add(image)
+            base = "$(git -C {} merge-base --fork-point origin/master)".format(self.project_dir)
+        base = execute("git -C {} rev-parse {}".format(self.project_dir, base)).strip()
+
+        with get_tracer().span("changes", count=len(names)):
+            changes = ChangeDetector(self.project_dir).get_changes(
+                {name: base for name in names}, {name: get_image_inputs(name) for name in names})
+        return {name: "{} changed since {}".format(files[0], base[:7])
+                for name, files in changes.items() if files}
+
+    def _get_modified_images(self, ctx: Context, local: bool = False) -> Dict[str, str]:
+        """Returns image name -> reason of the images to build (local) or push
+        when none are given.
+        """
+        if local:
+            reasons = self._get_local_change_reasons(ctx, self._get_all_images())
+        else:
+            reasons = self._get_change_reasons(ctx, self._get_all_images())
 
         print()
-        print("Modified images: " + ", ".join(images))
+        for name, reason in sorted(reasons.items()):
+            print("Modified image {}: {}".format(name, reason))
+        if not reasons:
+            print("No modified images")
         print()
 
-        try:
-            images.remove("utils")
-        except KeyError:
-            pass
+        return reasons
 
-        return list(images)
+    def _get_log_dir(self) -> str:
+        return os.environ.get("XUD_DOCKER_LOG_DIR") or os.path.join(self.project_dir, "tools", "logs")
+
+    def _print_error(self, e: BaseException) -> None:
+        if isinstance(e, SchedulerError):
+            # the tracebacks are above, in the reports of the failed jobs
+            print(e)
+        p = e
+        while p:
+            if isinstance(p, CalledProcessError):
+                print("$ %s" % p.cmd)
+                if p.output:
+                    print(p.output.decode().strip())
+                break
+            p = p.__cause__
+
+    def resolve_refs(self, ctx: Context, images: List[str]) -> Dict[Tuple[str, str], Optional[ResolvedRef]]:
+        """Resolves the upstream refs of all images in one parallel round, so
+        that the prepare jobs find them in the cache.
+        """
+        refs = []
+        for name in images:
+            try:
+                refs.extend(Image(ctx, name).get_refs())
+            except Exception:
+                self._logger.exception("Failed to get the upstream refs of %s", name)
+        with get_tracer().span("resolve refs", count=len(refs)):
+            return get_resolver().resolve_all(refs)
+
+    def _write_trace(self, command: str, record: bool = True) -> None:
+        log_dir = self._get_log_dir()
+        trace_file = os.path.join(log_dir, "%s-trace.json" % command)
+        summary_file = os.path.join(log_dir, "%s-summary.json" % command)
+        try:
+            get_tracer().write(trace_file, summary_file)
+            print("Trace: %s" % trace_file, flush=True)
+        except OSError:
+            self._logger.exception("Failed to write the trace")
+        if record:
+            try:
+                git_info = self.git_template.git_info
+                get_metrics().record(command, get_tracer(), git_info.branch, git_info.revision)
+            except Exception:
+                self._logger.exception("Failed to record the metrics")
+
+    def _get_expected_durations(self, scheduler: Scheduler, command: str,
+                                skipped: Dict[str, bool] = None) -> Dict[str, Optional[float]]:
+        """Returns the expected duration of every job of scheduler from the
+        recorded runs of command (or else of the other of build and push).
+        """
+        other = "build" if command == "push" else "push"
+        jobs = {job.name: bool(skipped and skipped.get(job.name)) for job in scheduler.get_jobs()}
+        try:
+            return get_metrics().get_durations(jobs, [command, other])
+        except Exception:
+            self._logger.exception("Failed to read the metrics")
+            return {name: None for name in jobs}
+
+    def _prioritize(self, scheduler: Scheduler, command: str) -> None:
+        """Starts the jobs with the longest expected remaining time first,
+        which keeps a fixed number of workers busy until the end of the run.
+        """
+        expected = self._get_expected_durations(scheduler, command)
+        scheduler.prioritize({name: duration or 0.0 for name, duration in expected.items()})
+
+    def _create_scheduler(self, ctx: Context, images: List[str], platforms: List[Platform], run, jobs: int,
+                          keep_going: bool, prefetch_jobs: int, run_image=None) -> Scheduler:
+        """Returns the jobs of run(name, platform) for every image and
+        platform, or of run_image(name) once per image for all platforms.
+        """
+        # prefetch jobs run next to the builds, so they always write to logs
+        scheduler = Scheduler(jobs=jobs, keep_going=keep_going, log_dir=self._get_log_dir(),
+                              pools={"prefetch": prefetch_jobs})
+        for name in images:
+            # sources of all images are fetched in the background and each
+            # build starts as soon as the sources of its image are ready
+            prefetch = scheduler.add("{}@source".format(name), Image(ctx, name).prepare, pool="prefetch")
+            if run_image:
+                scheduler.add("{}@{}".format(name, "+".join(p.tag_suffix for p in platforms)),
+                              lambda name=name: run_image(name), [prefetch])
+                continue
+            for p in platforms:
+                scheduler.add("{}@{}".format(name, p.tag_suffix), lambda name=name, p=p: run(name, p), [prefetch])
+        return scheduler
+
+    def _plan(self, ctx: Context, scheduler: Scheduler, command: str, images: List[str], platforms: List[Platform],
+              multi_platform: bool = False, no_cache: bool = False,
+              reasons: Optional[Dict[str, str]] = None) -> None:
+        """Prints what the jobs of scheduler would do. The jobs of an image
+        which isn't in reasons would be skipped as up to date (push only).
+        """
+        plan = Plan(scheduler)
+        resolved = self.resolve_refs(ctx, images)
+        for name in images:
+            image = Image(ctx, name)
+            lines = plan.images.setdefault(name, [])
+            for ref in image.get_refs():
+                r = resolved.get(ref)
+                lines.append("upstream {} {} {}".format(r.sha if r else "?", ref[0], r.name if r else ref[1]))
+            if reasons is not None and name not in reasons:
+                action, notes = "skip", ["up to date"]
+            else:
+                action = command
+                notes = [reasons[name]] if reasons else []
+
+            plan.add("{}@source".format(name), "fetch")
+            export = command == "push" or ctx.build_cache == "local"
+            if multi_platform:
+                cache = [] if ctx.engine or action == "skip" else image.get_cache_args(None, no_cache, export)
+                builder = []
+                b = ctx.builders.get_common(platforms, check=False)
+                if action != "skip" and b:
+                    emulated = [p.tag_suffix for p in platforms if not b.is_native(p)]
+                    builder = ["builder {} ({})".format(
+                        b.spec, "emulated " + ", ".join(emulated) if emulated else "native")]
+                plan.add("{}@{}".format(name, "+".join(p.tag_suffix for p in platforms)), action,
+                         notes + builder + [arg[2:] for arg in cache])
+                continue
+            for p in platforms:
+                cache = [] if ctx.engine or action == "skip" else image.get_cache_args(p, no_cache, export)
+                builder = []
+                if action != "skip":
+                    b = image.get_builder(p, check=False)
+                    builder = ["builder {} ({})".format(b.spec, "native" if b.is_native(p) else "emulated")]
+                plan.add("{}@{}".format(name, p.tag_suffix), action, notes + builder + [arg[2:] for arg in cache])
+        skipped = {job: step.action == "skip" for job, step in plan.steps.items()}
+        plan.print(self._get_expected_durations(scheduler, command, skipped))
 
     def build(self,
               images: List[str] = None,
               dry_run: bool = False,
               no_cache: bool = False,
               platforms: List[str] = None,
+              jobs: int = 1,
+              keep_going: bool = False,
+              fetch_mode: str = None,
+              prefetch_jobs: int = 4,
+              backend: str = None,
+              build_cache: str = None,
+              cache_dir: str = None,
+              builders: List[str] = None,
               ) -> None:
         try:
             if platforms:
@@ -163,26 +406,28 @@ class Toolkit:
             else:
                 platforms = [self.current_platform]
 
-            ctx = self._create_context(dry_run, platforms)
+            ctx = self._create_context(dry_run, platforms, fetch_mode, backend, build_cache, cache_dir, builders)
 
             if not images:
-                images = self._get_modified_images()
+                images = sorted(self._get_modified_images(ctx, local=True))
 
-            for i, name in enumerate(images):
-                if i > 0:
-                    print()
-                for p in platforms:
-                    Image(ctx, name).build(platform=p, no_cache=no_cache)
+            def run(name: str, platform: Platform) -> None:
+                Image(ctx, name).build(platform=platform, no_cache=no_cache)
+
+            scheduler = self._create_scheduler(ctx, images, platforms, run, jobs, keep_going, prefetch_jobs)
+            if dry_run:
+                self._plan(ctx, scheduler, "build", images, platforms, no_cache=no_cache)
+                return
+
+            self.resolve_refs(ctx, images)
+            self._prioritize(scheduler, "build")
+            scheduler.run()
 
         except Exception as e:
-            p = e
-            while p:
-                if isinstance(p, CalledProcessError):
-                    print("$ %s" % p.cmd)
-                    print(p.output.decode().strip())
-                    break
-                p = e.__cause__
+            self._print_error(e)
             raise
+        finally:
+            self._write_trace("build-plan" if dry_run else "build", not dry_run)
 
     def push(self,
              images: List[str] = None,
@@ -190,6 +435,15 @@ class Toolkit:
              no_cache: bool = False,
              platforms: List[str] = None,
              dirty_push: bool = False,
+             jobs: int = 1,
+             keep_going: bool = False,
+             fetch_mode: str = None,
+             prefetch_jobs: int = 4,
+             backend: str = None,
+             build_cache: str = None,
+             cache_dir: str = None,
+             multi_platform: bool = False,
+             builders: List[str] = None,
              ) -> None:
         try:
             if platforms:
@@ -197,30 +451,97 @@ class Toolkit:
             else:
                 platforms = [self.current_platform]
 
-            ctx = self._create_context(dry_run, platforms)
+            ctx = self._create_context(dry_run, platforms, fetch_mode, backend, build_cache, cache_dir, builders)
 
+            reasons = None
             if not images:
-                images = self._get_modified_images()
-
-            for i, name in enumerate(images):
-                if i > 0:
-                    print()
-                for p in platforms:
-                    Image(ctx, name).push(platform=p, no_cache=no_cache, dirty_push=dirty_push)
+                reasons = self._get_modified_images(ctx)
+                images = sorted(reasons)
+
+            def run(name: str, platform: Platform) -> None:
+                Image(ctx, name).push(platform=platform, no_cache=no_cache, dirty_push=dirty_push)
+
+            def run_image(name: str) -> None:
+                Image(ctx, name).push_platforms(platforms, no_cache=no_cache, dirty_push=dirty_push)
+
+            scheduler = self._create_scheduler(ctx, images, platforms, run, jobs, keep_going, prefetch_jobs,
+                                               run_image if multi_platform else None)
+            if dry_run:
+                # the push jobs compare the input digests, which needs the
+                # sources, so the plan goes by the pushed revisions instead
+                if reasons is None and not no_cache:
+                    reasons = self._get_change_reasons(ctx, images)
+                self._plan(ctx, scheduler, "push", images, platforms, multi_platform, no_cache, reasons)
+                return
+
+            self.resolve_refs(ctx, images)
+
+            if not no_cache:
+                if multi_platform:
+                    tags = [Image(ctx, name).get_build_tag(ctx.branch, None) for name in images]
+                else:
+                    tags = [Image(ctx, name).get_build_tag(ctx.branch, p) for name in images for p in platforms]
+                with get_tracer().span("manifest lookup", count=len(tags)):
+                    ctx.remote_manifests = dict(zip(tags, ctx.docker_template.get_manifests(tags)))
+
+            self._prioritize(scheduler, "push")
+            scheduler.run()
 
         except Exception as e:
-            p = e
-            while p:
-                if isinstance(p, CalledProcessError):
-                    print("$ %s" % p.cmd)
-                    print(p.output.decode().strip())
-                    break
-                p = e.__cause__
+            self._print_error(e)
             raise
+        finally:
+            self._write_trace("push-plan" if dry_run else "push", not dry_run)
+
+    def refs(self, images: List[str] = None) -> None:
+        ctx = self._create_context(False, [self.current_platform])
+        if not images:
+            images = self._get_all_images()
+        for (repo_url, ref), resolved in self.resolve_refs(ctx, images).items():
+            if resolved:
+                print("%s %s %s" % (resolved.sha, repo_url, resolved.name))
+            else:
+                print("%-40s %s %s" % ("?", repo_url, ref))
 
     def test(self):
         os.chdir(self.project_dir)
-        sys.exit(os.system("python3.8 -m pytest -s"))
+        sys.exit(call([sys.executable, "-m", "pytest", "-s", "tools/tests"]))
+
+    def release(self,
+                images: List[str],
+                source_branch: str = None,
+                tags: List[str] = None,
+                dry_run: bool = False,
+                platforms: List[str] = None,
+                jobs: int = 4,
+                keep_going: bool = False,
+                verify: bool = True,
+                source_group: str = None,
+                ) -> None:
+        """Promotes images:tag of source_branch (default: the current branch)
+        to the release tags in the registry, concurrently across images.
+        """
+        try:
+            if platforms:
+                platforms = [Platforms.get(name) for name in platforms]
+            else:
+                platforms = self.platforms
+
+            ctx = self._create_context(dry_run, platforms)
+            source_branch = source_branch or ctx.branch
+
+            if verify:
+                self.resolve_refs(ctx, images)
 
-    def release(self):
-        raise NotImplementedError
+            log_dir = self._get_log_dir() if jobs > 1 else None
+            scheduler = Scheduler(jobs=jobs, keep_going=keep_going, log_dir=log_dir)
+            for name in images:
+                scheduler.add("{}@release".format(name),
+                              lambda name=name: Image(ctx, name).release(source_branch, tags, verify, source_group))
+            scheduler.run()
+
+        except Exception as e:
+            self._print_error(e)
+            raise
+        finally:
+            self._write_trace("release", not dry_run)
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Iterator
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    # seconds since the tracer was created
+    start: float
+    end: Optional[float] = None
+    thread_id: int = 0
+    args: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        if self.end is None:
+            return 0
+        return self.end - self.start
+
+
+class Tracer:
+    """Records how long each phase of a run takes. A span inherits the
+    arguments (image, tag, platform) of the span it is nested in, so lower
+    layers like SourceManager only name their phase.
+
+    The spans are written as a Chrome trace-event file (chrome://tracing,
+    https://ui.perfetto.dev) and as a summary with the totals per phase and
+    the duration of every scheduler job.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("core.Tracer")
+        self.started_at = datetime.utcnow()
+        self._t0 = time.perf_counter()
+        self._spans: List[Span] = []
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str, category: str = "phase", **args) -> Iterator[Span]:
+        stack = self._stack()
+        merged = dict(stack[-1].args) if stack else {}
+        merged.update({key: str(value) for key, value in args.items() if value is not None})
+        thread = threading.current_thread()
+        s = Span(name, category, time.perf_counter() - self._t0, thread_id=thread.ident, args=merged)
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+        stack.append(s)
+        try:
+            yield s
+        except BaseException as e:
+            s.args["error"] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            s.end = time.perf_counter() - self._t0
+            with self._lock:
+                self._spans.append(s)
+
+    def record(self, name: str, start: float, end: float, category: str = "phase", **args) -> Span:
+        """Adds a span measured by the caller, start and end are
+        time.perf_counter() values.
+        """
+        stack = self._stack()
+        merged = dict(stack[-1].args) if stack else {}
+        merged.update({key: str(value) for key, value in args.items() if value is not None})
+        thread = threading.current_thread()
+        s = Span(name, category, start - self._t0, end - self._t0, thread.ident, merged)
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self._spans.append(s)
+        return s
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return sorted(self._spans, key=lambda s: s.start)
+
+    def to_chrome_trace(self) -> Dict:
+        events = []
+        with self._lock:
+            threads = dict(self._threads)
+        # small thread ids read better in trace viewers
+        tids = {ident: i for i, ident in enumerate(sorted(threads), start=1)}
+        for ident, name in threads.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tids[ident],
+                "args": {"name": name},
+            })
+        for s in self.spans:
+            events.append({
+                "name": s.name,
+                "cat": s.category,
+                "ph": "X",
+                "ts": round(s.start * 1e6),
+                "dur": round(s.duration * 1e6),
+                "pid": 1,
+                "tid": tids.get(s.thread_id, 0),
+                "args": s.args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_summary(self) -> Dict:
+        spans = self.spans
+        phases: Dict[str, Dict] = {}
+        jobs: Dict[str, Dict] = {}
+        for s in spans:
+            if s.category == "job":
+                jobs[s.name] = {"duration": round(s.duration, 3), **s.args}
+                continue
+            p = phases.setdefault(s.name, {"count": 0, "total": 0.0, "max": 0.0})
+            p["count"] += 1
+            p["total"] = round(p["total"] + s.duration, 3)
+            p["max"] = round(max(p["max"], s.duration), 3)
+        return {
+            "started_at": self.started_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "duration": round(time.perf_counter() - self._t0, 3),
+            "phases": dict(sorted(phases.items(), key=lambda item: -item[1]["total"])),
+            "jobs": jobs,
+        }
+
+    def write(self, trace_file: str, summary_file: str) -> None:
+        for path, data in [(trace_file, self.to_chrome_trace()), (summary_file, self.to_summary())]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2)
+        self._logger.debug("Wrote trace to %s and %s", trace_file, summary_file)
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+    with _tracer_lock:
+        if not _tracer:
+            _tracer = Tracer()
+        return _tracer
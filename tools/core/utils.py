@@ -1,23 +1,53 @@
-from subprocess import check_output, STDOUT
-from urllib.request import urlopen
-import json
-from typing import Optional
+from collections import deque
+from subprocess import check_output, STDOUT, PIPE, Popen, CalledProcessError
+from typing import Optional, Callable, BinaryIO, List, TextIO
 import os
+import signal
+import threading
 
 
 def execute(cmd: str) -> str:
+    """Runs a command with a short output (git plumbing, docker tag) and
+    returns all of it. Builds and pushes go through stream_command.
+    """
     output = check_output(cmd, shell=True, stderr=STDOUT)
     return output.decode()
 
 
-def get_github_job_url(run_id: str, job_name: str) -> Optional[str]:
-    url = "https://api.github.com/repos/ExchangeUnion/xud-docker/actions/runs/{}/jobs".format(run_id)
-    resp = urlopen(url)
-    j = json.load(resp)
-    for job in j["jobs"]:
-        if job["name"] == job_name:
-            return "https://github.com/ExchangeUnion/xud-docker/runs/{}?check_suite_focus=true".format(job["id"])
-    return None
+class Feeder(threading.Thread):
+    """Writes the stdin of a process from a background thread so that the
+    caller can read the process output at the same time.
+    """
+
+    def __init__(self, f: BinaryIO, writer: Callable[[BinaryIO], None]):
+        super().__init__(daemon=True)
+        self.f = f
+        self.writer = writer
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        try:
+            self.writer(self.f)
+        except BrokenPipeError:
+            # the process exited early, its exit code tells why
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.f.close()
+            except OSError:
+                pass
+
+    def join_and_check(self):
+        self.join()
+        if self.error:
+            raise self.error
+
+
+def get_cache_dir(*parts: str) -> str:
+    base = os.environ.get("XUD_DOCKER_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "xud-docker")
+    return os.path.join(base, *parts)
 
 
 def get_current_branch() -> str:
@@ -34,3 +64,67 @@ def get_current_branch() -> str:
     else:
         raise Exception("failed to get current branch")
     return b
+
+
+class _Watcher(threading.Thread):
+    """Stops the process group of a command when the event is set."""
+
+    def __init__(self, p: Popen, event: threading.Event):
+        super().__init__(daemon=True)
+        self.p = p
+        self.event = event
+
+    def run(self):
+        while self.p.poll() is None:
+            if self.event.wait(0.5):
+                try:
+                    os.killpg(self.p.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                return
+
+
+def stream_command(cmd: str,
+                   stdin: Callable[[BinaryIO], None] = None,
+                   outputs: List[TextIO] = None,
+                   tail: int = 200,
+                   cancelled: threading.Event = None,
+                   ) -> List[str]:
+    """Runs a shell command and copies its output (stdout and stderr) line by
+    line to the outputs as it arrives. Only the last `tail` lines are kept in
+    memory; they are returned, or attached to the CalledProcessError when the
+    command fails, so a long build log never has to fit in RAM.
+
+    stdin, if given, writes the input of the command from a background thread.
+    The command runs in its own process group, which is terminated when
+    `cancelled` is set.
+    """
+    outputs = outputs or []
+    lines = deque(maxlen=tail)
+    p = Popen(cmd, shell=True, stdin=PIPE if stdin else None, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+    feeder = None
+    if stdin:
+        feeder = Feeder(p.stdin, stdin)
+        feeder.start()
+    if cancelled:
+        _Watcher(p, cancelled).start()
+    try:
+        while True:
+            # a bounded read keeps a huge line without newlines (progress
+            # bars) from being buffered whole
+            data = p.stdout.readline(65536)
+            if not data:
+                break
+            line = data.decode(errors="replace")
+            lines.append(line)
+            for f in outputs:
+                f.write(line)
+                f.flush()
+    finally:
+        p.stdout.close()
+        p.wait()
+    if feeder:
+        feeder.join_and_check()
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, cmd, output="".join(lines).encode())
+    return [line.rstrip("\n") for line in lines]
@@ -1,10 +1,57 @@
 from argparse import ArgumentParser
 import os
 import sys
+import time
 from core import Toolkit
+from core.docker import Platforms
+from core.metrics import get_metrics
+from core.scheduler import SchedulerError
+from core.src import SourceManager
 from subprocess import CalledProcessError
 
 
+def bench(project_dir, args):
+    from benchmark import Benchmark
+
+    images = args.images or sorted(name for name in os.listdir(os.path.join(project_dir, "images"))
+                                   if os.path.exists(os.path.join(project_dir, "images", name, "src.py")))
+    sizes = [len(images) if size == "all" else int(size) for size in args.sizes.split(",")]
+    b = Benchmark(project_dir, args.work_dir, args.platform, args.jobs, args.build_seconds, args.push_seconds,
+                  args.registry_latency, args.backend, args.multi_platform, args.builder, args.emulation_factor)
+    b.setup(images)
+    try:
+        b.run_startup(images[0])
+        for size in sorted(set(min(size, len(images)) for size in sizes)):
+            b.run_matrix(images, size)
+    finally:
+        b.teardown()
+    b.write(args.output)
+
+
+def metrics(args):
+    store = get_metrics()
+    since = time.time() - args.days * 86400 if args.days else 0
+    platform = args.platform
+    if platform and "/" in platform:
+        platform = Platforms.get(platform).tag_suffix
+
+    if args.query == "slowest":
+        print("%-16s %-20s %5s %9s %9s" % ("IMAGE", "PLATFORM", "RUNS", "MEDIAN", "MAX"))
+        for image, p, runs, median, longest in store.slowest(args.run_command, since, args.limit):
+            print("%-16s %-20s %5d %8.1fs %8.1fs" % (image, p, runs, median, longest))
+    elif args.query == "percentiles":
+        print("%-12s %5s %9s %9s" % (args.by.upper(), "RUNS", "P50", "P95"))
+        for period, runs, p50, p95 in store.percentiles(args.image, platform, args.run_command, since, args.by):
+            print("%-12s %5d %8.1fs %8.1fs" % (period, runs, p50, p95))
+    elif args.query == "regressions":
+        found = store.regressions(args.image, platform, args.run_command, args.factor)
+        for revision, previous, median, previous_median in found:
+            print("%s: %.1fs -> %.1fs (%.1fx) since %s" % (
+                revision, previous_median, median, median / previous_median if previous_median else 0, previous))
+        if not found:
+            print("No revision of %s is %.1fx slower than the one before" % (args.image, args.factor))
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("-d", "--debug", action="store_true")
@@ -14,6 +61,15 @@ def main():
     build_parser.add_argument("--dry-run", action="store_true")
     build_parser.add_argument("--no-cache", action="store_true")
     build_parser.add_argument("--platform", "-p", action="append")
+    build_parser.add_argument("--jobs", "-j", type=int, default=1)
+    build_parser.add_argument("--keep-going", "-k", action="store_true")
+    build_parser.add_argument("--fetch-mode", choices=SourceManager.FETCH_MODES)
+    build_parser.add_argument("--prefetch-jobs", type=int, default=4)
+    build_parser.add_argument("--backend", choices=["cli", "engine"])
+    build_parser.add_argument("--cache", choices=["registry", "local", "none"])
+    build_parser.add_argument("--cache-dir")
+    build_parser.add_argument("--builder", action="append", metavar="PLATFORM=BUILDER",
+                              help="build PLATFORM with BUILDER: local, buildx:NAME, context:NAME or a DOCKER_HOST URL")
     build_parser.add_argument("images", type=str, nargs="*")
 
     push_parser = subparsers.add_parser("push")
@@ -21,11 +77,70 @@ def main():
     push_parser.add_argument("--dry-run", action="store_true")
     push_parser.add_argument("--no-cache", action="store_true")
     push_parser.add_argument("--platform", "-p", action="append")
+    push_parser.add_argument("--jobs", "-j", type=int, default=1)
+    push_parser.add_argument("--keep-going", "-k", action="store_true")
+    push_parser.add_argument("--fetch-mode", choices=SourceManager.FETCH_MODES)
+    push_parser.add_argument("--prefetch-jobs", type=int, default=4)
+    push_parser.add_argument("--backend", choices=["cli", "engine"])
+    push_parser.add_argument("--cache", choices=["registry", "local", "none"])
+    push_parser.add_argument("--cache-dir")
+    push_parser.add_argument("--builder", action="append", metavar="PLATFORM=BUILDER",
+                             help="build PLATFORM with BUILDER: local, buildx:NAME, context:NAME or a DOCKER_HOST URL")
+    push_parser.add_argument("--multi-platform", action="store_true",
+                             help="build and push all platforms of an image with one buildx invocation")
     push_parser.add_argument("images", type=str, nargs="*")
 
+    refs_parser = subparsers.add_parser("refs")
+    refs_parser.add_argument("images", type=str, nargs="*")
+
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("--sizes", default="1,3,all",
+                              help="comma separated numbers of images to benchmark (all: every image)")
+    bench_parser.add_argument("--platform", "-p", action="append")
+    bench_parser.add_argument("--jobs", "-j", type=int, default=1)
+    bench_parser.add_argument("--build-seconds", type=float, default=0.5)
+    bench_parser.add_argument("--push-seconds", type=float, default=0.2)
+    bench_parser.add_argument("--registry-latency", type=float, default=0.02)
+    bench_parser.add_argument("--backend", choices=["cli", "engine"], default="cli")
+    bench_parser.add_argument("--multi-platform", action="store_true")
+    bench_parser.add_argument("--builder", action="append", metavar="PLATFORM=BUILDER",
+                              help="route PLATFORM to a fake native builder, e.g. linux/arm64=context:arm")
+    bench_parser.add_argument("--emulation-factor", type=float, default=1,
+                              help="how many times slower the fake builders are on other platforms")
+    bench_parser.add_argument("--work-dir")
+    bench_parser.add_argument("--output", "-o")
+    bench_parser.add_argument("images", type=str, nargs="*")
+
     subparsers.add_parser("test")
 
-    subparsers.add_parser("release")
+    metrics_parser = subparsers.add_parser("metrics", prog="metrics",
+                                           help="query the durations of past builds and pushes")
+    metrics_parser.add_argument("--command", dest="run_command", choices=["build", "push", "release"])
+    metrics_parser.add_argument("--days", type=float, help="only runs of the last DAYS days")
+    metrics_parser.add_argument("--platform", "-p", help="e.g. linux/arm64 or aarch64")
+    metrics_subparsers = metrics_parser.add_subparsers(dest="query", required=True)
+    slowest_parser = metrics_subparsers.add_parser("slowest", help="images with the longest median duration")
+    slowest_parser.add_argument("--limit", "-n", type=int, default=10)
+    percentiles_parser = metrics_subparsers.add_parser("percentiles", help="p50/p95 of an image over time")
+    percentiles_parser.add_argument("--by", choices=["day", "week"], default="day")
+    percentiles_parser.add_argument("image")
+    regressions_parser = metrics_subparsers.add_parser("regressions",
+                                                       help="revisions which made an image slower")
+    regressions_parser.add_argument("--factor", type=float, default=1.5)
+    regressions_parser.add_argument("image")
+
+    release_parser = subparsers.add_parser("release", prog="release")
+    release_parser.add_argument("--from", dest="source_branch",
+                                help="branch whose images are released (default: the current branch)")
+    release_parser.add_argument("--from-group", help="Docker Hub group of the branch images")
+    release_parser.add_argument("--tag", "-t", action="append", help="additional tag, e.g. latest")
+    release_parser.add_argument("--dry-run", action="store_true")
+    release_parser.add_argument("--platform", "-p", action="append")
+    release_parser.add_argument("--jobs", "-j", type=int, default=4)
+    release_parser.add_argument("--keep-going", "-k", action="store_true")
+    release_parser.add_argument("--no-verify", action="store_true",
+                                help="don't check the input digests of the images against this tree")
+    release_parser.add_argument("images", type=str, nargs="+")
 
     args = parser.parse_args()
 
@@ -37,13 +152,23 @@ def main():
     sys.path.append(".")
 
     if args.command == "build":
-        toolkit.build(args.images, args.dry_run, args.no_cache, args.platform)
+        toolkit.build(args.images, args.dry_run, args.no_cache, args.platform, args.jobs, args.keep_going,
+                      args.fetch_mode, args.prefetch_jobs, args.backend, args.cache, args.cache_dir, args.builder)
     elif args.command == "push":
-        toolkit.push(args.images, args.dry_run, args.no_cache, args.platform, args.dirty_push)
+        toolkit.push(args.images, args.dry_run, args.no_cache, args.platform, args.dirty_push, args.jobs,
+                     args.keep_going, args.fetch_mode, args.prefetch_jobs, args.backend, args.cache, args.cache_dir,
+                     args.multi_platform, args.builder)
+    elif args.command == "refs":
+        toolkit.refs(args.images)
+    elif args.command == "bench":
+        bench(project_dir, args)
     elif args.command == "test":
         toolkit.test()
+    elif args.command == "metrics":
+        metrics(args)
     elif args.command == "release":
-        toolkit.release()
+        toolkit.release(args.images, args.source_branch, args.tag, args.dry_run, args.platform, args.jobs,
+                        args.keep_going, not args.no_verify, args.from_group)
 
 
 if __name__ == "__main__":
@@ -51,5 +176,5 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print()
-    except CalledProcessError:
+    except (CalledProcessError, SchedulerError):
         sys.exit(1)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# the toolkit is imported as the top-level package core, like helper.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import FakeRegistry  # noqa: E402
+
+
+@pytest.fixture
+def registry():
+    r = FakeRegistry().start()
+    yield r
+    r.stop()
@@ -0,0 +1,66 @@
+import pytest
+
+from core.builders import Builder, Builders
+from core.docker import LINUX_AMD64, LINUX_ARM64, LINUX_ARM_V7
+
+
+@pytest.mark.parametrize("spec, kind, docker, buildx_args", [
+    ("local", "local", "docker", []),
+    ("buildx:arm-native", "buildx", "docker", ["--builder arm-native"]),
+    ("context:pi", "context", "docker --context pi", []),
+    ("ssh://pi@raspberry", "host", "docker --host ssh://pi@raspberry", []),
+])
+def test_builder_specs(spec, kind, docker, buildx_args):
+    builder = Builder(spec)
+    assert (builder.kind, builder.docker, builder.get_buildx_args()) == (kind, docker, buildx_args)
+
+
+def test_invalid_builder_spec():
+    with pytest.raises(ValueError):
+        Builder("arm-native")
+
+
+def test_engine_only_for_unix_sockets():
+    assert Builder("unix:///run/arm.sock").create_engine().socket_path == "/run/arm.sock"
+    assert Builder("tcp://10.0.0.2:2375").create_engine() is None
+    assert Builder("buildx:arm-native").create_engine() is None
+
+
+def test_platforms_are_routed_to_their_builders():
+    builders = Builders(["linux/arm64=buildx:arm", "linux/arm/v7=buildx:arm"], LINUX_AMD64)
+    arm = builders.get(LINUX_ARM64, check=False)
+    # platforms with the same spec share the builder, so it is checked once
+    assert arm is builders.get(LINUX_ARM_V7, check=False)
+    assert arm.is_native(LINUX_ARM64) and arm.is_native(LINUX_ARM_V7)
+    assert builders.get(LINUX_AMD64) is builders.local
+    assert builders.local.is_native(LINUX_AMD64) and not builders.local.is_native(LINUX_ARM64)
+
+
+def test_unavailable_builders_fall_back_to_local():
+    builders = Builders(["linux/arm64=buildx:arm"], LINUX_AMD64)
+    arm = builders.get(LINUX_ARM64, check=False)
+    arm._available = False
+    assert builders.get(LINUX_ARM64) is builders.local
+    # the plan shows the configured routing without asking the builder
+    assert builders.get(LINUX_ARM64, check=False) is arm
+
+
+def test_common_builder():
+    builders = Builders(["linux/arm64=buildx:multi", "linux/amd64=buildx:multi"], LINUX_AMD64)
+    assert builders.get_common([LINUX_AMD64, LINUX_ARM64], check=False).spec == "buildx:multi"
+    builders = Builders(["linux/arm64=buildx:arm"], LINUX_AMD64)
+    assert builders.get_common([LINUX_AMD64, LINUX_ARM64], check=False) is None
+
+
+@pytest.mark.parametrize("spec", ["buildx:arm", "linux/arm64:buildx:arm"])
+def test_invalid_routing(spec):
+    with pytest.raises(ValueError):
+        Builders([spec], LINUX_AMD64)
+
+
+def test_builders_from_env(monkeypatch):
+    monkeypatch.setenv("XUD_DOCKER_BUILDERS", " linux/arm64=context:pi, linux/arm/v7=context:pi ")
+    builders = Builders.from_env(None, LINUX_AMD64)
+    assert builders.get(LINUX_ARM_V7, check=False).spec == "context:pi"
+    # given specs win over the environment
+    assert Builders.from_env([], LINUX_AMD64).get_common([LINUX_ARM64], check=False).spec == "local"
@@ -0,0 +1,45 @@
+import hashlib
+import os
+import time
+
+from core.cache import DigestCache
+
+
+def entry(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest(), data
+
+
+def test_put_and_get(tmp_path):
+    cache = DigestCache(str(tmp_path))
+    digest, data = entry(b"manifest")
+    assert cache.get(digest) is None
+    cache.put(digest, data)
+    assert cache.get(digest) == data
+
+
+def test_only_matching_sha256_content_is_kept(tmp_path):
+    cache = DigestCache(str(tmp_path))
+    digest, _ = entry(b"manifest")
+    cache.put(digest, b"something else")
+    assert cache.get(digest) is None
+    cache.put("md5:" + hashlib.md5(b"x").hexdigest(), b"x")
+    assert cache.get("md5:" + hashlib.md5(b"x").hexdigest()) is None
+    assert not any(files for _, _, files in os.walk(str(tmp_path)))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DigestCache(str(tmp_path), max_size=250)
+    a, b, c = entry(b"a" * 100), entry(b"b" * 100), entry(b"c" * 100)
+    cache.put(*a)
+    cache.put(*b)
+    now = time.time()
+    os.utime(cache._get_path(a[0]), (now - 100, now - 100))
+    os.utime(cache._get_path(b[0]), (now - 50, now - 50))
+
+    # reading a makes b the least recently used entry
+    assert cache.get(a[0]) == a[1]
+    cache.put(*c)
+
+    assert cache.get(b[0]) is None
+    assert cache.get(a[0]) == a[1]
+    assert cache.get(c[0]) == c[1]
@@ -0,0 +1,74 @@
+import subprocess
+
+import pytest
+
+from core.changes import ChangeDetector, get_image_inputs
+
+
+class Repo:
+    def __init__(self, path):
+        self.path = path
+        self.git("init", "-q", "-b", "master")
+
+    def git(self, *args):
+        return subprocess.check_output(["git", "-C", str(self.path), "-c", "user.name=test",
+                                        "-c", "user.email=test@example.com"] + list(args)).decode().strip()
+
+    def commit(self, *files):
+        for name in files:
+            f = self.path / name
+            f.parent.mkdir(parents=True, exist_ok=True)
+            f.write_text(f.read_text() + "x" if f.exists() else name)
+            self.git("add", name)
+        self.git("commit", "-q", "--allow-empty", "-m", " ".join(files) or "empty")
+        return self.git("rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return Repo(tmp_path)
+
+
+def changes(repo, bases):
+    return ChangeDetector(str(repo.path)).get_changes(bases, {key: get_image_inputs(key) for key in bases})
+
+
+def test_changes_since_the_base_commit(repo):
+    base = repo.commit("images/xud/Dockerfile", "images/geth/Dockerfile")
+    repo.commit("images/xud/entrypoint.sh")
+    repo.commit("images/geth/Dockerfile", "README.md")
+    assert changes(repo, {"xud": base, "geth": base}) == {
+        "xud": ["images/xud/entrypoint.sh"],
+        "geth": ["images/geth/Dockerfile"],
+    }
+
+
+def test_nothing_changed_at_head(repo):
+    repo.commit("images/xud/Dockerfile")
+    head = repo.commit("README.md")
+    assert changes(repo, {"xud": head}) == {"xud": []}
+
+
+def test_toolkit_inputs_count_for_every_image(repo):
+    base = repo.commit("images/xud/Dockerfile", "tools/core/image.py", "tools/core/toolkit.py")
+    repo.commit("tools/core/toolkit.py")
+    assert changes(repo, {"xud": base}) == {"xud": []}
+    repo.commit("tools/core/image.py")
+    assert changes(repo, {"xud": base}) == {"xud": ["tools/core/image.py"]}
+
+
+def test_commits_merged_from_other_branches(repo):
+    root = repo.commit("images/xud/Dockerfile", "images/geth/Dockerfile")
+    repo.git("checkout", "-q", "-b", "feature")
+    repo.commit("images/geth/Dockerfile")
+    repo.git("checkout", "-q", "master")
+    base = repo.commit("images/xud/Dockerfile")
+    repo.git("merge", "-q", "--no-ff", "-m", "merge", "feature")
+    # the feature commit isn't an ancestor of base, the xud commit is
+    assert changes(repo, {"xud": base, "geth": base}) == {"xud": [], "geth": ["images/geth/Dockerfile"]}
+    assert changes(repo, {"xud": root}) == {"xud": ["images/xud/Dockerfile"]}
+
+
+def test_base_outside_the_history(repo):
+    repo.commit("images/xud/Dockerfile")
+    assert changes(repo, {"xud": "0" * 40}) == {"xud": None}
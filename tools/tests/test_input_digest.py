@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core.docker import LINUX_AMD64, LINUX_ARM64
+from core.image import BuildInputs, Image
+
+
+@pytest.fixture
+def image(tmp_path):
+    folder = tmp_path / "images" / "xud"
+    folder.mkdir(parents=True)
+    (folder / "Dockerfile").write_text("FROM alpine\n")
+    (folder / "entrypoint.sh").write_text("#!/bin/sh\n")
+    return Image(SimpleNamespace(project_dir=str(tmp_path)), "xud")
+
+
+def digest(image, revision="abc", dockerfile="Dockerfile", build_args=None, platform=LINUX_AMD64):
+    return image.get_input_digest(revision, image.image_folder + "/" + dockerfile, build_args or {}, platform)
+
+
+def test_same_inputs_same_digest(image):
+    assert digest(image) == digest(image)
+    assert digest(image).startswith("sha256:")
+
+
+@pytest.mark.parametrize("change", [
+    {"revision": "def"},
+    {"dockerfile": "Dockerfile.aarch64"},
+    {"build_args": {"BRANCH": "master"}},
+    {"platform": LINUX_ARM64},
+])
+def test_build_parameters_change_the_digest(image, change):
+    assert digest(image, **change) != digest(image)
+
+
+def test_files_of_the_image_folder_change_the_digest(image, tmp_path):
+    folder = tmp_path / "images" / "xud"
+    before = digest(image)
+    (folder / "entrypoint.sh").write_text("#!/bin/sh\nexit 1\n")
+    changed = digest(image)
+    assert changed != before
+
+    # the name of a file counts, not only its content
+    (folder / "entrypoint.sh").rename(folder / "start.sh")
+    assert digest(image) != changed
+
+
+def test_sources_and_bytecode_are_left_out(image, tmp_path):
+    before = digest(image)
+    folder = tmp_path / "images" / "xud"
+    for d in [".src", ".src-1.0.0", "__pycache__"]:
+        (folder / d).mkdir()
+        (folder / d / "file").write_text(d)
+    assert digest(image) == before
+
+
+def test_multi_platform_digest_ignores_the_platform_order(image):
+    a = BuildInputs("abc", "Dockerfile", {}, "sha256:1", "", [])
+    b = BuildInputs("abc", "Dockerfile", {}, "sha256:2", "", [])
+    assert image.get_multi_platform_digest([a, b]) == image.get_multi_platform_digest([b, a])
+    assert image.get_multi_platform_digest([a, b]) != image.get_multi_platform_digest([a])
@@ -0,0 +1,140 @@
+import json
+import os
+import stat
+from types import SimpleNamespace
+
+import pytest
+
+from core import docker
+from core.docker import DockerRegistryClient, get_registry_credentials
+
+LIST = DockerRegistryClient.MANIFEST_LIST_V2
+REPO, TAG = "exchangeunion/xud", "latest"
+
+
+def entry(architecture, digest):
+    return {"mediaType": DockerRegistryClient.MANIFEST_V2, "size": 1, "digest": "sha256:" + digest,
+            "platform": {"architecture": architecture, "os": "linux"}}
+
+
+def attestation(of, digest):
+    return {"mediaType": DockerRegistryClient.OCI_MANIFEST, "size": 1, "digest": "sha256:" + digest,
+            "platform": {"architecture": "unknown", "os": "unknown"},
+            "annotations": {"vnd.docker.reference.digest": of["digest"],
+                            "vnd.docker.reference.type": "attestation-manifest"}}
+
+
+def put_list(registry, manifests, media_type=LIST):
+    data = json.dumps({"schemaVersion": 2, "mediaType": media_type, "manifests": manifests}).encode()
+    registry.put_manifest(REPO, TAG, media_type, data)
+
+
+def get_list(registry):
+    _, media_type, data = registry.get_manifest(REPO, TAG)
+    return media_type, json.loads(data.decode())["manifests"]
+
+
+@pytest.fixture
+def client(registry):
+    return DockerRegistryClient(registry.url + "/token", registry.url, credentials=("user", "password"),
+                                manifest_list_settle=0)
+
+
+def test_creates_the_list(registry, client):
+    digest = client.update_manifest_list(REPO, TAG, entry("amd64", "a1"))
+    assert registry.get_manifest(REPO, TAG)[0] == digest
+    assert get_list(registry) == (LIST, [entry("amd64", "a1")])
+
+
+def test_replaces_the_entry_of_the_platform_in_place(registry, client):
+    put_list(registry, [entry("amd64", "a0"), entry("arm64", "b0")])
+    client.update_manifest_list(REPO, TAG, entry("amd64", "a1"))
+    assert get_list(registry)[1] == [entry("amd64", "a1"), entry("arm64", "b0")]
+
+
+def test_an_entry_which_is_there_is_not_written_again(registry, client):
+    put_list(registry, [entry("amd64", "a0")])
+    digest = registry.get_manifest(REPO, TAG)[0]
+    writes = []
+    put_manifest = registry.put_manifest
+    registry.put_manifest = lambda *args: writes.append(args) or put_manifest(*args)
+    assert client.update_manifest_list(REPO, TAG, entry("amd64", "a0")) == digest
+    assert writes == []
+
+
+def test_a_concurrent_write_is_merged(registry, client):
+    put_list(registry, [entry("amd64", "a0")])
+    get_manifest = client.get_manifest
+    calls = []
+
+    def racing_get_manifest(repo, tag):
+        res = get_manifest(repo, tag)
+        if not calls:
+            # another job writes between our read and our write
+            put_list(registry, [entry("amd64", "a0"), entry("arm64", "b1")])
+        calls.append(tag)
+        return res
+
+    client.get_manifest = racing_get_manifest
+    client.update_manifest_list(REPO, TAG, entry("386", "c1"))
+    # the If-Match write failed and was done again on top of the other one
+    assert len(calls) == 2
+    assert get_list(registry)[1] == [entry("amd64", "a0"), entry("arm64", "b1"), entry("386", "c1")]
+
+
+def test_an_overwrite_after_our_write_is_merged_again(registry, client, monkeypatch):
+    # a registry which ignores If-Match lets a stale writer drop our entry
+    put_list(registry, [entry("amd64", "a0"), entry("arm64", "b0")])
+    client.manifest_list_settle = 1
+
+    overwrites = []
+
+    def sleep(seconds):
+        if not overwrites:
+            overwrites.append(seconds)
+            put_list(registry, [entry("amd64", "a0"), entry("arm64", "b1")])
+
+    monkeypatch.setattr(docker, "time", SimpleNamespace(time=docker.time.time, sleep=sleep))
+    digest = client.update_manifest_list(REPO, TAG, entry("amd64", "a1"))
+    assert overwrites == [1]
+    assert registry.get_manifest(REPO, TAG)[0] == digest
+    assert get_list(registry)[1] == [entry("amd64", "a1"), entry("arm64", "b1")]
+
+
+def test_oci_index_keeps_its_type_and_the_other_attestations(registry, client):
+    amd64, arm64 = entry("amd64", "a0"), entry("arm64", "b0")
+    put_list(registry, [amd64, arm64, attestation(amd64, "a0a"), attestation(arm64, "b0a")],
+             DockerRegistryClient.OCI_INDEX)
+    client.update_manifest_list(REPO, TAG, entry("amd64", "a1"))
+    assert get_list(registry) == (DockerRegistryClient.OCI_INDEX,
+                                  [entry("amd64", "a1"), arm64, attestation(arm64, "b0a")])
+
+
+def test_credentials_of_a_credential_helper(tmp_path, monkeypatch):
+    helper = tmp_path / "bin" / "docker-credential-test"
+    helper.parent.mkdir()
+    helper.write_text("#!/bin/sh\n"
+                      "read url\n"
+                      "[ \"$url\" = https://index.docker.io/v1/ ] || { echo not found; exit 1; }\n"
+                      "echo '{\"ServerURL\": \"'$url'\", \"Username\": \"alice\", \"Secret\": \"secret\"}'\n")
+    helper.chmod(helper.stat().st_mode | stat.S_IEXEC)
+    (tmp_path / "config.json").write_text(json.dumps({"auths": {"https://index.docker.io/v1/": {}},
+                                                      "credsStore": "test"}))
+    monkeypatch.setenv("PATH", str(helper.parent) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path))
+    monkeypatch.delenv("XUD_DOCKER_USERNAME", raising=False)
+
+    assert get_registry_credentials() == ("alice", "secret")
+    assert get_registry_credentials("https://other.registry/") is None
+
+    # credHelpers take precedence over credsStore
+    (tmp_path / "config.json").write_text(json.dumps({"credHelpers": {"https://index.docker.io/v1/": "missing"},
+                                                      "credsStore": "test"}))
+    assert get_registry_credentials() is None
+
+
+def test_credentials_of_the_config_file(tmp_path, monkeypatch):
+    (tmp_path / "config.json").write_text(json.dumps({"auths": {"https://index.docker.io/v1/": {"auth": "Ym9iOnB3"}}}))
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path))
+    monkeypatch.delenv("XUD_DOCKER_USERNAME", raising=False)
+    assert get_registry_credentials() == ("bob", "pw")
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from core.github import GithubRateLimitError
+from core.refs import RefResolver, ResolvedRef
+
+REPO_URL = "https://github.com/ExchangeUnion/xud"
+
+
+class FakeGithub:
+    """Answers get_git_ref from refs (name -> (sha, type)) and records the
+    requests.
+    """
+
+    def __init__(self, refs=None, error=None):
+        self.refs = refs or {}
+        self.error = error
+        self.requests = []
+
+    def get_git_ref(self, repo, ref, etag=None, wait=True):
+        self.requests.append((repo, ref, etag, wait))
+        if self.error:
+            raise self.error
+        if ref not in self.refs:
+            return 404, None, None
+        sha, type_ = self.refs[ref]
+        if etag == '"{}"'.format(sha):
+            return 304, None, etag
+        return 200, {"object": {"sha": sha, "type": type_}}, '"{}"'.format(sha)
+
+    def get_git_tag(self, repo, sha, wait=True):
+        return {"object": {"sha": "commit-of-" + sha}}
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    return str(tmp_path / "refs.json")
+
+
+def test_branch_and_annotated_tag(cache_file):
+    github = FakeGithub({"heads/master": ("a" * 40, "commit"), "tags/v1.0.0": ("t" * 40, "tag")})
+    resolver = RefResolver(cache_file, github=github)
+    assert resolver.resolve(REPO_URL, "master").sha == "a" * 40
+    assert resolver.resolve(REPO_URL, "master").name == "refs/heads/master"
+    assert resolver.resolve(REPO_URL, "v1.0.0").sha == "commit-of-" + "t" * 40
+    # no waiting for the rate limit, git ls-remote is the fallback
+    assert all(not wait for _, _, _, wait in github.requests)
+
+
+def test_results_are_kept_for_the_ttl(cache_file):
+    github = FakeGithub({"heads/master": ("a" * 40, "commit")})
+    resolver = RefResolver(cache_file, ttl=60, github=github)
+    resolver.resolve(REPO_URL, "master")
+    requests = len(github.requests)
+    resolver.resolve(REPO_URL, "master")
+    assert len(github.requests) == requests
+
+    # and across runs
+    RefResolver(cache_file, ttl=60, github=github).resolve(REPO_URL, "master")
+    assert len(github.requests) == requests
+
+
+def test_expired_results_are_revalidated_with_their_etag(cache_file):
+    github = FakeGithub({"heads/master": ("a" * 40, "commit")})
+    resolver = RefResolver(cache_file, ttl=60, github=github)
+    first = resolver.resolve(REPO_URL, "master")
+    resolver._cache[REPO_URL + "#master"].checked_at -= 120
+
+    github.requests.clear()
+    second = resolver.resolve(REPO_URL, "master")
+    # only the known ref name is asked for, with the ETag of the last answer
+    assert github.requests == [("ExchangeUnion/xud", "heads/master", '"{}"'.format("a" * 40), False)]
+    assert second.sha == first.sha
+    assert second.checked_at > time.time() - 60
+
+    github.refs["heads/master"] = ("b" * 40, "commit")
+    resolver._cache[REPO_URL + "#master"].checked_at -= 120
+    assert resolver.resolve(REPO_URL, "master").sha == "b" * 40
+
+
+@pytest.mark.parametrize("error", [GithubRateLimitError("rate limit"), RuntimeError("API down")])
+def test_github_errors_fall_back_to_ls_remote(cache_file, monkeypatch, error):
+    resolver = RefResolver(cache_file, github=FakeGithub(error=error))
+    asked = []
+
+    def ls_remote(repo_url, ref):
+        asked.append((repo_url, ref))
+        return ResolvedRef("c" * 40, "refs/heads/" + ref, time.time())
+
+    monkeypatch.setattr(resolver, "_ls_remote", ls_remote)
+    assert resolver.resolve(REPO_URL, "master").sha == "c" * 40
+    assert asked == [(REPO_URL, "master")]
+
+
+def test_other_hosts_use_ls_remote(cache_file, monkeypatch):
+    github = FakeGithub()
+    resolver = RefResolver(cache_file, github=github)
+    monkeypatch.setattr(resolver, "_ls_remote",
+                        lambda repo_url, ref: ResolvedRef("d" * 40, "refs/tags/" + ref, time.time()))
+    result = resolver.resolve_all([("https://gitlab.com/x/y", "v1"), ("https://gitlab.com/x/y", "v1")])
+    assert list(result.values())[0].sha == "d" * 40
+    assert github.requests == []
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from core.scheduler import Job, JobCancelled, Scheduler, SchedulerError, current_job
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def wait_for_cancel():
+    job = current_job()
+    if not job.cancelled.wait(10):
+        raise AssertionError("not cancelled")
+    raise JobCancelled(job.name)
+
+
+def test_dependencies_run_first():
+    order = []
+    s = Scheduler(jobs=4)
+    a = s.add("a", lambda: order.append("a"))
+    b = s.add("b", lambda: order.append("b"), [a])
+    s.add("c", lambda: order.append("c"), [a, b])
+    s.run()
+    assert order == ["a", "b", "c"]
+    assert all(job.status == Job.DONE for job in s.get_jobs())
+
+
+def test_failure_cancels_the_rest():
+    s = Scheduler(jobs=2)
+    started = threading.Event()
+
+    def failing():
+        started.wait(10)
+        fail()
+
+    def running():
+        started.set()
+        wait_for_cancel()
+
+    a = s.add("a", failing)
+    b = s.add("b", running)
+    c = s.add("c", lambda: None, [a])
+    d = s.add("d", lambda: None, [b])
+    with pytest.raises(SchedulerError, match=r"a \(RuntimeError: boom\)") as e:
+        s.run()
+    assert e.value.failed == [a]
+    # without keep_going nothing starts after a failure
+    assert (a.status, b.status, c.status, d.status) == (Job.FAILED, Job.CANCELLED, Job.CANCELLED, Job.CANCELLED)
+
+
+def test_keep_going_runs_independent_jobs():
+    ran = []
+    s = Scheduler(jobs=1, keep_going=True)
+    a = s.add("a", fail)
+    b = s.add("b", lambda: ran.append("b"), [a])
+    c = s.add("c", lambda: ran.append("c"))
+    with pytest.raises(SchedulerError):
+        s.run()
+    assert ran == ["c"]
+    assert (a.status, b.status, c.status) == (Job.FAILED, Job.SKIPPED, Job.DONE)
+
+
+def test_failed_job_log_ends_with_the_traceback(tmp_path):
+    s = Scheduler(jobs=2, keep_going=True, log_dir=str(tmp_path))
+    a = s.add("x@source", fail)
+    with pytest.raises(SchedulerError):
+        s.run()
+    assert a.log_file == str(tmp_path / "x__source.log")
+    log = (tmp_path / "x__source.log").read_text()
+    assert "Traceback" in log and log.rstrip().endswith("RuntimeError: boom")
+
+
+def test_jobs_start_in_order_of_priority():
+    order = []
+    s = Scheduler(jobs=1)
+    a = s.add("a", lambda: order.append("a"))
+    s.add("b", lambda: order.append("b"))
+    s.add("c", lambda: order.append("c"), [a])
+    # a is short but c, which waits for it, is the longest job
+    s.prioritize({"a": 1, "b": 5, "c": 10})
+    s.run()
+    assert order == ["a", "c", "b"]
+
+
+def test_pools_limit_their_own_jobs():
+    s = Scheduler(jobs=1, pools={"prefetch": 2})
+    source = s.add("x@source", lambda: None, pool="prefetch")
+    s.add("y@source", lambda: None, pool="prefetch")
+    s.add("x@x86_64", lambda: None, [source])
+    times = s.estimate({"x@source": 2, "y@source": 3, "x@x86_64": 4})
+    assert times == {"x@source": (0, 2), "y@source": (0, 3), "x@x86_64": (2, 6)}
+
+
+def test_critical_path():
+    s = Scheduler(jobs=4)
+    a = s.add("a", lambda: None)
+    b = s.add("b", lambda: None)
+    s.add("c", lambda: None, [a, b])
+    assert [job.name for job in s.critical_path({"a": 1, "b": 3, "c": 2})] == ["b", "c"]